@@ -10,19 +10,28 @@ from goldretriever.models.models import (
     QueryResult,
     QueryWithEmbedding,
 )
-from goldretriever.services.chunks import get_document_chunks
-from goldretriever.services.openai import get_embeddings
+from goldretriever.services.cache import PersistentEmbeddingCache
+from goldretriever.services.chunks import aget_document_chunks, validate_document_embeddings
+from goldretriever.services.openai import aget_embeddings
 
 
 class DataStore(ABC):
     async def upsert(
-        self, documents: List[Document], chunk_token_size: Optional[int] = None
+        self,
+        documents: List[Document],
+        chunk_token_size: Optional[int] = None,
+        embedding_model: Optional[str] = None,
+        embedding_cache: Optional[PersistentEmbeddingCache] = None,
     ) -> List[str]:
         """
         Takes in a list of documents and inserts them into the database.
+        Documents with a precomputed embedding, computed with embedding_model, are inserted without embedding them again.
+        Chunks whose text is in the embedding cache, or the one at EMBEDDING_CACHE_PATH if None, reuse the cached embedding.
         First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
         Return a list of document ids.
         """
+        validate_document_embeddings(documents, embedding_model)
+
         # Delete any existing vectors for documents with the input document ids
         await asyncio.gather(
             *[
@@ -37,7 +46,7 @@ class DataStore(ABC):
             ]
         )
 
-        chunks = get_document_chunks(documents, chunk_token_size)
+        chunks = await aget_document_chunks(documents, chunk_token_size, embedding_cache=embedding_cache)
 
         return await self._upsert(chunks)
 
@@ -56,7 +65,7 @@ class DataStore(ABC):
         """
         # get a list of of just the queries from the Query list
         query_texts = [query.query for query in queries]
-        query_embeddings = get_embeddings(query_texts)
+        query_embeddings = await aget_embeddings(query_texts)
         # hydrate the queries with embeddings
         queries_with_embeddings = [
             QueryWithEmbedding(**query.dict(), embedding=embedding)
@@ -1,16 +1,30 @@
+import contextlib
 import os
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 from docarray import Document as DADoc
 from jina import Executor, requests, DocumentArray
 import asyncio
 
+from goldretriever.services.profiling import ProfilerBusyError, profile
+
+try:
+    from opentelemetry import propagate
+except ImportError:
+    propagate = None
+
+# The request parameter the gateway passes its trace context in
+TRACE_CONTEXT_PARAMETER = "__trace_context__"
+
 
 class DocArrayDataStore(Executor):
     def __init__(self, **kwargs):
-        super().__init__()
+        # the runtime arguments give the executor jina's tracer, if tracing is enabled for the flow
+        super().__init__(**kwargs)
         namespace = os.environ['K8S_NAMESPACE_NAME'].split('-')[1]
         workspace = f'/data/jnamespace-{namespace}'  # very hacky, figure out another way
         self._index_file_path = os.path.join(workspace, "retrieval_da.bin")
+        # bumped on every change of the index, lets the gateway invalidate its cached query results
+        self._generation = 0
 
         print(f"Index path set to {self._index_file_path}")
         try:
@@ -20,20 +34,60 @@ class DocArrayDataStore(Executor):
             self._index = DocumentArray()
             print(f"Instantiated empty index")
 
+    def _start_span(
+        self, name: str, parameters: Optional[Dict] = None, tracing_context=None, **attributes
+    ):
+        """Start a span as a child of the gateway's span if tracing is enabled, otherwise do nothing."""
+        tracer = getattr(self, "tracer", None)
+        if tracer is None:
+            return contextlib.nullcontext()
+        if tracing_context is None and propagate is not None and parameters:
+            carrier = parameters.get(TRACE_CONTEXT_PARAMETER)
+            if carrier:
+                tracing_context = propagate.extract(carrier)
+        return tracer.start_as_current_span(name, context=tracing_context, attributes=attributes)
+
     @requests(on="/upsert")
-    async def upsert(self, docs: DocumentArray, **kwargs) -> DocumentArray:
-        # Delete any existing vectors for documents with the input document ids
-        existing_docs = DocumentArray([doc for doc in docs if doc.id in self._index])
-        if existing_docs:
-            await asyncio.gather(self.delete(docs=existing_docs, parameters={}))
-
-        docs_to_append = docs[...]
-        self._index.extend(docs[...])
-        self._index.save_binary(self._index_file_path)
+    async def upsert(
+        self, docs: DocumentArray, parameters: Optional[Dict] = None, tracing_context=None, **kwargs
+    ) -> DocumentArray:
+        """
+        Index docs, replacing the documents with the same ids. The index is saved unless parameters["save"] is False,
+        which lets the gateway save it once with /save after indexing all batches of a request.
+        """
+        with self._start_span("index_upsert", parameters, tracing_context, num_docs=len(docs)):
+            # Delete any existing vectors for documents with the input document ids
+            existing_ids = [doc.id for doc in docs if doc.id in self._index]
+            if existing_ids:
+                del self._index[existing_ids]
+
+            docs_to_append = docs[...]
+            self._index.extend(docs[...])
+            if (parameters or {}).get("save", True):
+                self._save()
         return docs_to_append
 
+    @requests(on="/save")
+    async def save(
+        self, parameters: Optional[Dict] = None, tracing_context=None, **kwargs
+    ) -> DocumentArray:
+        with self._start_span("index_save", parameters, tracing_context):
+            self._save()
+        return DocumentArray(DADoc(tags={"generation": self._generation}))
+
+    def _save(self):
+        with self._start_span("save_index"):
+            self._index.save_binary(self._index_file_path)
+        self._generation += 1
+
     @requests(on="/query")
-    async def query(self, docs: DocumentArray, **kwargs) -> DocumentArray:
+    async def query(
+        self, docs: DocumentArray, parameters: Optional[Dict] = None, tracing_context=None, **kwargs
+    ) -> DocumentArray:
+        with self._start_span("index_query", parameters, tracing_context, num_queries=len(docs)):
+            return self._query(docs)
+
+    def _query(self, docs: DocumentArray) -> DocumentArray:
         result_docs = DocumentArray()
         for (
             doc
@@ -41,33 +95,62 @@ class DocArrayDataStore(Executor):
             filter_query = self._get_query_from_filters(doc.tags.get("filters"))
             docs_to_search = self._index
             if filter_query:
-                docs_to_search = self._index.find(filter_query)
-            matches = docs_to_search.find(doc.embedding, top_k=doc.tags["top_k"])
-            result_docs.append(DADoc(id=doc.id, chunks=matches))
+                with self._start_span("filter_scan", index_size=len(self._index)):
+                    docs_to_search = self._index.find(filter_query)
+            with self._start_span("vector_search", num_candidates=len(docs_to_search)):
+                matches = docs_to_search.find(doc.embedding, top_k=doc.tags["top_k"])
+            result_docs.append(
+                DADoc(
+                    id=doc.id,
+                    text=doc.text,
+                    chunks=matches,
+                    tags={"generation": self._generation},
+                )
+            )
         return result_docs
 
     @requests(on="/delete")
     async def delete(
-        self, docs: DocumentArray, parameters: Dict, **kwargs
+        self, docs: DocumentArray, parameters: Dict, tracing_context=None, **kwargs
     ) -> DocumentArray:
+        with self._start_span("index_delete", parameters, tracing_context):
+            return self._delete(docs, parameters)
+
+    def _delete(self, docs: DocumentArray, parameters: Dict) -> DocumentArray:
         delete_all = parameters.get("delete_all", False)
         ids = docs[:, "id"]
         filters = parameters.get("filters", None)
         if delete_all:
             self._index = DocumentArray()
-            self._index.save_binary(self._index_file_path)
-            return DocumentArray(DADoc(tags={"success": True}))
-        if ids:
+        elif ids:
             del self._index[ids]
-            self._index.save_binary(self._index_file_path)
-            return DocumentArray(DADoc(tags={"success": True}))
-        if filters:
+        elif filters:
             query = self._get_query_from_filters(filters)
             ids = self._index.find(query)[:, "id"]
             del self._index[ids]
-            self._index.save_binary(self._index_file_path)
-            return DocumentArray(DADoc(tags={"success": True}))
-        return DocumentArray(DADoc(tags={"success": False}))
+        else:
+            return DocumentArray(DADoc(tags={"success": False, "generation": self._generation}))
+        self._save()
+        return DocumentArray(DADoc(tags={"success": True, "generation": self._generation}))
+
+    @requests(on="/debug/profile")
+    async def debug_profile(self, parameters: Dict, **kwargs) -> DocumentArray:
+        """Profile this executor for parameters["seconds"] and return the folded stacks in the profile tag."""
+        loop = asyncio.get_running_loop()
+        try:
+            # in a thread, the endpoints keep being served and show up in the profile
+            folded = await loop.run_in_executor(
+                None,
+                profile,
+                float(parameters.get("seconds", 10)),
+                parameters.get("kind", "cpu"),
+                float(parameters.get("interval", 0.01)),
+            )
+        except ValueError as e:
+            return DocumentArray(DADoc(tags={"error": str(e)}))
+        except ProfilerBusyError as e:
+            return DocumentArray(DADoc(tags={"error": str(e), "busy": True}))
+        return DocumentArray(DADoc(tags={"profile": folded}))
 
     @staticmethod
     def _get_query_from_filters(filters: Dict[str, Any]) -> Dict:
@@ -1,14 +1,19 @@
 import functools
+import asyncio
 import json
+import multiprocessing
 import os
-from typing import Dict, List, Optional
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.managers import SyncManager
+from typing import AsyncIterator, List, Optional, Tuple
 
 import numpy as np
 import yaml
-from fastapi import FastAPI, File, HTTPException, Depends, Body, UploadFile
+from fastapi import FastAPI, File, HTTPException, Depends, Body, Request, UploadFile
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, PlainTextResponse, Response, StreamingResponse
 
 from jina.serve.runtimes.gateway.http.fastapi import FastAPIBaseGateway
 from docarray import Document as DADoc, DocumentArray
@@ -18,19 +23,57 @@ from models.api import (
     DeleteResponse,
     QueryRequest,
     QueryResponse,
+    UpsertJobResponse,
     UpsertRequest,
     UpsertResponse,
+    UpsertStreamResult,
 )
 from models.models import (
-    DocumentChunk,
+    Document,
+    DocumentChunkBatch,
+    DocumentChunkMetadata,
+    DocumentMetadata,
     DocumentMetadataFilter,
+    Job,
     QueryResult,
     DocumentChunkWithScore,
     Query,
+    Source,
 )
-from services.chunks import get_document_chunks
-from services.file import get_document_from_file
-from services.openai import get_embeddings
+from services.admission import AdmissionLimiter, AdmissionMiddleware
+from services.batching import EmbeddingBatcher
+from services.cache import (
+    EMBEDDING_CACHE_MAX_BYTES,
+    EMBEDDING_CACHE_PATH_ENV,
+    EmbeddingCache,
+    PersistentEmbeddingCache,
+    QueryResultCache,
+    SemanticQueryCache,
+)
+from services.chunks import (
+    EMBEDDINGS_BATCH_SIZE,
+    aembed_chunk_batches,
+    aembed_document_chunks,
+    aiter_in_executor,
+    aiter_upload_chunk_batches,
+    get_document_chunk_batches,
+    iter_document_chunk_batches,
+    iter_document_chunks,
+    validate_document_embeddings,
+    warm_tokenizer,
+)
+from services.compression import DecompressionMiddleware
+from services.file import guess_mimetype, iter_text_from_file
+from services.hedging import CircuitBreaker, CircuitOpenError, HedgedEmbedder
+from services.jobs import JobManager, JobQueueFullError
+from services.openai import AsyncEmbeddingClient
+from services.packing import pack_query_results
+from services.pipelining import process_pipelined
+from services.profiling import ProfilerBusyError, profile
+from services.scheduling import RateLimitScheduler
+from services.serialization import encode_query_response
+from services.stream import iter_ndjson_documents
+from services.tracing import RequestSpanMiddleware, create_file_tracer, start_span, trace_parameters
 
 bearer_scheme = HTTPBearer()
 BEARER_TOKEN_ENV = os.environ.get("BEARER_TOKEN")
@@ -42,25 +85,37 @@ def validate_token(bearer_token: str, credentials: HTTPAuthorizationCredentials
     return credentials
 
 
-def chunk_to_dadoc(chunk: DocumentChunk) -> DADoc:
-    doc = DADoc(
-        text=chunk.text,
-        tags=chunk.metadata.dict(),
-        embedding=np.array(chunk.embedding),
+def chunk_batch_to_da(batch: DocumentChunkBatch) -> DocumentArray:
+    tags = batch.metadata
+    if batch.num_tokens is not None:
+        # stored with the chunk, so that query results can be packed into a token budget without tokenizing them
+        tags = [dict(metadata, num_tokens=num_tokens) for metadata, num_tokens in zip(tags, batch.num_tokens)]
+    da = DocumentArray(
+        [
+            DADoc(id=id, text=text, tags=metadata) if id is not None else DADoc(text=text, tags=metadata)
+            for id, text, metadata in zip(batch.ids, batch.texts, tags)
+        ]
     )
-    if chunk.id is not None:
-        doc.id = chunk.id
-    return doc
+    # each document gets a float32 row view of the embedding matrix
+    da.embeddings = batch.embeddings
+    return da
 
 
 def dadoc_to_chunk_with_score(doc: DADoc):
-    return DocumentChunkWithScore(
+    # the matches were validated when they were indexed, skip validating them again
+    chunk = DocumentChunkWithScore.construct(
         score=list(doc.scores.values())[0].value,
         id=doc.id,
         text=doc.text,
-        metadata=doc.tags,
+        metadata=DocumentChunkMetadata.construct(
+            **{key: value for key, value in doc.tags.items() if key in DocumentChunkMetadata.__fields__}
+        ),
         embedding=None,
     )
+    num_tokens = doc.tags.get("num_tokens")
+    if num_tokens is not None:
+        chunk._num_tokens = int(num_tokens)
+    return chunk
 
 
 def query_to_doc(query: Query, embedding: Optional[List[float]] = None) -> DADoc:
@@ -74,18 +129,80 @@ def query_to_doc(query: Query, embedding: Optional[List[float]] = None) -> DADoc
         tags=tags,
     )
     if embedding is not None:
-        doc.embedding = np.array(embedding)
+        doc.embedding = np.array(embedding, dtype=np.float32)
     return doc
 
 
 def doc_to_query_result(doc: DADoc) -> QueryResult:
-    return QueryResult(
+    return QueryResult.construct(
         query=doc.text, results=[dadoc_to_chunk_with_score(doc) for doc in doc.chunks]
     )
 
 
+def query_response(
+    results: List[QueryResult], fields: Optional[List[str]] = None, accept: Optional[str] = None
+) -> Response:
+    # encoded directly instead of through the response model, which validates every chunk again
+    content, media_type = encode_query_response(results, fields, accept)
+    return Response(content=content, media_type=media_type)
+
+
+class NDJSONStreamingResponse(StreamingResponse):
+    """
+    StreamingResponse that may be sent while the request body is still being read.
+    StreamingResponse listens for the client disconnecting on the receive channel, which would consume the request body.
+    """
+
+    media_type = "application/x-ndjson"
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
+
+
 class RetrievalGateway(FastAPIBaseGateway):
-    def __init__(self, bearer_token: Optional[str] = None, openai_token: str = '', **kwargs):
+    def __init__(
+        self,
+        bearer_token: Optional[str] = None,
+        openai_token: str = '',
+        processing_workers: Optional[int] = None,
+        prewarm_tokenizer: bool = True,
+        max_decompressed_body_size: Optional[int] = 1024 * 1024 * 1024,
+        traces_file: Optional[str] = None,
+        max_inflight_upserts: int = 2,
+        max_concurrent_embedding_batches: int = 8,
+        stream_batch_size: int = 64,
+        job_workers: int = 2,
+        job_queue_size: int = 100,
+        embedding_timeout: float = 10,
+        embedding_max_connections: int = 32,
+        embedding_requests_per_minute: Optional[float] = 3000,
+        embedding_tokens_per_minute: Optional[float] = 1000000,
+        embedding_max_attempts: int = 2,
+        embedding_failure_threshold: int = 5,
+        embedding_reset_timeout: float = 30,
+        fallback_embedding_api_base: Optional[str] = None,
+        fallback_embedding_api_key: Optional[str] = None,
+        embedding_batch_wait_ms: float = 5,
+        embedding_batch_size: int = 128,
+        embedding_cache_size: int = 4096,
+        embedding_cache_ttl: Optional[float] = 3600,
+        chunk_embedding_cache_path: Optional[str] = None,
+        chunk_embedding_cache_max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        query_cache_size: int = 1024,
+        query_cache_ttl: Optional[float] = 600,
+        semantic_cache_threshold: Optional[float] = None,
+        semantic_cache_size: int = 1024,
+        query_token_budget: Optional[int] = 4000,
+        max_concurrent_queries: int = 64,
+        max_queued_queries: int = 256,
+        query_queue_timeout: Optional[float] = 5,
+        max_concurrent_ingests: int = 4,
+        max_queued_ingests: int = 16,
+        ingest_queue_timeout: Optional[float] = None,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self.plugin_description = kwargs.get('plugin_description')
         self.plugin_name = kwargs.get('plugin_name')
@@ -97,30 +214,369 @@ class RetrievalGateway(FastAPIBaseGateway):
             os.environ["OPENAI_API_KEY"] = openai_token  # TODO(johannes): hacky, change to pass around
         assert os.environ.get("OPENAI_API_KEY", None) is not None
 
-    async def perform_upsert_call(
-        self, chunks: Dict[str, List[DocumentChunk]]
+        # CPU-bound text extraction and chunking run in worker processes, to keep queries responsive during ingestion.
+        # None uses one worker per core, 0 runs them in a thread of the gateway process instead
+        self.processing_workers = processing_workers if processing_workers is not None else os.cpu_count()
+        self.processing_pool = (
+            ProcessPoolExecutor(
+                max_workers=self.processing_workers,
+                # forking a process that runs grpc threads is unsafe
+                mp_context=multiprocessing.get_context("spawn"),
+            )
+            if processing_workers != 0
+            else None
+        )
+        self._processing_manager: Optional[SyncManager] = None
+        # the tokenizer is loaded lazily, prewarming loads it in the background once the gateway is serving,
+        # in the gateway process, which counts the tokens of query results, and in every processing worker
+        self.prewarm_tokenizer = prewarm_tokenizer
+        # ingestion bodies may be sent compressed, this bounds the size they are decompressed to,
+        # and the size of a line of a streamed upsert, which is buffered until it is complete
+        self.max_decompressed_body_size = max_decompressed_body_size
+        self.max_inflight_upserts = max_inflight_upserts
+        # the embedding requests of one upsert that are in flight at a time, the scheduler paces them all
+        self.max_concurrent_embedding_batches = max_concurrent_embedding_batches
+        self.stream_batch_size = stream_batch_size
+        self.jobs = JobManager(
+            self.upsert_documents,
+            num_workers=job_workers,
+            max_queued_jobs=job_queue_size,
+            batch_size=stream_batch_size,
+        )
+        # the embedding requests of all upserts are paced to the rate limits of the OpenAI account together.
+        # Query embeddings are sent right away, but count against the limits
+        self.embedding_scheduler = RateLimitScheduler(
+            requests_per_minute=embedding_requests_per_minute,
+            tokens_per_minute=embedding_tokens_per_minute,
+        )
+        self.embedding_client = AsyncEmbeddingClient(
+            timeout=embedding_timeout,
+            max_connections=embedding_max_connections,
+            scheduler=self.embedding_scheduler,
+        )
+        # query embeddings are hedged instead of retried with backoff, to bound the tail latency of queries.
+        # An alternate OpenAI-compatible API serving the same model is used while the OpenAI API is failing
+        self.fallback_embedding_client = (
+            AsyncEmbeddingClient(
+                timeout=embedding_timeout,
+                max_connections=embedding_max_connections,
+                api_base=fallback_embedding_api_base,
+                api_key=fallback_embedding_api_key,
+            )
+            if fallback_embedding_api_base is not None
+            else None
+        )
+        self.hedged_embedder = HedgedEmbedder(
+            self.embedding_client.create_embeddings,
+            max_attempts=embedding_max_attempts,
+            circuit_breaker=CircuitBreaker(
+                failure_threshold=embedding_failure_threshold,
+                reset_timeout=embedding_reset_timeout,
+            ),
+            fallback=self.fallback_embedding_client.create_embeddings
+            if self.fallback_embedding_client is not None
+            else None,
+        )
+        # concurrent queries are embedded together, see get_query_embeddings
+        self.embedding_batcher = EmbeddingBatcher(
+            self.hedged_embedder.get_embeddings,
+            max_wait=embedding_batch_wait_ms / 1000,
+            max_batch_size=embedding_batch_size,
+        )
+        self.embedding_cache = EmbeddingCache(maxsize=embedding_cache_size, ttl=embedding_cache_ttl)
+        # re-upserted chunks whose text is unchanged reuse their embeddings from disk, also across restarts
+        chunk_embedding_cache_path = chunk_embedding_cache_path or os.environ.get(EMBEDDING_CACHE_PATH_ENV)
+        self.chunk_embedding_cache = (
+            PersistentEmbeddingCache(chunk_embedding_cache_path, max_bytes=chunk_embedding_cache_max_bytes)
+            if chunk_embedding_cache_path
+            else None
+        )
+        self.query_cache = QueryResultCache(maxsize=query_cache_size, ttl=query_cache_ttl)
+        # opt-in, because a close match may serve the results of a different query, e.g. "Q3 revenue" for "Q4 revenue"
+        self.semantic_cache = (
+            SemanticQueryCache(threshold=semantic_cache_threshold, maxsize=semantic_cache_size)
+            if semantic_cache_threshold is not None
+            else None
+        )
+        # the default token budget of the chunk texts returned to the plugin, None to return all chunks
+        self.query_token_budget = query_token_budget
+        # queries and ingestion are admitted separately, so that a burst of uploads cannot delay queries.
+        # Requests beyond the queue limits, or waiting longer than the queue timeout, are rejected with a 429
+        self.query_limiter = AdmissionLimiter(
+            "query",
+            max_concurrency=max_concurrent_queries,
+            max_queued=max_queued_queries,
+            queue_timeout=query_queue_timeout,
+        )
+        self.ingest_limiter = AdmissionLimiter(
+            "ingest",
+            max_concurrency=max_concurrent_ingests,
+            max_queued=max_queued_ingests,
+            queue_timeout=ingest_queue_timeout,
+        )
+        # spans are exported with jina's tracer if tracing is enabled for the flow, otherwise optionally to a file
+        self._file_tracer, self._close_file_tracer = (
+            create_file_tracer(traces_file, self.__class__.__name__) if traces_file else (None, None)
+        )
+        # cached query results are only served while the index generation is unchanged,
+        # it is bumped on every upsert or delete and whenever the executor reports a change of its index
+        self.index_generation = 0
+        self._executor_generation: Optional[int] = None
+
+    def get_tracer(self):
+        tracer = getattr(self, "tracer", None)
+        return tracer if tracer is not None else self._file_tracer
+
+    def observe_executor_generation(self, generation: Optional[int]):
+        if generation is None:
+            return
+        if self._executor_generation is not None and generation != self._executor_generation:
+            self.index_generation += 1
+        self._executor_generation = generation
+
+    def bump_index_generation(self):
+        self.index_generation += 1
+        # the next generation reported by the executor already includes this change
+        self._executor_generation = None
+
+    async def get_query_embeddings(self, query_texts: List[str]) -> List[List[float]]:
+        """
+        Embed query texts, serving repeated queries from the embedding cache.
+        Texts missing from the cache are batched with those of concurrent requests into a single OpenAI request.
+        """
+        model = self.embedding_client.model
+        embeddings, missing = self.embedding_cache.get_many(query_texts, model)
+        if missing:
+            missing_texts = list(dict.fromkeys(query_texts[i] for i in missing))
+            with start_span(self.get_tracer(), "embed_queries", num_queries=len(missing_texts)):
+                missing_embeddings = dict(
+                    zip(missing_texts, await self.embedding_batcher.get_embeddings(missing_texts))
+                )
+            for i in missing:
+                embeddings[i] = missing_embeddings[query_texts[i]]
+            self.embedding_cache.put_many(
+                missing_texts, [missing_embeddings[text] for text in missing_texts], model
+            )
+        return embeddings
+
+    async def upsert_documents(
+        self, documents: List[Document], embedding_model: Optional[str] = None
     ) -> UpsertResponse:
-        docs_to_send = DocumentArray()
-        for _, chunk_list in chunks.items():
-            docs_to_send.extend([chunk_to_dadoc(chunk) for chunk in chunk_list])
-        ids_to_return = []
-        async for docs in self.streamer.stream_docs(
-            docs=docs_to_send,
-            exec_endpoint="/upsert",
+        """
+        Chunk, embed and index documents.
+        Documents with precomputed embeddings, computed with embedding_model, are indexed as they are.
+        Each batch of embedded chunks is sent to the executor as soon as it is ready, while the next batch is embedded.
+        At most max_inflight_upserts batches are being indexed at a time, the next batch is embedded only once one of them is done.
+        """
+        validate_document_embeddings(documents, embedding_model, self.embedding_client.model)
+
+        with start_span(self.get_tracer(), "upsert_documents", num_documents=len(documents)):
+            return await self._upsert_documents(documents)
+
+    async def _upsert_documents(self, documents: List[Document]) -> UpsertResponse:
+        return await self.upsert_chunk_batches(self.iter_embedded_chunk_batches(documents))
+
+    async def upsert_file(self, file: UploadFile) -> UpsertResponse:
+        """
+        Chunk, embed and index an uploaded file while its text is extracted, page by page or row by row,
+        so that files of any size are indexed completely, holding only a few batches of chunks at a time.
+        """
+        mimetype = file.content_type or guess_mimetype(file.filename or "")
+        document = Document(id=str(uuid.uuid4()), text="", metadata=DocumentMetadata(source=Source.file))
+        if self.processing_pool is not None:
+            # the file is parsed and chunked in a worker process, which sends the batches back while it reads the file
+            batches = aiter_upload_chunk_batches(
+                file, mimetype, document, self.processing_pool, self.get_processing_manager()
+            )
+        else:
+            await file.seek(0)
+            chunks = iter_document_chunks(document, document.id, None, iter_text_from_file(file.file, mimetype))
+            batches = aiter_in_executor(iter_document_chunk_batches(chunks))
+
+        try:
+            with start_span(self.get_tracer(), "upsert_file", mimetype=mimetype):
+                return await self.upsert_chunk_batches(
+                    aembed_chunk_batches(
+                        batches,
+                        self.embedding_client,
+                        self.get_tracer(),
+                        self.max_concurrent_embedding_batches,
+                        self.chunk_embedding_cache,
+                    )
+                )
+        finally:
+            # stops the worker process right away if the file could not be indexed
+            await batches.aclose()
+
+    def get_processing_manager(self) -> SyncManager:
+        """Return the manager passing the chunk batches of uploaded files back from the worker processes."""
+        # started with the first uploaded file, to keep it out of the startup time
+        if self._processing_manager is None:
+            self._processing_manager = multiprocessing.get_context("spawn").Manager()
+        return self._processing_manager
+
+    async def upsert_chunk_batches(self, batches: AsyncIterator[DocumentChunkBatch]) -> UpsertResponse:
+        """
+        Index batches of embedded chunks while they arrive, with at most max_inflight_upserts batches in flight.
+        The executor saves its index once after all batches, also those indexed before a batch failed.
+        """
+        num_upserts = 0
+
+        async def upsert(batch: DocumentChunkBatch) -> UpsertResponse:
+            nonlocal num_upserts
+            num_upserts += 1
+            return await self.perform_upsert_call(batch, save=False)
+
+        try:
+            responses = await process_pipelined(batches, upsert, self.max_inflight_upserts)
+        finally:
+            if num_upserts:
+                await self.perform_save_call()
+
+        return UpsertResponse(ids=[id for response in responses for id in response.ids])
+
+    async def iter_embedded_chunk_batches(
+        self, documents: List[Document]
+    ) -> AsyncIterator[DocumentChunkBatch]:
+        loop = asyncio.get_running_loop()
+        # the chunks travel as columnar batches, which are much cheaper to send back from a worker process
+        with start_span(self.get_tracer(), "chunk_documents", num_documents=len(documents)):
+            to_embed, embedded = await loop.run_in_executor(
+                self.processing_pool,
+                get_document_chunk_batches,
+                documents,
+                None,  # uses default chunk size
+            )
+        # chunks with precomputed embeddings skip the embedding stage
+        for i in range(0, len(embedded), EMBEDDINGS_BATCH_SIZE):
+            yield embedded[i : i + EMBEDDINGS_BATCH_SIZE]
+        async for batch in aembed_document_chunks(
+            to_embed,
+            self.embedding_client,
+            self.get_tracer(),
+            self.max_concurrent_embedding_batches,
+            self.chunk_embedding_cache,
         ):
-            ids_to_return.extend(docs[:, "id"])
+            yield batch
+
+    async def stream_upsert_documents(
+        self, stream: AsyncIterator[bytes], embedding_model: Optional[str] = None
+    ) -> AsyncIterator[str]:
+        """
+        Index newline-delimited JSON documents while they arrive, stream_batch_size documents at a time.
+        Yields one UpsertStreamResult line per document, with its id or the reason it was not indexed.
+        """
+        batch: List[Tuple[int, Document]] = []
+
+        async def flush():
+            try:
+                await self.upsert_documents([document for _, document in batch], embedding_model)
+                results = [UpsertStreamResult(line=line, id=document.id) for line, document in batch]
+            except Exception as e:
+                print("Error:", e)
+                results = [
+                    UpsertStreamResult(line=line, id=document.id, error=str(e))
+                    for line, document in batch
+                ]
+            batch.clear()
+            return "".join(result.json() + "\n" for result in results)
+
+        async for line, document in iter_ndjson_documents(stream, self.max_decompressed_body_size):
+            if isinstance(document, str):
+                yield UpsertStreamResult(line=line, error=document).json() + "\n"
+                continue
+            # assign the id here to be able to report it
+            document.id = document.id or str(uuid.uuid4())
+            batch.append((line, document))
+            if len(batch) >= self.stream_batch_size:
+                yield await flush()
+        if batch:
+            yield await flush()
+
+    async def perform_upsert_call(self, chunks: DocumentChunkBatch, save: bool = True) -> UpsertResponse:
+        """
+        Index a batch of chunks. With save=False the executor doesn't save its index,
+        and the caller saves it with perform_save_call once it has indexed all of its batches.
+        """
+        ids_to_return = []
+        with start_span(self.get_tracer(), "executor_upsert", num_chunks=len(chunks)):
+            docs_to_send = chunk_batch_to_da(chunks)
+            async for docs in self.streamer.stream_docs(
+                docs=docs_to_send,
+                parameters=trace_parameters({"save": save}),
+                exec_endpoint="/upsert",
+            ):
+                ids_to_return.extend(docs[:, "id"])
+        if save:
+            self.bump_index_generation()
 
         return UpsertResponse(ids=ids_to_return)
 
+    async def perform_save_call(self):
+        try:
+            with start_span(self.get_tracer(), "executor_save"):
+                async for _ in self.streamer.stream_docs(
+                    docs=DocumentArray([DADoc()]),
+                    parameters=trace_parameters(),
+                    exec_endpoint="/save",
+                ):
+                    pass
+        finally:
+            # the batches are in the executor's index even if saving it failed
+            self.bump_index_generation()
+
     async def perform_query_call(self, da: DocumentArray) -> List[QueryResult]:
         query_results = []
-        async for docs in self.streamer.stream_docs(
-            docs=da,
-            exec_endpoint="/query",
-        ):
-            query_results.extend([doc_to_query_result(doc) for doc in docs])
+        with start_span(self.get_tracer(), "executor_query", num_queries=len(da)):
+            async for docs in self.streamer.stream_docs(
+                docs=da,
+                parameters=trace_parameters(),
+                exec_endpoint="/query",
+            ):
+                for doc in docs:
+                    self.observe_executor_generation(doc.tags.get("generation"))
+                    query_results.append(doc_to_query_result(doc))
         return query_results
 
+    async def query_documents(self, queries: List[Query]) -> List[QueryResult]:
+        """
+        Answer queries, serving repeated ones from the query result cache and, if it is enabled,
+        paraphrased ones from the semantic cache. Only the queries missing from the caches are sent to the executor.
+        """
+        with start_span(self.get_tracer(), "query_documents", num_queries=len(queries)):
+            return await self._query_documents(queries)
+
+    async def _query_documents(self, queries: List[Query]) -> List[QueryResult]:
+        generation = self.index_generation
+        results = [self.query_cache.get_result(query, generation) for query in queries]
+        missing = [i for i, result in enumerate(results) if result is None]
+        if not missing:
+            return results
+
+        query_embeddings = await self.get_query_embeddings(
+            [queries[i].query for i in missing]
+        )
+        to_search = []
+        for i, embedding in zip(missing, query_embeddings):
+            if self.semantic_cache is not None:
+                results[i] = self.semantic_cache.get_result(queries[i], embedding, generation)
+            if results[i] is None:
+                to_search.append((i, embedding))
+
+        if to_search:
+            query_da_docs = DocumentArray(
+                [query_to_doc(queries[i], embedding) for i, embedding in to_search]
+            )
+            search_results = await self.perform_query_call(query_da_docs)
+            for (i, embedding), result in zip(to_search, search_results):
+                results[i] = result
+                if self.semantic_cache is not None:
+                    self.semantic_cache.put_result(queries[i], embedding, result, generation)
+
+        for i in missing:
+            self.query_cache.put_result(queries[i], results[i], generation)
+        return results
+
     async def perform_delete_call(
         self,
         ids: Optional[List[str]] = None,
@@ -129,15 +585,40 @@ class RetrievalGateway(FastAPIBaseGateway):
     ) -> bool:
         ids = ids or []
         docs = DocumentArray([DADoc(id=id) for id in ids])
-        parameters = {"delete_all": delete_all, "filter": filter.dict()}
-        async for docs in self.streamer.stream_docs(
-            docs=docs,
-            parameters=parameters,
-            exec_endpoint="/delete",
-        ):
-            if len([doc for doc in docs if doc.tags.get("success", False)]) > 0:
-                return True
-        return False
+        parameters = trace_parameters(
+            {
+                "delete_all": delete_all,
+                "filters": filter.dict(exclude_none=True) if filter is not None else None,
+            }
+        )
+        success = False
+        with start_span(self.get_tracer(), "executor_delete", num_ids=len(ids)):
+            async for docs in self.streamer.stream_docs(
+                docs=docs,
+                parameters=parameters,
+                exec_endpoint="/delete",
+            ):
+                if len([doc for doc in docs if doc.tags.get("success", False)]) > 0:
+                    success = True
+        if success:
+            self.bump_index_generation()
+        return success
+
+    async def shutdown(self):
+        await super().shutdown()
+        await self.jobs.close()
+        await self.embedding_client.close()
+        if self.fallback_embedding_client is not None:
+            await self.fallback_embedding_client.close()
+        if self.processing_pool is not None:
+            # the gateway process joins its worker processes when it exits, they must have been told to stop by then
+            await asyncio.get_running_loop().run_in_executor(None, self.processing_pool.shutdown)
+        if self._processing_manager is not None:
+            self._processing_manager.shutdown()
+        if self.chunk_embedding_cache is not None:
+            self.chunk_embedding_cache.close()
+        if self._close_file_tracer is not None:
+            self._close_file_tracer()
 
     def modify_config_files(self):
         # replace placeholder URL in the configuration
@@ -166,6 +647,49 @@ class RetrievalGateway(FastAPIBaseGateway):
     def app(self):
         app = FastAPI()
         app.mount("/.well-known", StaticFiles(directory=".well-known"), name="static")
+        # added before the admission middleware, which wraps it, so that rejected bodies are not decompressed
+        app.add_middleware(
+            DecompressionMiddleware,
+            paths=["/upsert", "/upsert-file", "/upsert-stream", "/jobs/upsert"],
+            max_size=self.max_decompressed_body_size,
+        )
+        app.add_middleware(
+            AdmissionMiddleware,
+            limiters={
+                "/query": self.query_limiter,
+                "/sub/query": self.query_limiter,
+                "/upsert": self.ingest_limiter,
+                "/upsert-file": self.ingest_limiter,
+                "/upsert-stream": self.ingest_limiter,
+                "/delete": self.ingest_limiter,
+            },
+        )
+
+        # added last to wrap the other middlewares, so that the whole request is traced
+        app.add_middleware(
+            RequestSpanMiddleware,
+            tracer=self._file_tracer if getattr(self, "tracer", None) is None else None,
+        )
+
+        @app.on_event("startup")
+        async def prewarm():
+            if self.prewarm_tokenizer:
+                loop = asyncio.get_running_loop()
+                warming = [loop.run_in_executor(None, warm_tokenizer)]
+                if self.processing_pool is not None:
+                    # workers are started on demand, one task per worker starts and warms all of them
+                    for _ in range(self.processing_workers):
+                        warming.append(loop.run_in_executor(self.processing_pool, warm_tokenizer))
+
+                async def wait_for_tokenizer():
+                    try:
+                        await asyncio.gather(*warming)
+                    except Exception as e:
+                        # e.g. offline without a cached encoding, it is loaded again on first use
+                        print("Error: could not load the tokenizer ahead of its first use:", e)
+
+                # not awaited, queries are served while the tokenizer is loading
+                asyncio.ensure_future(wait_for_tokenizer())
 
         # construct URL
         try:
@@ -195,6 +719,60 @@ class RetrievalGateway(FastAPIBaseGateway):
         async def read_openapi_yaml():
             return FileResponse(".well-known/openapi.yaml")
 
+        @app.get("/stats", dependencies=[Depends(self.token_validation)])
+        async def stats():
+            return {
+                "embedding_cache": self.embedding_cache.info(),
+                "chunk_embedding_cache": self.chunk_embedding_cache.info() if self.chunk_embedding_cache else None,
+                "embedding_batcher": self.embedding_batcher.info(),
+                "embedding_requests": self.hedged_embedder.info(),
+                "embedding_rate_limits": self.embedding_scheduler.info(),
+                "query_cache": self.query_cache.info(),
+                "semantic_cache": self.semantic_cache.info() if self.semantic_cache else None,
+                "admission": {
+                    "query": self.query_limiter.info(),
+                    "ingest": self.ingest_limiter.info(),
+                },
+                "index_generation": self.index_generation,
+            }
+
+        @app.get("/debug/profile", dependencies=[Depends(self.token_validation)])
+        async def debug_profile(
+            seconds: float = 10,
+            kind: str = "cpu",
+            interval: float = 0.01,
+            target: str = "gateway",
+        ):
+            """
+            Profile the gateway or the indexer for some seconds while they serve requests,
+            and return the stacks in folded format, e.g. for flamegraph.pl or speedscope.
+            """
+            if target == "gateway":
+                try:
+                    folded = await asyncio.get_running_loop().run_in_executor(
+                        None, profile, seconds, kind, interval
+                    )
+                except ValueError as e:
+                    raise HTTPException(status_code=400, detail=str(e))
+                except ProfilerBusyError as e:
+                    raise HTTPException(status_code=409, detail=str(e))
+                return PlainTextResponse(folded)
+            if target != "executor":
+                raise HTTPException(status_code=400, detail=f"Unknown profile target {target}, use gateway or executor")
+
+            folded = ""
+            async for docs in self.streamer.stream_docs(
+                docs=DocumentArray([DADoc()]),
+                parameters={"seconds": seconds, "kind": kind, "interval": interval},
+                exec_endpoint="/debug/profile",
+            ):
+                for doc in docs:
+                    if "error" in doc.tags:
+                        status_code = 409 if doc.tags.get("busy") else 400
+                        raise HTTPException(status_code=status_code, detail=doc.tags["error"])
+                    folded += doc.tags.get("profile", "")
+            return PlainTextResponse(folded)
+
         @app.post(
             "/upsert-file",
             response_model=UpsertResponse,
@@ -203,13 +781,8 @@ class RetrievalGateway(FastAPIBaseGateway):
         async def upsert_file(
             file: UploadFile = File(...),
         ):
-            document = await get_document_from_file(file)
-
             try:
-                chunks = get_document_chunks(
-                    [document], chunk_token_size=None
-                )  # use default chunk size
-                return await self.perform_upsert_call(chunks)
+                return await self.upsert_file(file)
             except Exception as e:
                 print("Error:", e)
                 raise HTTPException(status_code=500, detail=f"str({e})")
@@ -223,35 +796,80 @@ class RetrievalGateway(FastAPIBaseGateway):
             request: UpsertRequest = Body(...),
         ):
             try:
-                chunks = get_document_chunks(
-                    request.documents, chunk_token_size=None
-                )  # uses default chunk size
-                return await self.perform_upsert_call(chunks)
+                return await self.upsert_documents(request.documents, request.embedding_model)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
             except Exception as e:
                 print("Error:", e)
                 raise HTTPException(status_code=500, detail="Internal Service Error")
 
+        @app.post(
+            "/upsert-stream",
+            response_class=NDJSONStreamingResponse,
+            dependencies=[Depends(self.token_validation)]
+        )
+        async def upsert_stream(request: Request, embedding_model: Optional[str] = None):
+            """
+            Accepts newline-delimited JSON documents and indexes them while the upload is still arriving.
+            Documents may carry precomputed embeddings, computed with the embedding_model given as query parameter.
+            Streams back one line per document with its id, or the error that prevented indexing it.
+            """
+            return NDJSONStreamingResponse(
+                self.stream_upsert_documents(request.stream(), embedding_model)
+            )
+
+        @app.post(
+            "/jobs/upsert",
+            response_model=UpsertJobResponse,
+            dependencies=[Depends(self.token_validation)]
+        )
+        async def submit_upsert_job(
+            request: UpsertRequest = Body(...),
+        ):
+            try:
+                validate_document_embeddings(
+                    request.documents, request.embedding_model, self.embedding_client.model
+                )
+                job = self.jobs.submit(request.documents, embedding_model=request.embedding_model)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            except JobQueueFullError as e:
+                raise HTTPException(status_code=429, detail=str(e))
+            return UpsertJobResponse(job_id=job.id)
+
+        @app.get(
+            "/jobs/{job_id}",
+            response_model=Job,
+            dependencies=[Depends(self.token_validation)]
+        )
+        async def get_job(job_id: str):
+            job = self.jobs.get(job_id)
+            if job is None:
+                raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+            return job
+
         @app.post(
             "/query",
             response_model=QueryResponse,
             dependencies=[Depends(self.token_validation)]
         )
         async def query_main(
+            http_request: Request,
             request: QueryRequest = Body(...),
         ):
             try:
-                queries = request.queries
-                query_texts = [query.query for query in queries]
-                query_embeddings = get_embeddings(query_texts)
-                query_da_docs = DocumentArray(
-                    [
-                        query_to_doc(query, embedding)
-                        for query, embedding in zip(queries, query_embeddings)
-                    ]
+                results = await self.query_documents(request.queries)
+                with start_span(self.get_tracer(), "pack_results"):
+                    results = pack_query_results(results, request.max_tokens)
+                with start_span(self.get_tracer(), "serialize_response"):
+                    return query_response(results, request.fields, http_request.headers.get("accept"))
+            except CircuitOpenError as e:
+                # fail fast while the embedding API is unhealthy
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e),
+                    headers={"Retry-After": str(int(self.hedged_embedder.circuit_breaker.reset_timeout))},
                 )
-                results = await self.perform_query_call(query_da_docs)
-                return QueryResponse(results=results)
-
             except Exception as e:
                 print("Error:", e)
                 raise HTTPException(status_code=500, detail="Internal Service Error")
@@ -260,24 +878,27 @@ class RetrievalGateway(FastAPIBaseGateway):
             "/query",
             response_model=QueryResponse,
             # NOTE: We are describing the shape of the API endpoint input due to a current limitation in parsing arrays of objects from OpenAPI schemas. This will not be necessary in the future.
-            description="Accepts search query objects array each with query and optional filter. Break down complex questions into sub-questions. Refine results by criteria, e.g. time / source, don't do this often. Split queries if ResponseTooLargeError occurs.",
+            description="Accepts search query objects array each with query and optional filter. Break down complex questions into sub-questions. Refine results by criteria, e.g. time / source, don't do this often.",
             dependencies=[Depends(self.token_validation)],
         )
         async def query(
+            http_request: Request,
             request: QueryRequest = Body(...),
         ):
             try:
-                queries = request.queries
-                query_texts = [query.query for query in queries]
-                query_embeddings = get_embeddings(query_texts)
-                query_da_docs = DocumentArray(
-                    [
-                        query_to_doc(query, embedding)
-                        for query, embedding in zip(queries, query_embeddings)
-                    ]
+                results = await self.query_documents(request.queries)
+                # the best chunks of all queries that fit the budget, so that the response is never too large
+                with start_span(self.get_tracer(), "pack_results"):
+                    results = pack_query_results(results, request.max_tokens or self.query_token_budget)
+                with start_span(self.get_tracer(), "serialize_response"):
+                    return query_response(results, request.fields, http_request.headers.get("accept"))
+            except CircuitOpenError as e:
+                # fail fast while the embedding API is unhealthy
+                raise HTTPException(
+                    status_code=503,
+                    detail=str(e),
+                    headers={"Retry-After": str(int(self.hedged_embedder.circuit_breaker.reset_timeout))},
                 )
-                results = await self.perform_query_call(query_da_docs)
-                return QueryResponse(results=results)
             except Exception as e:
                 print("Error:", e)
                 raise HTTPException(status_code=500, detail="Internal Service Error")
@@ -296,7 +917,7 @@ class RetrievalGateway(FastAPIBaseGateway):
                     detail="One of ids, filter, or delete_all is required",
                 )
             try:
-                success = self.perform_delete_call(
+                success = await self.perform_delete_call(
                     request.ids, request.delete_all, request.filter
                 )
                 return DeleteResponse(success=success)
@@ -5,19 +5,35 @@ from goldretriever.models.models import (
     QueryResult,
 )
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import List, Literal, Optional
 
 
 class UpsertRequest(BaseModel):
     documents: List[Document]
+    # the model the precomputed document embeddings were computed with, required if there are any
+    embedding_model: Optional[str] = None
 
 
 class UpsertResponse(BaseModel):
     ids: List[str]
 
 
+class UpsertStreamResult(BaseModel):
+    line: int
+    id: Optional[str] = None
+    error: Optional[str] = None
+
+
+class UpsertJobResponse(BaseModel):
+    job_id: str
+
+
 class QueryRequest(BaseModel):
     queries: List[Query]
+    # the fields of each result chunk to return, all fields if not set
+    fields: Optional[List[Literal["id", "text", "metadata", "embedding", "score"]]] = None
+    # the maximum total number of tokens of the returned chunk texts, across all queries
+    max_tokens: Optional[int] = None
 
 
 class QueryResponse(BaseModel):
@@ -1,7 +1,9 @@
-from pydantic import BaseModel
-from typing import List, Optional
+from pydantic import BaseModel, PrivateAttr
+from typing import Any, Dict, List, Optional
 from enum import Enum
 
+import numpy as np
+
 
 class Source(str, Enum):
     email = "email"
@@ -28,14 +30,71 @@ class DocumentChunk(BaseModel):
     embedding: Optional[List[float]] = None
 
 
+class DocumentChunkBatch:
+    """
+    Columnar batch of document chunks, with parallel lists of chunk ids, texts and metadata,
+    and a float32 matrix holding one embedding per row, or None if the chunks are not embedded yet.
+    num_tokens optionally holds the number of tokens of each chunk text.
+    """
+
+    def __init__(
+        self,
+        ids: List[str],
+        texts: List[str],
+        metadata: List[Dict[str, Any]],
+        embeddings: Optional[np.ndarray] = None,
+        num_tokens: Optional[List[int]] = None,
+    ):
+        self.ids = ids
+        self.texts = texts
+        self.metadata = metadata
+        self.embeddings = embeddings
+        self.num_tokens = num_tokens
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __getitem__(self, item: slice) -> "DocumentChunkBatch":
+        return DocumentChunkBatch(
+            self.ids[item],
+            self.texts[item],
+            self.metadata[item],
+            self.embeddings[item] if self.embeddings is not None else None,
+            self.num_tokens[item] if self.num_tokens is not None else None,
+        )
+
+    @classmethod
+    def from_chunks(cls, chunks: List[DocumentChunk]) -> "DocumentChunkBatch":
+        # the chunks of a document share their metadata object, convert it only once
+        metadata_dicts: Dict[int, Dict[str, Any]] = {}
+        for chunk in chunks:
+            if id(chunk.metadata) not in metadata_dicts:
+                metadata_dicts[id(chunk.metadata)] = chunk.metadata.dict()
+        embeddings = (
+            np.asarray([chunk.embedding for chunk in chunks], dtype=np.float32)
+            if chunks and all(chunk.embedding is not None for chunk in chunks)
+            else None
+        )
+        return cls(
+            ids=[chunk.id for chunk in chunks],
+            texts=[chunk.text for chunk in chunks],
+            metadata=[metadata_dicts[id(chunk.metadata)] for chunk in chunks],
+            embeddings=embeddings,
+        )
+
+
 class DocumentChunkWithScore(DocumentChunk):
     score: float
+    # the number of tokens of the text if it was counted at ingest, not part of the response
+    _num_tokens: Optional[int] = PrivateAttr(default=None)
 
 
 class Document(BaseModel):
     id: Optional[str] = None
     text: str
     metadata: Optional[DocumentMetadata] = None
+    # a precomputed embedding of the whole text, which is then indexed as a single chunk without embedding it again
+    embedding: Optional[List[float]] = None
 
 
 class DocumentWithChunks(Document):
@@ -64,3 +123,23 @@ class QueryWithEmbedding(Query):
 class QueryResult(BaseModel):
     query: str
     results: List[DocumentChunkWithScore]
+
+
+class JobStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    succeeded = "succeeded"
+    failed = "failed"
+
+
+class Job(BaseModel):
+    id: str
+    status: JobStatus = JobStatus.queued
+    num_documents: int
+    num_processed: int = 0
+    num_failed: int = 0
+    errors: List[str] = []
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    documents_per_second: Optional[float] = None
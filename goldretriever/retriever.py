@@ -1,5 +1,7 @@
 import asyncio
 import glob
+import gzip
+import json
 import mimetypes
 import os
 import random
@@ -17,6 +19,11 @@ from hubble.api import login as login_jina
 from jcloud.api import deploy as deploy_flow
 from jcloud.flow import CloudFlow
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
 app = typer.Typer()
 
 current_file_path = Path(__file__).resolve()
@@ -36,6 +43,30 @@ class DataSourceNotFoundError(Exception):
     pass
 
 
+def compress_body(body: bytes, compression: Optional[str]) -> bytes:
+    if compression == "gzip":
+        return gzip.compress(body, compresslevel=6)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(body)
+    if compression in (None, "none"):
+        return body
+    raise ValueError(f"Unsupported compression {compression}, use gzip, zstd or none")
+
+
+def send_compressed(request: requests.Request, compression: Optional[str]) -> requests.Response:
+    # the body is encoded by requests first, so that multipart uploads are compressed as a whole
+    prepared = request.prepare()
+    if compression not in (None, "none") and prepared.body:
+        body = prepared.body if isinstance(prepared.body, bytes) else prepared.body.encode("utf-8")
+        prepared.body = compress_body(body, compression)
+        prepared.headers["Content-Encoding"] = compression
+        prepared.headers["Content-Length"] = str(len(prepared.body))
+    with requests.Session() as session:
+        return session.send(prepared)
+
+
 def random_string(size=16):
     return "".join(
         random.SystemRandom().choice(string.ascii_uppercase + string.digits)
@@ -117,7 +148,7 @@ def check_openai_key(openai_key: Optional[str] = None):
     return openai_key
 
 
-def upsert_documents(docs, bearer_token, flow_id, n_docs=5):
+def upsert_documents(docs, bearer_token, flow_id, n_docs=5, embedding_model=None, compression="gzip"):
     print(f"Indexing documents for {flow_id}")
     endpoint_url = f"https://{flow_id}.wolf.jina.ai/upsert"
     headers = {
@@ -128,27 +159,33 @@ def upsert_documents(docs, bearer_token, flow_id, n_docs=5):
     for batch in range(0, len(docs), n_docs):
         data = {"documents": []}
         for ind, doc in enumerate(docs[batch : batch + n_docs]):
-            data["documents"].append(
-                {
-                    "id": str(batch + ind),
-                    "text": doc.text,
-                    "metadata": {
-                        "source": doc.tags.get("source", "email"),
-                        "source_id": doc.tags.get("source_id", "string"),
-                        "url": doc.tags.get("url", "string"),
-                        "created_at": doc.tags.get("created_at", "string"),
-                        "author": doc.tags.get("author", "string"),
-                    },
-                }
-            )
-        response = requests.post(endpoint_url, headers=headers, json=data)
+            document = {
+                "id": str(batch + ind),
+                "text": doc.text,
+                "metadata": {
+                    "source": doc.tags.get("source", "email"),
+                    "source_id": doc.tags.get("source_id", "string"),
+                    "url": doc.tags.get("url", "string"),
+                    "created_at": doc.tags.get("created_at", "string"),
+                    "author": doc.tags.get("author", "string"),
+                },
+            }
+            # send the embeddings stored in the docarray file, so that the documents are not embedded again
+            if embedding_model is not None and doc.embedding is not None:
+                document["embedding"] = doc.embedding.tolist()
+            data["documents"].append(document)
+        if embedding_model is not None:
+            data["embedding_model"] = embedding_model
+        response = send_compressed(
+            requests.Request("POST", endpoint_url, headers=headers, data=json.dumps(data)), compression
+        )
         if response.status_code != 200:
             print("Could not index the documents")
             print(response.text)
     print(f"{len(docs)} documents have been successfully indexed!")
 
 
-def upsert_files(files, bearer_token, flow_id):
+def upsert_files(files, bearer_token, flow_id, compression="gzip"):
     print(f"Indexing files for {flow_id}")
     endpoint_url = f"https://{flow_id}.wolf.jina.ai/upsert-file"
     headers = {
@@ -156,7 +193,9 @@ def upsert_files(files, bearer_token, flow_id):
     }
     for file in files:
         file_bytes = {"file": (file, open(file, "rb"), mimetypes.guess_type(file)[0])}
-        response = requests.post(endpoint_url, headers=headers, files=file_bytes)
+        response = send_compressed(
+            requests.Request("POST", endpoint_url, headers=headers, files=file_bytes), compression
+        )
         if response.status_code != 200:
             print("Could not index the file")
             print(response.text)
@@ -168,6 +207,10 @@ def index(
     data: str = typer.Option,
     bearer_token: Optional[str] = typer.Option(None),
     id: Optional[str] = typer.Option(None),
+    embedding_model: Optional[str] = typer.Option(
+        None, help="The model the embeddings of docarray files were computed with, to index them without embedding the documents again"
+    ),
+    compression: str = typer.Option("gzip", help="The compression of the uploaded data: gzip, zstd or none"),
 ):
     read_envs()
     bearer_token = check_bearer_token(bearer_token)
@@ -210,10 +253,10 @@ def index(
             raise DataSourceNotFoundError(f"Could not find {data}")
 
     if docs:
-        upsert_documents(docs, bearer_token, flow_id)
+        upsert_documents(docs, bearer_token, flow_id, embedding_model=embedding_model, compression=compression)
 
     if files:
-        upsert_files(files, bearer_token, flow_id)
+        upsert_files(files, bearer_token, flow_id, compression=compression)
 
 
 def create_eventloop():
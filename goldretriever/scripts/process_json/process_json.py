@@ -2,10 +2,12 @@ import uuid
 import json
 import argparse
 import asyncio
+from typing import Optional
 
 from goldretriever.models.models import Document, DocumentMetadata
 from goldretriever.datastore.datastore import DataStore
 from goldretriever.datastore.factory import get_datastore
+from goldretriever.services.cache import PersistentEmbeddingCache, get_persistent_embedding_cache
 from goldretriever.services.extract_metadata import extract_metadata_from_document
 from goldretriever.services.pii_detection import screen_text_for_pii
 
@@ -18,6 +20,7 @@ async def process_json_dump(
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    embedding_cache: Optional[PersistentEmbeddingCache] = None,
 ):
     # load the json file as a list of dictionaries
     with open(filepath) as json_file:
@@ -97,7 +100,7 @@ async def process_json_dump(
         batch_documents = documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]
         print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
         print("documents: ", documents)
-        await datastore.upsert(batch_documents)
+        await datastore.upsert(batch_documents, embedding_cache=embedding_cache)
 
     # print the skipped items
     print(f"Skipped {len(skipped_items)} items due to errors or PII detection")
@@ -126,6 +129,12 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--embedding_cache",
+        default=None,
+        help="The path of a persistent embedding cache, which lets re-runs reuse the embeddings of unchanged text. "
+        "Defaults to the EMBEDDING_CACHE_PATH environment variable, if set",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -138,7 +147,12 @@ async def main():
     datastore = await get_datastore()
     # process the json dump
     await process_json_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        get_persistent_embedding_cache(args.embedding_cache),
     )
 
 
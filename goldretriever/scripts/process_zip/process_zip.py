@@ -4,10 +4,12 @@ import os
 import json
 import argparse
 import asyncio
+from typing import Optional
 
 from goldretriever.models.models import Document, DocumentMetadata, Source
 from goldretriever.datastore.datastore import DataStore
 from goldretriever.datastore.factory import get_datastore
+from goldretriever.services.cache import PersistentEmbeddingCache, get_persistent_embedding_cache
 from goldretriever.services.extract_metadata import extract_metadata_from_document
 from goldretriever.services.file import extract_text_from_filepath
 from goldretriever.services.pii_detection import screen_text_for_pii
@@ -21,6 +23,7 @@ async def process_file_dump(
     custom_metadata: dict,
     screen_for_pii: bool,
     extract_metadata: bool,
+    embedding_cache: Optional[PersistentEmbeddingCache] = None,
 ):
     # create a ZipFile object and extract all the files into a directory named 'dump'
     with zipfile.ZipFile(filepath) as zip_file:
@@ -90,7 +93,7 @@ async def process_file_dump(
         batch_documents = [doc for doc in documents[i : i + DOCUMENT_UPSERT_BATCH_SIZE]]
         print(f"Upserting batch of {len(batch_documents)} documents, batch {i}")
         print("documents: ", documents)
-        await datastore.upsert(batch_documents)
+        await datastore.upsert(batch_documents, embedding_cache=embedding_cache)
 
     # delete all files in the dump directory
     for root, dirs, files in os.walk("dump", topdown=False):
@@ -131,6 +134,12 @@ async def main():
         type=bool,
         help="A boolean flag to indicate whether to try to extract metadata from the document (using a language model)",
     )
+    parser.add_argument(
+        "--embedding_cache",
+        default=None,
+        help="The path of a persistent embedding cache, which lets re-runs reuse the embeddings of unchanged text. "
+        "Defaults to the EMBEDDING_CACHE_PATH environment variable, if set",
+    )
     args = parser.parse_args()
 
     # get the arguments
@@ -143,7 +152,12 @@ async def main():
     datastore = await get_datastore()
     # process the file dump
     await process_file_dump(
-        filepath, datastore, custom_metadata, screen_for_pii, extract_metadata
+        filepath,
+        datastore,
+        custom_metadata,
+        screen_for_pii,
+        extract_metadata,
+        get_persistent_embedding_cache(args.embedding_cache),
     )
 
 
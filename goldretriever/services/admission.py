@@ -0,0 +1,142 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Deque, Dict, Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+
+class AdmissionRejectedError(Exception):
+    pass
+
+
+class AdmissionLimiter:
+    """
+    Limits the number of requests of one kind that are processed concurrently, and of those waiting for their turn.
+
+    A request that arrives while max_queued requests are already waiting, or that waits longer than queue_timeout,
+    is rejected with AdmissionRejectedError instead of adding to the backlog.
+
+    Args:
+        name: The name of the kind of requests, used in error messages.
+        max_concurrency: The maximum number of requests processed at a time.
+        max_queued: The maximum number of requests waiting to be processed.
+        queue_timeout: The maximum number of seconds a request waits to be processed, or None to wait indefinitely.
+        retry_after: The number of seconds a rejected client is asked to wait before retrying.
+        num_recent_waits: The number of most recent queue wait times the wait percentiles are computed from.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrency: int,
+        max_queued: int,
+        queue_timeout: Optional[float] = None,
+        retry_after: int = 1,
+        num_recent_waits: int = 1000,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.queue_timeout = queue_timeout
+        self.retry_after = retry_after
+        self.num_active = 0
+        self.num_queued = 0
+        self.num_admitted = 0
+        self.num_rejected = 0
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._recent_waits: Deque[float] = deque(maxlen=num_recent_waits)
+
+    async def acquire(self):
+        """Wait until the request may be processed, raising AdmissionRejectedError if the queue is full or the wait too long."""
+        if self._semaphore is None:
+            # created here rather than in __init__ to bind it to the running event loop
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if self._semaphore.locked() and self.num_queued >= self.max_queued:
+            self.num_rejected += 1
+            raise AdmissionRejectedError(f"Too many {self.name} requests, {self.num_queued} are queued")
+
+        self.num_queued += 1
+        start = time.monotonic()
+        # acquired in a task instead of with asyncio.wait_for, which before Python 3.12 admits a cancelled request
+        # or loses the slot when the cancellation or the timeout races a successful acquire
+        acquire = asyncio.ensure_future(self._semaphore.acquire())
+        admitted = False
+        try:
+            await asyncio.wait([acquire], timeout=self.queue_timeout)
+            admitted = acquire.done()
+        finally:
+            self.num_queued -= 1
+            self._recent_waits.append(time.monotonic() - start)
+            if not admitted:
+                # if the acquire wins the race anyway, its slot is given back
+                acquire.cancel()
+                acquire.add_done_callback(self._release_acquired)
+        if not admitted:
+            self.num_rejected += 1
+            raise AdmissionRejectedError(
+                f"A {self.name} request waited more than {self.queue_timeout} seconds to be processed"
+            )
+        self.num_active += 1
+        self.num_admitted += 1
+
+    def _release_acquired(self, acquire: asyncio.Future):
+        if not acquire.cancelled():
+            self._semaphore.release()
+
+    def release(self):
+        """Mark an admitted request as processed."""
+        self.num_active -= 1
+        self._semaphore.release()
+
+    def info(self) -> Dict[str, Any]:
+        """Return the number of active, queued, admitted and rejected requests, and the recent queue wait times in seconds."""
+        waits = sorted(self._recent_waits)
+        return {
+            "active": self.num_active,
+            "queued": self.num_queued,
+            "admitted": self.num_admitted,
+            "rejected": self.num_rejected,
+            "queue_wait_mean": sum(waits) / len(waits) if waits else 0.0,
+            "queue_wait_p95": waits[int(0.95 * (len(waits) - 1))] if waits else 0.0,
+            "queue_wait_max": waits[-1] if waits else 0.0,
+        }
+
+
+class AdmissionMiddleware:
+    """
+    ASGI middleware that admits the requests to some paths through an AdmissionLimiter per path.
+
+    Rejected requests get a 429 response with a Retry-After header before their body is read.
+    An admitted request holds its slot until its response is sent completely, including streamed responses.
+
+    Args:
+        app: The ASGI app to wrap.
+        limiters: The limiter of each path, requests to other paths are passed through.
+    """
+
+    def __init__(self, app: ASGIApp, limiters: Dict[str, AdmissionLimiter]):
+        self.app = app
+        self.limiters = limiters
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        limiter = self.limiters.get(scope["path"]) if scope["type"] == "http" else None
+        if limiter is None:
+            await self.app(scope, receive, send)
+            return
+
+        try:
+            await limiter.acquire()
+        except AdmissionRejectedError as e:
+            response = JSONResponse(
+                {"detail": str(e)},
+                status_code=429,
+                headers={"Retry-After": str(limiter.retry_after)},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limiter.release()
@@ -0,0 +1,104 @@
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+
+class EmbeddingBatcher:
+    """
+    Coalesces the texts of concurrent embedding requests into batched embedding calls.
+
+    Texts are queued for up to max_wait seconds, or until max_batch_size texts are queued, and are then embedded with a single call.
+    Identical texts that are queued or in flight at the same time are embedded only once.
+
+    Args:
+        get_embeddings: The coroutine function used to embed a batch of texts.
+        max_wait: The number of seconds to wait for more texts before a batch is sent.
+        max_batch_size: The maximum number of texts in a batch.
+    """
+
+    def __init__(
+        self,
+        get_embeddings: Callable[[List[str]], Awaitable[List[List[float]]]],
+        max_wait: float = 0.005,
+        max_batch_size: int = 128,
+    ):
+        self._get_embeddings = get_embeddings
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self._queued: Dict[str, asyncio.Future] = {}
+        self._in_flight: Dict[str, asyncio.Future] = {}
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self.num_batches = 0
+        self.num_texts = 0
+        self.num_deduplicated = 0
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts as part of the next batch.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            A list of embeddings, each of which is a list of floats.
+        """
+        futures = [self._enqueue(text) for text in texts]
+        # the futures are shared with other requests, shield them from the cancellation of this one
+        return list(await asyncio.gather(*[asyncio.shield(future) for future in futures]))
+
+    def _enqueue(self, text: str) -> asyncio.Future:
+        future = self._queued.get(text) or self._in_flight.get(text)
+        if future is not None:
+            self.num_deduplicated += 1
+            return future
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._queued[text] = future
+        if len(self._queued) >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._queued = self._queued, {}
+        if batch:
+            self._in_flight.update(batch)
+            asyncio.ensure_future(self._send(batch))
+
+    async def _send(self, batch: Dict[str, asyncio.Future]):
+        texts = list(batch)
+        self.num_batches += 1
+        self.num_texts += len(texts)
+        try:
+            embeddings = await self._get_embeddings(texts)
+        except Exception as e:
+            for future in batch.values():
+                if not future.done():
+                    future.set_exception(e)
+        except BaseException:
+            # the batch was cancelled, e.g. on shutdown, the requests waiting for it must not hang
+            for future in batch.values():
+                if not future.done():
+                    future.cancel()
+            raise
+        else:
+            for future, embedding in zip(batch.values(), embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+        finally:
+            for text, future in batch.items():
+                if self._in_flight.get(text) is future:
+                    del self._in_flight[text]
+
+    def info(self) -> Dict[str, Any]:
+        """Return the number of batches sent and of texts embedded and deduplicated."""
+        return {
+            "batches": self.num_batches,
+            "texts": self.num_texts,
+            "deduplicated": self.num_deduplicated,
+            "mean_batch_size": self.num_texts / self.num_batches if self.num_batches else 0.0,
+        }
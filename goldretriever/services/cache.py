@@ -0,0 +1,443 @@
+import functools
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from goldretriever.models.models import Query, QueryResult
+
+EMBEDDING_CACHE_PATH_ENV = "EMBEDDING_CACHE_PATH"  # The environment variable holding the path of the persistent embedding cache
+EMBEDDING_CACHE_MAX_BYTES = 1024 * 1024 * 1024  # The default maximum size of the persistent embedding cache
+EMBEDDING_CACHE_ACCESS_RESOLUTION = 60  # The number of seconds within which repeated hits don't refresh accessed_at
+EMBEDDING_CACHE_MAX_PENDING_ACCESSES = 10000  # The number of refreshes of accessed_at written at once without a put
+
+
+def normalize_query_text(text: str) -> str:
+    """
+    Normalize a query text so that texts differing only in whitespace share a cache entry.
+    Case is kept, because embeddings and search results depend on it.
+
+    Args:
+        text: The query text to normalize.
+
+    Returns:
+        The text with leading and trailing whitespace removed and inner whitespace collapsed.
+    """
+    return " ".join(text.split())
+
+
+def _filter_key(query: Query) -> Hashable:
+    if query.filter is None:
+        return ()
+    return tuple(sorted(query.filter.dict(exclude_none=True).items()))
+
+
+class LRUCache:
+    """
+    In-process least-recently-used cache whose entries also expire after a fixed time to live.
+
+    Args:
+        maxsize: The maximum number of entries to keep, the least recently used entry is evicted first.
+        ttl: The number of seconds after which an entry expires, or None to keep entries until they are evicted.
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the value stored under key, or None if it is missing or expired."""
+        entry = self._data.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at >= time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+            del self._data[key]
+        self.misses += 1
+        return None
+
+    def put(self, key: Hashable, value: Any):
+        """Store value under key, evicting the least recently used entries if the cache is full."""
+        if self.maxsize <= 0:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl is not None else float("inf")
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def clear(self):
+        self._data.clear()
+
+    def info(self) -> Dict[str, Any]:
+        """Return the hit and miss counters and the current size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+
+class EmbeddingCache(LRUCache):
+    """
+    LRU cache of query embeddings keyed by embedding model and normalized query text.
+    """
+
+    def get_many(
+        self, texts: List[str], model: str
+    ) -> Tuple[List[Optional[List[float]]], List[int]]:
+        """
+        Look up the embeddings of several texts at once.
+
+        Args:
+            texts: The texts to look up.
+            model: The name of the embedding model the embeddings were computed with.
+
+        Returns:
+            A tuple of (embeddings, missing), where embeddings holds the cached embedding of each text or None,
+            and missing lists the positions of the texts that were not found in the cache.
+        """
+        embeddings = [self.get((model, normalize_query_text(text))) for text in texts]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return embeddings, missing
+
+    def put_many(self, texts: List[str], embeddings: List[List[float]], model: str):
+        """Store the embeddings of several texts computed with the given model."""
+        for text, embedding in zip(texts, embeddings):
+            self.put((model, normalize_query_text(text)), embedding)
+
+
+class QueryResultCache(LRUCache):
+    """
+    LRU cache of query results keyed by normalized query text, filter and top_k.
+    Each entry is tagged with the index generation it was computed at and is only served while the generation is unchanged.
+    """
+
+    @staticmethod
+    def _key(query: Query) -> Hashable:
+        return normalize_query_text(query.query), _filter_key(query), query.top_k
+
+    def get_result(self, query: Query, generation: int) -> Optional[QueryResult]:
+        """Return the cached result of query if it was computed at the given index generation."""
+        entry = self.get(self._key(query))
+        if entry is None:
+            return None
+        entry_generation, result = entry
+        if entry_generation != generation:
+            # the index changed since the result was computed, undo the hit
+            self.hits -= 1
+            self.misses += 1
+            return None
+        return result.copy(update={"query": query.query})
+
+    def put_result(self, query: Query, result: QueryResult, generation: int):
+        """Store the result of query, computed at the given index generation."""
+        self.put(self._key(query), (generation, result))
+
+
+class SemanticQueryCache:
+    """
+    Cache of query results keyed by query embedding, serving paraphrased repeats of recent queries.
+
+    A result is served for a query whose embedding has at least the given cosine similarity with that of a cached query,
+    if both share the same filter and top_k and the index generation is unchanged.
+    The most recent maxsize queries are kept, older ones are overwritten first.
+
+    Args:
+        threshold: The minimum cosine similarity between two queries to serve the cached result.
+        maxsize: The maximum number of cached queries.
+    """
+
+    def __init__(self, threshold: float = 0.97, maxsize: int = 1024):
+        self.threshold = threshold
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._embeddings: Optional[np.ndarray] = None
+        self._entries: List[Tuple[Hashable, int, QueryResult]] = []
+        self._next = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get_result(
+        self, query: Query, embedding: List[float], generation: int
+    ) -> Optional[QueryResult]:
+        """Return the cached result of the most similar query above the threshold, computed at the given index generation."""
+        if self._entries:
+            key = (_filter_key(query), query.top_k)
+            similarities = self._embeddings[: len(self._entries)] @ self._normalize(embedding)
+            for i in np.argsort(-similarities):
+                if similarities[i] < self.threshold:
+                    break
+                entry_key, entry_generation, result = self._entries[i]
+                if entry_key == key and entry_generation == generation:
+                    self.hits += 1
+                    return result.copy(update={"query": query.query})
+        self.misses += 1
+        return None
+
+    def put_result(
+        self, query: Query, embedding: List[float], result: QueryResult, generation: int
+    ):
+        """Store the result of query with its embedding, computed at the given index generation."""
+        if self.maxsize <= 0:
+            return
+        normalized = self._normalize(embedding)
+        if self._embeddings is None:
+            self._embeddings = np.zeros((self.maxsize, len(normalized)), dtype=np.float32)
+        entry = ((_filter_key(query), query.top_k), generation, result)
+        if len(self._entries) < self.maxsize:
+            self._entries.append(entry)
+        else:
+            self._entries[self._next] = entry
+        self._embeddings[self._next] = normalized
+        self._next = (self._next + 1) % self.maxsize
+
+    def clear(self):
+        self._embeddings = None
+        self._entries = []
+        self._next = 0
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> np.ndarray:
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def info(self) -> Dict[str, Any]:
+        """Return the hit and miss counters and the current size of the cache."""
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "threshold": self.threshold,
+        }
+
+
+class PersistentEmbeddingCache:
+    """
+    On-disk cache of chunk embeddings in a SQLite file, keyed by a hash of the embedding model and the chunk text.
+
+    Re-indexing unchanged text reuses its embeddings instead of requesting them again, also across restarts,
+    and the file can be shared by the gateway and the ingestion scripts.
+    When the embeddings take more than max_bytes, the least recently used ones are evicted. The total size is kept
+    in the file, so that it includes the embeddings added by all processes sharing it.
+    Lookups don't write: the access times of hits are refreshed in the transaction of the next put_many,
+    and only if they are older than access_resolution seconds.
+
+    Args:
+        path: The path of the SQLite file, which is created if it does not exist.
+        max_bytes: The maximum total size of the cached embeddings in bytes.
+        access_resolution: The number of seconds within which repeated hits of an embedding are not recorded.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_bytes: int = EMBEDDING_CACHE_MAX_BYTES,
+        access_resolution: float = EMBEDDING_CACHE_ACCESS_RESOLUTION,
+    ):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.access_resolution = access_resolution
+        # the access times of hits that are not written yet, by key
+        self._pending_accesses: Dict[bytes, float] = {}
+        self.hits = 0
+        self.misses = 0
+        # the cache is used from the event loop and from the threads embedding batches concurrently
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings "
+            "(key BLOB PRIMARY KEY, embedding BLOB NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings_size "
+            "(id INTEGER PRIMARY KEY CHECK (id = 0), num_bytes INTEGER NOT NULL, num_entries INTEGER NOT NULL)"
+        )
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            # the row holding the size is created by the first process that opens the file
+            if self._connection.execute("SELECT COUNT(*) FROM embeddings_size").fetchone()[0] == 0:
+                self._connection.execute(
+                    "INSERT INTO embeddings_size (id, num_bytes, num_entries) "
+                    "SELECT 0, COALESCE(SUM(LENGTH(embedding)), 0), COUNT(*) FROM embeddings"
+                )
+            self._connection.execute("COMMIT")
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    @staticmethod
+    def _key(text: str, model: str) -> bytes:
+        return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).digest()
+
+    def get_many(self, texts: Sequence[str], model: str) -> Tuple[List[Optional[np.ndarray]], List[int]]:
+        """
+        Look up the embeddings of several texts at once.
+
+        Args:
+            texts: The texts to look up.
+            model: The name of the embedding model the embeddings were computed with.
+
+        Returns:
+            A tuple of (embeddings, missing), where embeddings holds the cached float32 embedding of each text or None,
+            and missing lists the positions of the texts that were not found in the cache.
+        """
+        keys = [self._key(text, model) for text in texts]
+        now = time.time()
+        with self._lock:
+            rows = {}
+            # SQLite limits the number of parameters of a statement
+            for i in range(0, len(keys), 500):
+                batch = keys[i : i + 500]
+                placeholders = ",".join("?" * len(batch))
+                for key, embedding, accessed_at in self._connection.execute(
+                    f"SELECT key, embedding, accessed_at FROM embeddings WHERE key IN ({placeholders})", batch
+                ):
+                    rows[key] = embedding
+                    if now - accessed_at >= self.access_resolution:
+                        self._pending_accesses[key] = now
+            if len(self._pending_accesses) >= EMBEDDING_CACHE_MAX_PENDING_ACCESSES:
+                self._commit_pending_accesses()
+            num_hits = sum(key in rows for key in keys)
+            self.hits += num_hits
+            self.misses += len(keys) - num_hits
+        embeddings = [
+            np.frombuffer(rows[key], dtype=np.float32) if key in rows else None for key in keys
+        ]
+        missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+        return embeddings, missing
+
+    def put_many(self, texts: Sequence[str], embeddings: Sequence[Any], model: str):
+        """Store the embeddings of several texts computed with the given model, evicting the least recently used if full."""
+        now = time.time()
+        rows = [
+            (self._key(text, model), np.asarray(embedding, dtype=np.float32).tobytes(), now)
+            for text, embedding in zip(texts, embeddings)
+        ]
+        with self._lock:
+            # takes the write lock right away, the size is read and updated in the same transaction
+            self._connection.execute("BEGIN IMMEDIATE")
+            try:
+                # before eviction, which must see the embeddings that were looked up recently
+                self._write_pending_accesses()
+                num_bytes = num_entries = 0
+                for key, embedding, accessed_at in rows:
+                    replaced = self._connection.execute(
+                        "SELECT LENGTH(embedding) FROM embeddings WHERE key = ?", (key,)
+                    ).fetchone()
+                    self._connection.execute(
+                        "INSERT OR REPLACE INTO embeddings (key, embedding, accessed_at) VALUES (?, ?, ?)",
+                        (key, embedding, accessed_at),
+                    )
+                    if replaced is None:
+                        num_entries += 1
+                    num_bytes += len(embedding) - (replaced[0] if replaced is not None else 0)
+                self._connection.execute(
+                    "UPDATE embeddings_size SET num_bytes = num_bytes + ?, num_entries = num_entries + ?",
+                    (num_bytes, num_entries),
+                )
+                num_bytes, num_entries = self._get_size()
+                if num_bytes > self.max_bytes:
+                    self._evict(num_bytes, num_entries)
+                self._connection.execute("COMMIT")
+                self._pending_accesses.clear()
+            except BaseException:
+                self._connection.execute("ROLLBACK")
+                raise
+
+    def _commit_pending_accesses(self):
+        self._connection.execute("BEGIN")
+        try:
+            self._write_pending_accesses()
+            self._connection.execute("COMMIT")
+            self._pending_accesses.clear()
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+
+    def _write_pending_accesses(self):
+        if self._pending_accesses:
+            self._connection.executemany(
+                "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                [(accessed_at, key) for key, accessed_at in self._pending_accesses.items()],
+            )
+
+    def _get_size(self) -> Tuple[int, int]:
+        return self._connection.execute("SELECT num_bytes, num_entries FROM embeddings_size").fetchone()
+
+    def _evict(self, num_bytes: int, num_entries: int):
+        # evict down to 90% of the maximum size at once, so that eviction doesn't run on every insert
+        bytes_per_entry = num_bytes / num_entries
+        num_evicted = int((num_bytes - 0.9 * self.max_bytes) / bytes_per_entry) + 1
+        self._connection.execute(
+            "DELETE FROM embeddings WHERE key IN "
+            "(SELECT key FROM embeddings ORDER BY accessed_at LIMIT ?)",
+            (num_evicted,),
+        )
+        # counted again rather than from the deleted rows, which keeps the size exact
+        self._connection.execute(
+            "UPDATE embeddings_size SET (num_bytes, num_entries) = "
+            "(SELECT COALESCE(SUM(LENGTH(embedding)), 0), COUNT(*) FROM embeddings)"
+        )
+
+    def close(self):
+        with self._lock:
+            self._commit_pending_accesses()
+            self._connection.close()
+
+    def info(self) -> Dict[str, Any]:
+        """Return the hit and miss counters, and the number and total size of the cached embeddings."""
+        with self._lock:
+            hits, misses = self.hits, self.misses
+            num_bytes, num_entries = self._get_size()
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "size": num_entries,
+            "bytes": num_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+def get_persistent_embedding_cache(path: Optional[str] = None) -> Optional[PersistentEmbeddingCache]:
+    """
+    Return the persistent embedding cache at path, or at the path set in the EMBEDDING_CACHE_PATH environment variable.
+    Returns None if neither is set, so that the cache is opt-in. Each file is opened once per process.
+    """
+    path = path or os.environ.get(EMBEDDING_CACHE_PATH_ENV)
+    if not path:
+        return None
+    return _open_persistent_embedding_cache(os.path.abspath(path))
+
+
+@functools.lru_cache(maxsize=None)
+def _open_persistent_embedding_cache(path: str) -> PersistentEmbeddingCache:
+    return PersistentEmbeddingCache(path)
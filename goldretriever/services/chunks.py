@@ -1,64 +1,95 @@
-from typing import Dict, List, Optional, Tuple
+import asyncio
+import functools
+import os
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from queue import Full
+from typing import TYPE_CHECKING, Any, AsyncIterable, AsyncIterator, Deque, Dict, Generator, Iterable, Iterator, List, Optional, Tuple
 import uuid
-from goldretriever.models.models import Document, DocumentChunk, DocumentChunkMetadata
-
-import tiktoken
-
-from goldretriever.services.openai import get_embeddings
+import numpy as np
+from fastapi import UploadFile
+
+from goldretriever.models.models import (
+    Document,
+    DocumentChunk,
+    DocumentChunkBatch,
+    DocumentChunkMetadata,
+)
+
+if TYPE_CHECKING:
+    from multiprocessing.managers import SyncManager
+
+    import tiktoken
+
+from goldretriever.services.cache import PersistentEmbeddingCache, get_persistent_embedding_cache
+from goldretriever.services.file import iter_text_from_file, share_form_file, write_form_file_to_temp_file
+from goldretriever.services.openai import (
+    EMBEDDING_DIMENSIONS,
+    EMBEDDING_MODEL,
+    AsyncEmbeddingClient,
+    default_embedding_client,
+    get_embeddings,
+)
+from goldretriever.services.scheduling import RateLimitScheduler
+from goldretriever.services.tracing import start_span
 
 # Global variables
-tokenizer = tiktoken.get_encoding(
-    "cl100k_base"
-)  # The encoding scheme to use for tokenization
+TOKENIZER_ENCODING = "cl100k_base"  # The encoding scheme to use for tokenization
 
 # Constants
 CHUNK_SIZE = 200  # The target size of each text chunk in tokens
 MIN_CHUNK_SIZE_CHARS = 350  # The minimum size of each text chunk in characters
 MIN_CHUNK_LENGTH_TO_EMBED = 5  # Discard chunks shorter than this
 EMBEDDINGS_BATCH_SIZE = 128  # The number of embeddings to request at a time
-MAX_NUM_CHUNKS = 10000  # The maximum number of chunks to generate from a text
+EMBEDDINGS_BATCH_TOKENS = 32000  # The maximum number of tokens to embed with one request
+EMBEDDINGS_MAX_CONCURRENT_BATCHES = 8  # The number of embedding requests of one call that are in flight at a time
+STREAM_BUFFER_SIZE = 100000  # The number of characters of a streamed text that are tokenized at a time
+FILE_QUEUED_BATCHES = 4  # The number of chunk batches of a file a worker process may get ahead of their consumer
 
 
-def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
+@functools.lru_cache(maxsize=None)
+def get_tokenizer() -> "tiktoken.Encoding":
     """
-    Split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
+    Return the tokenizer, loading it on first use.
+    Loading it downloads the encoding unless it is cached, so it is deferred until the first text is chunked.
+    """
+    import tiktoken
 
-    Args:
-        text: The text to split into chunks.
-        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+    return tiktoken.get_encoding(TOKENIZER_ENCODING)
 
-    Returns:
-        A list of text chunks, each of which is a string of ~CHUNK_SIZE tokens.
-    """
-    # Return an empty list if the text is empty or whitespace
-    if not text or text.isspace():
-        return []
 
-    # Tokenize the text
-    tokens = tokenizer.encode(text, disallowed_special=())
+def warm_tokenizer():
+    """Load the tokenizer ahead of its first use, e.g. in a newly started worker process."""
+    get_tokenizer()
 
-    # Initialize an empty list of chunks
-    chunks = []
 
-    # Use the provided chunk token size or the default one
-    chunk_size = chunk_token_size or CHUNK_SIZE
+def count_tokens(text: str) -> int:
+    """Return the number of tokens of a text, as counted by the tokenizer used for chunking."""
+    return len(get_tokenizer().encode(text, disallowed_special=()))
 
-    # Initialize a counter for the number of chunks
-    num_chunks = 0
+
+def _take_chunks(tokenizer: "tiktoken.Encoding", text: str, chunk_size: int, final: bool) -> Generator[str, None, str]:
+    """
+    Take chunks from the start of a text in a single pass over its tokens, and return the text left over.
+    Unless final, text of at least chunk_size tokens is left over, whose tokens may still change with the text that follows.
+    """
+    # Tokenize the text
+    tokens = tokenizer.encode(text, disallowed_special=())
+
+    # The position of the first token not consumed yet, the tokens are never copied
+    start = 0
 
     # Loop until all tokens are consumed
-    while tokens and num_chunks < MAX_NUM_CHUNKS:
-        # Take the first chunk_size tokens as a chunk
-        chunk = tokens[:chunk_size]
+    while start < len(tokens) and (final or len(tokens) - start >= 2 * chunk_size):
+        # Take the next chunk_size tokens as a chunk
+        chunk = tokens[start : start + chunk_size]
 
         # Decode the chunk into text
         chunk_text = tokenizer.decode(chunk)
 
         # Skip the chunk if it is empty or whitespace
         if not chunk_text or chunk_text.isspace():
-            # Remove the tokens corresponding to the chunk text from the remaining tokens
-            tokens = tokens[len(chunk) :]
-            # Continue to the next iteration of the loop
+            start += len(chunk)
             continue
 
         # Find the last period or punctuation mark in the chunk
@@ -78,47 +109,96 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
         chunk_text_to_append = chunk_text.replace("\n", " ").strip()
 
         if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
-            # Append the chunk text to the list of chunks
-            chunks.append(chunk_text_to_append)
+            yield chunk_text_to_append
 
-        # Remove the tokens corresponding to the chunk text from the remaining tokens
-        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        # Consume the tokens corresponding to the chunk text. Only the chunk is re-encoded, which keeps the chunks
+        # identical to splitting the re-encoded text, even where a boundary falls inside a token
+        start += len(tokenizer.encode(chunk_text, disallowed_special=()))
 
-        # Increment the number of chunks
-        num_chunks += 1
+    if start >= len(tokens):
+        return ""
+    consumed = tokenizer.decode(tokens[:start])
+    if text.startswith(consumed):
+        return text[len(consumed) :]
+    # the consumed tokens end inside a character
+    return tokenizer.decode(tokens[start:])
 
-    # Handle the remaining tokens
-    if tokens:
-        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
-        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
-            chunks.append(remaining_text)
 
-    return chunks
+def iter_text_chunks(texts: Iterable[str], chunk_token_size: Optional[int]) -> Iterator[str]:
+    """
+    Split a text that arrives in pieces, e.g. the pages of a PDF or the rows of a CSV, into chunks of ~CHUNK_SIZE tokens,
+    based on punctuation and newline boundaries.
 
+    The chunks are yielded while the pieces are consumed, and only about STREAM_BUFFER_SIZE characters are held at a time,
+    so that texts of any length are chunked completely with bounded memory.
 
-def create_document_chunks(
-    doc: Document, chunk_token_size: Optional[int]
-) -> Tuple[List[DocumentChunk], str]:
+    Args:
+        texts: The consecutive pieces of the text.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Yields:
+        The text chunks, each of which is a string of ~CHUNK_SIZE tokens.
     """
-    Create a list of document chunks from a document object and return the document id.
+    # Use the provided chunk token size or the default one
+    chunk_size = chunk_token_size or CHUNK_SIZE
+
+    pieces: List[str] = []
+    size = 0
+    for text in texts:
+        # the buffer is chunked once more text follows it, so a text given in one piece is chunked in one pass
+        if size >= STREAM_BUFFER_SIZE:
+            rest = yield from _take_chunks(get_tokenizer(), "".join(pieces), chunk_size, final=False)
+            pieces, size = [rest], len(rest)
+        pieces.append(text)
+        size += len(text)
+
+    text = "".join(pieces)
+    # Skip the text if it is empty or whitespace
+    if text and not text.isspace():
+        yield from _take_chunks(get_tokenizer(), text, chunk_size, final=True)
+
+
+def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
+    """
+    Split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
+
+    The text is tokenized once, and the chunks are taken in a single pass over the tokens,
+    so that chunking takes time linear in the length of the text.
 
     Args:
-        doc: The document object to create chunks from. It should have a text attribute and optionally an id and a metadata attribute.
+        text: The text to split into chunks.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
 
     Returns:
-        A tuple of (doc_chunks, doc_id), where doc_chunks is a list of document chunks, each of which is a DocumentChunk object with an id, a document_id, a text, and a metadata attribute,
-        and doc_id is the id of the document object, generated if not provided. The id of each chunk is generated from the document id and a sequential number, and the metadata is copied from the document object.
+        A list of text chunks, each of which is a string of ~CHUNK_SIZE tokens.
     """
-    # Check if the document text is empty or whitespace
-    if not doc.text or doc.text.isspace():
-        return [], doc.id or str(uuid.uuid4())
+    return list(iter_text_chunks([text], chunk_token_size))
 
-    # Generate a document id if not provided
-    doc_id = doc.id or str(uuid.uuid4())
 
-    # Split the document text into chunks
-    text_chunks = get_text_chunks(doc.text, chunk_token_size)
+def iter_document_chunks(
+    doc: Document, doc_id: str, chunk_token_size: Optional[int], texts: Optional[Iterable[str]] = None
+) -> Iterator[DocumentChunk]:
+    """
+    Yield the chunks of a document while its text is split, see create_document_chunks.
+
+    Args:
+        doc: The document object to create chunks from.
+        doc_id: The id of the document, which the ids of the chunks are generated from.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        texts: The consecutive pieces of the document text, e.g. the pages of a large file, or None to use doc.text.
+
+    Yields:
+        The document chunks, each of which is a DocumentChunk object with an id, a text, and a metadata attribute.
+    """
+    if texts is None:
+        texts = [doc.text or ""]
+
+    # Split the document text into chunks, unless its embedding is precomputed for the whole text
+    text_chunks = (
+        iter_text_chunks(texts, chunk_token_size)
+        if doc.embedding is None
+        else [doc.text]
+    )
 
     metadata = (
         DocumentChunkMetadata(**doc.metadata.__dict__)
@@ -128,37 +208,50 @@ def create_document_chunks(
 
     metadata.document_id = doc_id
 
-    # Initialize an empty list of chunks for this document
-    doc_chunks = []
-
     # Assign each chunk a sequential number and create a DocumentChunk object
     for i, text_chunk in enumerate(text_chunks):
         chunk_id = f"{doc_id}_{i}"
-        doc_chunk = DocumentChunk(
+        yield DocumentChunk(
             id=chunk_id,
             text=text_chunk,
             metadata=metadata,
+            embedding=doc.embedding,
         )
-        # Append the chunk object to the list of chunks for this document
-        doc_chunks.append(doc_chunk)
 
-    # Return the list of chunks and the document id
-    return doc_chunks, doc_id
 
-
-def get_document_chunks(
-    documents: List[Document], chunk_token_size: Optional[int]
-) -> Dict[str, List[DocumentChunk]]:
+def create_document_chunks(
+    doc: Document, chunk_token_size: Optional[int]
+) -> Tuple[List[DocumentChunk], str]:
     """
-    Convert a list of documents into a dictionary from document id to list of document chunks.
+    Create a list of document chunks from a document object and return the document id.
 
     Args:
-        documents: The list of documents to convert.
+        doc: The document object to create chunks from. It should have a text attribute and optionally an id and a metadata attribute.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
 
     Returns:
-        A dictionary mapping each document id to a list of document chunks, each of which is a DocumentChunk object
-        with text, metadata, and embedding attributes.
+        A tuple of (doc_chunks, doc_id), where doc_chunks is a list of document chunks, each of which is a DocumentChunk object with an id, a document_id, a text, and a metadata attribute,
+        and doc_id is the id of the document object, generated if not provided. The id of each chunk is generated from the document id and a sequential number, and the metadata is copied from the document object.
+    """
+    # Generate a document id if not provided
+    doc_id = doc.id or str(uuid.uuid4())
+
+    # Check if the document text is empty or whitespace
+    if not doc.text or doc.text.isspace():
+        return [], doc_id
+
+    return list(iter_document_chunks(doc, doc_id, chunk_token_size)), doc_id
+
+
+def create_all_document_chunks(
+    documents: List[Document], chunk_token_size: Optional[int]
+) -> Tuple[Dict[str, List[DocumentChunk]], List[DocumentChunk]]:
+    """
+    Create the chunks of a list of documents, without embeddings.
+
+    Returns:
+        A tuple of (chunks, all_chunks), where chunks maps each document id to its list of document chunks,
+        and all_chunks is the flat list of all chunks in document order.
     """
     # Initialize an empty dictionary of lists of chunks
     chunks: Dict[str, List[DocumentChunk]] = {}
@@ -176,27 +269,426 @@ def get_document_chunks(
         # Add the list of chunks for this document to the dictionary with the document id as the key
         chunks[doc_id] = doc_chunks
 
+    return chunks, all_chunks
+
+
+def iter_batch_slices(
+    num_chunks: int,
+    num_tokens: Optional[List[int]] = None,
+    size: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+) -> Iterator[slice]:
+    """
+    Split chunks into consecutive batches of at most size chunks, each embedded with one request.
+    If the number of tokens of each chunk is known, the batches are also packed to at most max_tokens tokens,
+    so that batches of long chunks don't exceed the tokens per minute budget with a single request.
+    size and max_tokens default to EMBEDDINGS_BATCH_SIZE and EMBEDDINGS_BATCH_TOKENS.
+    """
+    size = size or EMBEDDINGS_BATCH_SIZE
+    max_tokens = max_tokens or EMBEDDINGS_BATCH_TOKENS
+    if num_tokens is None:
+        for i in range(0, num_chunks, size):
+            yield slice(i, min(i + size, num_chunks))
+        return
+    start = 0
+    batch_tokens = 0
+    for i, chunk_tokens in enumerate(num_tokens):
+        if i > start and (i - start >= size or batch_tokens + chunk_tokens > max_tokens):
+            yield slice(start, i)
+            start, batch_tokens = i, 0
+        batch_tokens += chunk_tokens
+    if start < num_chunks:
+        yield slice(start, num_chunks)
+
+
+def get_document_chunks(
+    documents: List[Document],
+    chunk_token_size: Optional[int],
+    scheduler: Optional[RateLimitScheduler] = None,
+    max_concurrent_batches: Optional[int] = None,
+    embedding_cache: Optional[PersistentEmbeddingCache] = None,
+) -> Dict[str, List[DocumentChunk]]:
+    """
+    Convert a list of documents into a dictionary from document id to list of document chunks.
+
+    Args:
+        documents: The list of documents to convert.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        scheduler: The scheduler pacing the embedding requests to the account's rate limits, or None to send them right away.
+        max_concurrent_batches: The number of embedding requests in flight at a time,
+            or None to use EMBEDDINGS_MAX_CONCURRENT_BATCHES.
+        embedding_cache: The cache the embeddings of unchanged texts are reused from,
+            or None to use the one at EMBEDDING_CACHE_PATH, if it is set.
+
+    Returns:
+        A dictionary mapping each document id to a list of document chunks, each of which is a DocumentChunk object
+        with text, metadata, and embedding attributes.
+    """
+    chunks, all_chunks = create_all_document_chunks(documents, chunk_token_size)
+
+    # Only embed the chunks whose embedding is not precomputed
+    all_chunks = [chunk for chunk in all_chunks if chunk.embedding is None]
+
+    # Reuse the embeddings of texts that were embedded before
+    embedding_cache = embedding_cache or get_persistent_embedding_cache()
+    if embedding_cache is not None and all_chunks:
+        cached, missing = embedding_cache.get_many([chunk.text for chunk in all_chunks], EMBEDDING_MODEL)
+        for chunk, embedding in zip(all_chunks, cached):
+            if embedding is not None:
+                chunk.embedding = embedding.tolist()
+        all_chunks = [all_chunks[i] for i in missing]
+
     # Check if there are no chunks
     if not all_chunks:
-        return {}
+        return chunks
 
-    # Get all the embeddings for the document chunks in batches, using get_embeddings
-    embeddings: List[List[float]] = []
-    for i in range(0, len(all_chunks), EMBEDDINGS_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_texts = [
-            chunk.text for chunk in all_chunks[i : i + EMBEDDINGS_BATCH_SIZE]
-        ]
+    # Count the tokens of the chunks, to pack the batches by tokens
+    num_tokens = [count_tokens(chunk.text) for chunk in all_chunks]
 
-        # Get the embeddings for the batch texts
-        batch_embeddings = get_embeddings(batch_texts)
+    def embed_batch(batch: slice) -> List[List[float]]:
+        # Wait for the rate limits to allow the request
+        if scheduler is not None:
+            scheduler.acquire_sync(sum(num_tokens[batch]))
 
-        # Append the batch embeddings to the embeddings list
-        embeddings.extend(batch_embeddings)
+        # Get the embeddings for the texts of the chunks in the batch, each batch is retried by get_embeddings
+        return get_embeddings([chunk.text for chunk in all_chunks[batch]])
+
+    # Get all the embeddings for the document chunks in batches, max_concurrent_batches at a time
+    embeddings: List[List[float]] = []
+    with ThreadPoolExecutor(max_concurrent_batches or EMBEDDINGS_MAX_CONCURRENT_BATCHES) as pool:
+        # the embeddings of the batches are returned in the order of the batches
+        for batch_embeddings in pool.map(embed_batch, iter_batch_slices(len(all_chunks), num_tokens)):
+            # Append the batch embeddings to the embeddings list
+            embeddings.extend(batch_embeddings)
 
     # Update the document chunk objects with the embeddings
     for i, chunk in enumerate(all_chunks):
         # Assign the embedding from the embeddings list to the chunk object
         chunk.embedding = embeddings[i]
 
+    if embedding_cache is not None:
+        embedding_cache.put_many([chunk.text for chunk in all_chunks], embeddings, EMBEDDING_MODEL)
+
     return chunks
+
+
+async def aget_document_chunks(
+    documents: List[Document],
+    chunk_token_size: Optional[int],
+    embedding_client: Optional[AsyncEmbeddingClient] = None,
+    executor: Optional[Executor] = None,
+    max_concurrent_batches: Optional[int] = None,
+    embedding_cache: Optional[PersistentEmbeddingCache] = None,
+) -> Dict[str, List[DocumentChunk]]:
+    """
+    Like get_document_chunks, but chunks and embeds the documents without blocking the event loop.
+
+    Args:
+        documents: The list of documents to convert.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        embedding_client: The client used to embed the chunks, or None to use the default client.
+        executor: The executor the documents are chunked in, or None to use the default thread pool.
+        max_concurrent_batches: The number of embedding requests in flight at a time,
+            or None to use EMBEDDINGS_MAX_CONCURRENT_BATCHES.
+        embedding_cache: The cache the embeddings of unchanged texts are reused from,
+            or None to use the one at EMBEDDING_CACHE_PATH, if it is set.
+
+    Returns:
+        A dictionary mapping each document id to a list of document chunks with embeddings.
+    """
+    loop = asyncio.get_running_loop()
+    chunks, all_chunks = await loop.run_in_executor(
+        executor, create_all_document_chunks, documents, chunk_token_size
+    )
+
+    all_chunks = [chunk for chunk in all_chunks if chunk.embedding is None]
+    if not all_chunks:
+        return chunks
+
+    # the tokens are counted to pack the embedding requests by tokens
+    to_embed = await loop.run_in_executor(executor, _counted_batch, all_chunks)
+    chunks_to_embed = iter(all_chunks)
+    async for batch in aembed_document_chunks(
+        to_embed,
+        embedding_client,
+        max_concurrent_batches=max_concurrent_batches,
+        embedding_cache=embedding_cache or get_persistent_embedding_cache(),
+    ):
+        for embedding, chunk in zip(batch.embeddings, chunks_to_embed):
+            chunk.embedding = embedding.tolist()
+
+    return chunks
+
+
+def get_document_chunk_batches(
+    documents: List[Document], chunk_token_size: Optional[int]
+) -> Tuple[DocumentChunkBatch, DocumentChunkBatch]:
+    """
+    Create the chunks of a list of documents as columnar batches, separating those that need to be embedded.
+    The number of tokens of each chunk is counted here, so that it can be stored with the chunk in the index.
+
+    Args:
+        documents: The list of documents to convert.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+
+    Returns:
+        A tuple of (to_embed, embedded), where to_embed is a DocumentChunkBatch of the chunks without embeddings,
+        and embedded is a DocumentChunkBatch of the documents with precomputed embeddings, each in document order.
+    """
+    _, all_chunks = create_all_document_chunks(documents, chunk_token_size)
+    return (
+        _counted_batch([chunk for chunk in all_chunks if chunk.embedding is None]),
+        _counted_batch([chunk for chunk in all_chunks if chunk.embedding is not None]),
+    )
+
+
+def iter_document_chunk_batches(
+    chunks: Iterable[DocumentChunk],
+    size: Optional[int] = None,
+    max_tokens: Optional[int] = None,
+) -> Iterator[DocumentChunkBatch]:
+    """
+    Group document chunks into columnar batches of at most size chunks and max_tokens tokens,
+    with the number of tokens of each chunk, while the chunks are created.
+    size and max_tokens default to EMBEDDINGS_BATCH_SIZE and EMBEDDINGS_BATCH_TOKENS.
+    """
+    size = size or EMBEDDINGS_BATCH_SIZE
+    max_tokens = max_tokens or EMBEDDINGS_BATCH_TOKENS
+    batch: List[DocumentChunk] = []
+    num_tokens: List[int] = []
+    batch_tokens = 0
+    for chunk in chunks:
+        chunk_tokens = count_tokens(chunk.text)
+        if batch and (len(batch) >= size or batch_tokens + chunk_tokens > max_tokens):
+            yield _counted_batch(batch, num_tokens)
+            batch, num_tokens, batch_tokens = [], [], 0
+        batch.append(chunk)
+        num_tokens.append(chunk_tokens)
+        batch_tokens += chunk_tokens
+    if batch:
+        yield _counted_batch(batch, num_tokens)
+
+
+def _counted_batch(chunks: List[DocumentChunk], num_tokens: Optional[List[int]] = None) -> DocumentChunkBatch:
+    batch = DocumentChunkBatch.from_chunks(chunks)
+    batch.num_tokens = num_tokens if num_tokens is not None else [count_tokens(text) for text in batch.texts]
+    return batch
+
+
+async def aiter_in_executor(iterator: Iterator[Any], executor: Optional[Executor] = None) -> AsyncIterator[Any]:
+    """
+    Advance a blocking iterator in an executor, without blocking the event loop.
+    The executor must be able to share the iterator, i.e. it must not be a process pool.
+    """
+    loop = asyncio.get_running_loop()
+    done = object()
+    while True:
+        item = await loop.run_in_executor(executor, next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+def put_file_chunk_batches(path: str, mimetype: str, document: Document, queue: Any, stop: Any):
+    """
+    Chunk the text of a file into columnar batches while it is extracted, and put them in queue, followed by None.
+    Runs in a worker process, and stops early once stop is set, when the batches are no longer consumed.
+    """
+    try:
+        texts = iter_text_from_file(open(path, "rb"), mimetype)
+        for batch in iter_document_chunk_batches(iter_document_chunks(document, document.id, None, texts)):
+            while True:
+                if stop.is_set():
+                    return
+                try:
+                    queue.put(batch, timeout=0.1)
+                    break
+                except Full:
+                    pass
+    finally:
+        # a consumer waiting for the next batch must not hang, if the queue is full nobody is waiting
+        try:
+            queue.put_nowait(None)
+        except Full:
+            pass
+
+
+async def aiter_upload_chunk_batches(
+    file: UploadFile, mimetype: str, document: Document, executor: Executor, manager: "SyncManager"
+) -> AsyncIterator[DocumentChunkBatch]:
+    """
+    Chunk the text of an uploaded file into columnar batches in a worker process, and yield them while they arrive.
+    The worker opens the spooled upload through /proc, where there is no /proc it reads a copy in a temporary file.
+    Either is released once the worker is done.
+
+    Args:
+        file: The uploaded file.
+        mimetype: The mimetype of the file.
+        document: The document the chunks belong to, its text is that of the file.
+        executor: The process pool the file is chunked in.
+        manager: The manager holding the queue the batches are sent back through.
+
+    Yields:
+        The batches of chunks, of which at most FILE_QUEUED_BATCHES wait to be consumed at a time.
+    """
+    loop = asyncio.get_running_loop()
+    shared = await loop.run_in_executor(None, share_form_file, file)
+    if shared is not None:
+        path, fd = shared
+        release = functools.partial(os.close, fd)
+    else:
+        path = await write_form_file_to_temp_file(file)
+        release = functools.partial(os.remove, path)
+    queue = manager.Queue(FILE_QUEUED_BATCHES)
+    stop = manager.Event()
+    future = None
+    try:
+        future = loop.run_in_executor(executor, put_file_chunk_batches, path, mimetype, document, queue, stop)
+        while True:
+            batch = await loop.run_in_executor(None, queue.get)
+            if batch is None:
+                break
+            yield batch
+        # raises the error of the worker, if it failed
+        await future
+    finally:
+        stop.set()
+        if future is None:
+            release()
+        else:
+            future.add_done_callback(lambda _: release())
+
+
+def validate_document_embeddings(
+    documents: List[Document],
+    embedding_model: Optional[str],
+    model: str = EMBEDDING_MODEL,
+):
+    """
+    Check that the precomputed document embeddings can be searched with query embeddings of the given model.
+
+    Args:
+        documents: The documents, some of which may have precomputed embeddings.
+        embedding_model: The model the caller declared the embeddings were computed with.
+        model: The model queries are embedded with.
+
+    Raises:
+        ValueError: If the declared model is missing or different, or an embedding does not have the model's dimension.
+    """
+    embeddings = [doc.embedding for doc in documents if doc.embedding is not None]
+    if not embeddings:
+        return
+    if embedding_model != model:
+        raise ValueError(
+            f"Precomputed embeddings must be computed with {model}, got embedding_model={embedding_model}"
+        )
+    dimension = EMBEDDING_DIMENSIONS.get(model, len(embeddings[0]))
+    for doc in documents:
+        if doc.embedding is not None and len(doc.embedding) != dimension:
+            raise ValueError(
+                f"The embedding of document {doc.id} has dimension {len(doc.embedding)}, expected {dimension}"
+            )
+
+
+async def aembed_document_chunks(
+    chunks: DocumentChunkBatch,
+    embedding_client: Optional[AsyncEmbeddingClient] = None,
+    tracer: Optional[Any] = None,
+    max_concurrent_batches: Optional[int] = None,
+    embedding_cache: Optional[PersistentEmbeddingCache] = None,
+) -> AsyncIterator[DocumentChunkBatch]:
+    """
+    Embed document chunks EMBEDDINGS_BATCH_SIZE at a time, without blocking the event loop.
+    If the number of tokens of the chunks is known, the batches are packed to at most EMBEDDINGS_BATCH_TOKENS tokens.
+
+    Args:
+        chunks: The batch of document chunks to embed.
+        embedding_client: The client used to embed the chunks, or None to use the default client.
+        tracer: The OpenTelemetry tracer each embedding request is traced with, or None if tracing is disabled.
+        max_concurrent_batches: The number of embedding requests in flight at a time,
+            or None to use EMBEDDINGS_MAX_CONCURRENT_BATCHES.
+        embedding_cache: The cache the embeddings of unchanged texts are reused from and stored in, or None.
+
+    Yields:
+        Each batch of chunks, in order, as soon as its embedding matrix is set, so that a batch can be
+        processed further while the next ones are embedded.
+    """
+
+    async def batches() -> AsyncIterator[DocumentChunkBatch]:
+        for batch in iter_batch_slices(len(chunks), chunks.num_tokens):
+            yield chunks[batch]
+
+    async for batch in aembed_chunk_batches(
+        batches(), embedding_client, tracer, max_concurrent_batches, embedding_cache
+    ):
+        yield batch
+
+
+async def aembed_chunk_batches(
+    batches: AsyncIterable[DocumentChunkBatch],
+    embedding_client: Optional[AsyncEmbeddingClient] = None,
+    tracer: Optional[Any] = None,
+    max_concurrent_batches: Optional[int] = None,
+    embedding_cache: Optional[PersistentEmbeddingCache] = None,
+) -> AsyncIterator[DocumentChunkBatch]:
+    """
+    Embed batches of document chunks while they are created, e.g. by chunking a large document lazily.
+
+    Args:
+        batches: The batches of document chunks to embed, each of which is embedded with one request.
+        embedding_client: The client used to embed the chunks, or None to use the default client.
+        tracer: The OpenTelemetry tracer each embedding request is traced with, or None if tracing is disabled.
+        max_concurrent_batches: The number of embedding requests in flight at a time,
+            or None to use EMBEDDINGS_MAX_CONCURRENT_BATCHES.
+        embedding_cache: The cache the embeddings of unchanged texts are reused from and stored in, or None.
+            Only the texts that are not cached are sent to the embedding API.
+
+    Yields:
+        Each batch, in the order of batches, as soon as it and the batches before it are embedded.
+    """
+    embedding_client = embedding_client or default_embedding_client
+    max_concurrent_batches = max_concurrent_batches or EMBEDDINGS_MAX_CONCURRENT_BATCHES
+
+    loop = asyncio.get_running_loop()
+
+    async def embed(batch: DocumentChunkBatch) -> DocumentChunkBatch:
+        if embedding_cache is None:
+            cached, missing = [], list(range(len(batch)))
+        else:
+            cached, missing = await loop.run_in_executor(
+                None, embedding_cache.get_many, batch.texts, embedding_client.model
+            )
+        if not missing:
+            batch.embeddings = np.stack(cached)
+            return batch
+
+        texts = [batch.texts[i] for i in missing]
+        # each request is retried on its own by the client
+        with start_span(tracer, "embed_chunks", num_chunks=len(texts)):
+            embeddings = await embedding_client.get_embedding_matrix(
+                texts, sum(batch.num_tokens[i] for i in missing) if batch.num_tokens is not None else None
+            )
+        if len(missing) == len(batch):
+            batch.embeddings = embeddings
+        else:
+            matrix = np.empty((len(batch), embeddings.shape[1]), dtype=np.float32)
+            matrix[missing] = embeddings
+            for i, embedding in enumerate(cached):
+                if embedding is not None:
+                    matrix[i] = embedding
+            batch.embeddings = matrix
+        if embedding_cache is not None:
+            await loop.run_in_executor(None, embedding_cache.put_many, texts, embeddings, embedding_client.model)
+        return batch
+
+    in_flight: Deque[asyncio.Future] = deque()
+    try:
+        async for batch in batches:
+            if len(in_flight) >= max_concurrent_batches:
+                yield await in_flight.popleft()
+            in_flight.append(asyncio.ensure_future(embed(batch)))
+        while in_flight:
+            yield await in_flight.popleft()
+    finally:
+        for embedding in in_flight:
+            embedding.cancel()
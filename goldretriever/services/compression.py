@@ -0,0 +1,160 @@
+import zlib
+from typing import Callable, Dict, Iterable, Optional
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+DECOMPRESSED_CHUNK_SIZE = 1024 * 1024  # The maximum number of decompressed bytes passed on at a time
+
+
+class DecompressionError(Exception):
+    pass
+
+
+class _ZlibDecompressor:
+    def __init__(self, wbits: int):
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def decompress(self, data: bytes) -> Iterable[bytes]:
+        # bounded pieces, so that a small highly compressed body is not inflated into memory at once
+        while data:
+            yield self._decompressor.decompress(data, DECOMPRESSED_CHUNK_SIZE)
+            data = self._decompressor.unconsumed_tail
+
+    def flush(self) -> bytes:
+        if not self._decompressor.eof:
+            raise DecompressionError("The compressed body is truncated")
+        return self._decompressor.flush()
+
+
+class _ZstdDecompressor:
+    def __init__(self, max_size: Optional[int] = None):
+        # the writer passes the output on in pieces of at most DECOMPRESSED_CHUNK_SIZE bytes while it decompresses
+        self._writer = zstandard.ZstdDecompressor().stream_writer(
+            self, write_size=DECOMPRESSED_CHUNK_SIZE, closefd=False
+        )
+        self._max_size = max_size
+        self._size = 0
+        self._pieces = []
+
+    def write(self, data: bytes) -> int:
+        # stops decompressing as soon as the limit is exceeded, so that a small highly compressed body is not
+        # inflated into memory at once
+        self._size += len(data)
+        if self._max_size is not None and self._size > self._max_size:
+            raise DecompressionError(f"The decompressed body is larger than {self._max_size} bytes")
+        self._pieces.append(bytes(data))
+        return len(data)
+
+    def decompress(self, data: bytes) -> Iterable[bytes]:
+        self._writer.write(data)
+        pieces, self._pieces = self._pieces, []
+        yield from pieces
+
+    def flush(self) -> bytes:
+        return b""
+
+
+DECOMPRESSORS: Dict[str, Callable[[Optional[int]], object]] = {
+    "gzip": lambda max_size: _ZlibDecompressor(16 + zlib.MAX_WBITS),
+    "deflate": lambda max_size: _ZlibDecompressor(zlib.MAX_WBITS),
+}
+if zstandard is not None:
+    DECOMPRESSORS["zstd"] = _ZstdDecompressor
+
+
+class DecompressionMiddleware:
+    """
+    ASGI middleware that decompresses the request bodies sent to some paths with a Content-Encoding, while they arrive.
+
+    gzip and deflate are always supported, zstd if the zstandard package is installed.
+    Requests with another encoding get a 415 response, bodies that can't be decompressed a 400 response.
+
+    Args:
+        app: The ASGI app to wrap.
+        paths: The paths whose request bodies are decompressed, requests to other paths are passed through.
+        max_size: The maximum size of a decompressed body in bytes, or None for no limit.
+    """
+
+    def __init__(self, app: ASGIApp, paths: Iterable[str], max_size: Optional[int] = None):
+        self.app = app
+        self.paths = set(paths)
+        self.max_size = max_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http" or scope["path"] not in self.paths:
+            await self.app(scope, receive, send)
+            return
+        headers = dict(scope["headers"])
+        encoding = headers.get(b"content-encoding", b"identity").decode("latin-1").strip().lower()
+        if encoding == "identity":
+            await self.app(scope, receive, send)
+            return
+        if encoding not in DECOMPRESSORS:
+            response = JSONResponse(
+                {"detail": f"Unsupported Content-Encoding {encoding}, supported are {', '.join(DECOMPRESSORS)}"},
+                status_code=415,
+            )
+            await response(scope, receive, send)
+            return
+
+        # the app sees an uncompressed body of unknown length
+        scope = dict(scope)
+        scope["headers"] = [
+            (name, value)
+            for name, value in scope["headers"]
+            if name not in (b"content-encoding", b"content-length")
+        ]
+        decompressor = DECOMPRESSORS[encoding](self.max_size)
+        pending = []
+        size = 0
+        done = False
+
+        def add_piece(piece: bytes):
+            # the size is checked while decompressing, before the pieces of a whole message are held in memory
+            nonlocal size
+            size += len(piece)
+            if self.max_size is not None and size > self.max_size:
+                raise DecompressionError(f"The decompressed body is larger than {self.max_size} bytes")
+            pending.append(piece)
+
+        async def decompressed_receive() -> Message:
+            nonlocal done
+            while not pending and not done:
+                message = await receive()
+                if message["type"] != "http.request":
+                    return message
+                try:
+                    for piece in decompressor.decompress(message.get("body", b"")):
+                        add_piece(piece)
+                    if not message.get("more_body", False):
+                        add_piece(decompressor.flush())
+                        done = True
+                except (zlib.error, DecompressionError) as e:
+                    raise DecompressionError(f"Could not decompress the {encoding} body: {e}")
+                except Exception as e:
+                    if zstandard is not None and isinstance(e, zstandard.ZstdError):
+                        raise DecompressionError(f"Could not decompress the {encoding} body: {e}")
+                    raise
+            body = pending.pop(0) if pending else b""
+            return {"type": "http.request", "body": body, "more_body": bool(pending) or not done}
+
+        response_started = False
+
+        async def tracking_send(message: Message):
+            nonlocal response_started
+            if message["type"] == "http.response.start":
+                response_started = True
+            await send(message)
+
+        try:
+            await self.app(scope, decompressed_receive, tracking_send)
+        except DecompressionError as e:
+            if response_started:
+                raise
+            await JSONResponse({"detail": str(e)}, status_code=400)(scope, receive, send)
@@ -1,24 +1,25 @@
+import codecs
 import os
-from io import BufferedReader
-from typing import Optional
+import tempfile
+from typing import BinaryIO, Iterator, Optional, Tuple
 from fastapi import UploadFile
 import mimetypes
-from PyPDF2 import PdfReader
-import docx2txt
 import csv
-import pptx
 
-from goldretriever.models.models import Document, DocumentMetadata, Source
+UPLOAD_READ_SIZE = 1024 * 1024  # The number of bytes of an upload held in memory at a time
 
 
-async def get_document_from_file(file: UploadFile) -> Document:
-    extracted_text = await extract_text_from_form_file(file)
-    metadata = DocumentMetadata(
-        source=Source.file,
-    )
-    doc = Document(text=extracted_text, metadata=metadata)
+def guess_mimetype(filename: str) -> str:
+    """Return the mimetype of a file based on its extension."""
+    mimetype, _ = mimetypes.guess_type(filename)
 
-    return doc
+    if not mimetype:
+        if filename.endswith(".md"):
+            mimetype = "text/markdown"
+        else:
+            raise Exception("Unsupported file type")
+
+    return mimetype
 
 
 def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) -> str:
@@ -26,13 +27,7 @@ def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) ->
 
     if mimetype is None:
         # Get the mimetype of the file based on its extension
-        mimetype, _ = mimetypes.guess_type(filepath)
-
-    if not mimetype:
-        if filepath.endswith(".md"):
-            mimetype = "text/markdown"
-        else:
-            raise Exception("Unsupported file type")
+        mimetype = guess_mimetype(filepath)
 
     # Open the file in binary mode
     file = open(filepath, "rb")
@@ -41,75 +36,102 @@ def extract_text_from_filepath(filepath: str, mimetype: Optional[str] = None) ->
     return extracted_text
 
 
-def extract_text_from_file(file: BufferedReader, mimetype: str) -> str:
+def extract_text_from_file(file: BinaryIO, mimetype: str) -> str:
+    return "".join(iter_text_from_file(file, mimetype))
+
+
+def iter_text_from_file(file: BinaryIO, mimetype: str) -> Iterator[str]:
+    """
+    Yield the text content of a file in consecutive pieces, e.g. page by page of a PDF or row by row of a CSV,
+    so that large files can be chunked while they are read. The file is closed when the text is exhausted.
+    """
+    try:
+        yield from _iter_text_from_file(file, mimetype)
+    finally:
+        file.close()
+
+
+def _iter_text_from_file(file: BinaryIO, mimetype: str) -> Iterator[str]:
+    # the parsers are imported when a file of their type is extracted first, to keep them out of the startup time
     if mimetype == "application/pdf":
-        # Extract text from pdf using PyPDF2
+        from PyPDF2 import PdfReader
+
+        # Extract text from pdf using PyPDF2, page by page
         reader = PdfReader(file)
-        extracted_text = " ".join([page.extract_text() for page in reader.pages])
+        for i, page in enumerate(reader.pages):
+            yield (" " if i else "") + page.extract_text()
     elif mimetype == "text/plain" or mimetype == "text/markdown":
-        # Read text from plain text file
-        extracted_text = file.read().decode("utf-8")
+        # Read text from plain text file, UPLOAD_READ_SIZE bytes at a time
+        decoder = codecs.getincrementaldecoder("utf-8")()
+        while True:
+            data = file.read(UPLOAD_READ_SIZE)
+            yield decoder.decode(data, final=not data)
+            if not data:
+                break
     elif (
         mimetype
         == "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
     ):
+        import docx2txt
+
         # Extract text from docx using docx2txt
-        extracted_text = docx2txt.process(file)
+        yield docx2txt.process(file)
     elif mimetype == "text/csv":
-        # Extract text from csv using csv module
-        extracted_text = ""
+        # Extract text from csv using csv module, row by row
         decoded_buffer = (line.decode("utf-8") for line in file)
         reader = csv.reader(decoded_buffer)
         for row in reader:
-            extracted_text += " ".join(row) + "\n"
+            yield " ".join(row) + "\n"
     elif (
         mimetype
         == "application/vnd.openxmlformats-officedocument.presentationml.presentation"
     ):
-        # Extract text from pptx using python-pptx
-        extracted_text = ""
+        import pptx
+
+        # Extract text from pptx using python-pptx, slide by slide
         presentation = pptx.Presentation(file)
         for slide in presentation.slides:
+            extracted_text = ""
             for shape in slide.shapes:
                 if shape.has_text_frame:
                     for paragraph in shape.text_frame.paragraphs:
                         for run in paragraph.runs:
                             extracted_text += run.text + " "
                     extracted_text += "\n"
+            yield extracted_text
     else:
         # Unsupported file type
-        file.close()
         raise ValueError("Unsupported file type: {}".format(mimetype))
 
-    file.close()
-    return extracted_text
-
-
-# Extract text from a file based on its mimetype
-async def extract_text_from_form_file(file: UploadFile):
-    """Return the text content of a file."""
-    # get the file body from the upload file object
-    mimetype = file.content_type
-    print(f"mimetype: {mimetype}")
-    print(f"file.file: {file.file}")
-    print("file: ", file)
-
-    file_stream = await file.read()
-
-    temp_file_path = "/tmp/temp_file"
-
-    # write the file to a temporary location
-    with open(temp_file_path, "wb") as f:
-        f.write(file_stream)
 
+async def write_form_file_to_temp_file(file: UploadFile) -> str:
+    """Copy an upload into a new temporary file, UPLOAD_READ_SIZE bytes at a time, and return its path."""
+    await file.seek(0)
+    suffix = os.path.splitext(file.filename or "")[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as temp_file:
+        while True:
+            data = await file.read(UPLOAD_READ_SIZE)
+            if not data:
+                break
+            temp_file.write(data)
+    return temp_file.name
+
+
+def share_form_file(file: UploadFile) -> Optional[Tuple[str, int]]:
+    """
+    Return a path other processes can open an upload at without copying it, and a duplicate of its file descriptor,
+    which keeps the path valid until it is closed. An upload still held in memory is moved to disk first.
+    Returns None on systems without /proc, where an open file without a name can't be opened by other processes.
+    """
+    fd_dir = f"/proc/{os.getpid()}/fd"
+    if not os.path.isdir(fd_dir):
+        return None
+    # the upload is spooled to an unnamed temporary file once it is larger than starlette's spool size
+    if hasattr(file.file, "rollover"):
+        file.file.rollover()
     try:
-        extracted_text = extract_text_from_filepath(temp_file_path, mimetype)
-    except Exception as e:
-        print(f"Error: {e}")
-        os.remove(temp_file_path)
-        raise e
-
-    # remove file from temp location
-    os.remove(temp_file_path)
-
-    return extracted_text
+        fd = os.dup(file.file.fileno())
+    except OSError:
+        # the upload is not backed by a file
+        return None
+    return f"{fd_dir}/{fd}", fd
@@ -0,0 +1,207 @@
+import asyncio
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional
+
+EmbeddingFunction = Callable[[List[str]], Awaitable[List[List[float]]]]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Stops calls to an unhealthy upstream after consecutive failures, and lets a single trial call through after a cool-down.
+
+    The circuit opens after failure_threshold consecutive failed calls, and rejects calls for reset_timeout seconds.
+    After that it is half-open: one call is let through, which closes the circuit if it succeeds and reopens it if it fails.
+
+    Args:
+        failure_threshold: The number of consecutive failures that open the circuit.
+        reset_timeout: The number of seconds the circuit stays open before a trial call is let through.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_timeout: float = 30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.num_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_progress = False
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self.reset_timeout:
+            return "open"
+        return "half-open"
+
+    def allow_request(self) -> bool:
+        """Return whether a call may be made now, reserving the trial call if the circuit is half-open."""
+        state = self.state
+        if state == "closed":
+            return True
+        if state == "half-open" and not self._trial_in_progress:
+            self._trial_in_progress = True
+            return True
+        return False
+
+    def record_success(self):
+        self.num_failures = 0
+        self.opened_at = None
+        self._trial_in_progress = False
+
+    def release_trial(self):
+        """Give up the trial call without an outcome, e.g. because it was cancelled, so that another call can be the trial."""
+        self._trial_in_progress = False
+
+    def record_failure(self):
+        self.num_failures += 1
+        if self._trial_in_progress or self.num_failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+        self._trial_in_progress = False
+
+
+class HedgedEmbedder:
+    """
+    Embeds texts with a bounded tail latency, for latency-sensitive callers such as queries.
+
+    If a request has not returned after the recent p95 latency, a duplicate request is sent, and the first response wins.
+    A failed request is followed by the next one immediately, instead of after a backoff.
+    When all requests of max_attempts fail repeatedly, the circuit breaker opens and calls fail fast with CircuitOpenError,
+    or are sent to the fallback embedder if there is one, until the upstream recovers.
+
+    Args:
+        get_embeddings: The coroutine function making a single embedding request, without retries.
+        max_attempts: The maximum number of requests sent for one call, including hedged ones.
+        initial_hedge_delay: The number of seconds after which a request is hedged until enough latencies are known.
+        min_hedge_delay: The minimum number of seconds after which a request is hedged.
+        min_samples: The number of latencies needed before the hedge delay is based on them.
+        num_recent_latencies: The number of most recent latencies the percentiles are computed from.
+        circuit_breaker: The circuit breaker guarding the upstream, or None to use one with default settings.
+        fallback: The coroutine function used while the circuit is open, which must return compatible embeddings.
+    """
+
+    def __init__(
+        self,
+        get_embeddings: EmbeddingFunction,
+        max_attempts: int = 2,
+        initial_hedge_delay: float = 1.0,
+        min_hedge_delay: float = 0.05,
+        min_samples: int = 20,
+        num_recent_latencies: int = 200,
+        circuit_breaker: Optional[CircuitBreaker] = None,
+        fallback: Optional[EmbeddingFunction] = None,
+    ):
+        self._get_embeddings = get_embeddings
+        self.max_attempts = max_attempts
+        self.initial_hedge_delay = initial_hedge_delay
+        self.min_hedge_delay = min_hedge_delay
+        self.min_samples = min_samples
+        self.circuit_breaker = circuit_breaker or CircuitBreaker()
+        self._fallback = fallback
+        self._latencies: Deque[float] = deque(maxlen=num_recent_latencies)
+        self.num_calls = 0
+        self.num_hedged = 0
+        self.num_hedges_won = 0
+        self.num_rejected = 0
+        self.num_fallbacks = 0
+
+    def _percentile(self, q: float) -> Optional[float]:
+        if not self._latencies:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[int(q * (len(latencies) - 1))]
+
+    @property
+    def hedge_delay(self) -> float:
+        if len(self._latencies) < self.min_samples:
+            return self.initial_hedge_delay
+        return max(self.min_hedge_delay, self._percentile(0.95))
+
+    async def _attempt(self, texts: List[str]) -> List[List[float]]:
+        start = time.monotonic()
+        embeddings = await self._get_embeddings(texts)
+        self._latencies.append(time.monotonic() - start)
+        return embeddings
+
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts, hedging slow requests.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            A list of embeddings, each of which is a list of floats.
+
+        Raises:
+            CircuitOpenError: If the upstream is unhealthy and there is no fallback.
+            Exception: The error of the last request if all requests failed.
+        """
+        self.num_calls += 1
+        is_trial = self.circuit_breaker.state == "half-open"
+        if not self.circuit_breaker.allow_request():
+            if self._fallback is not None:
+                self.num_fallbacks += 1
+                return await self._fallback(texts)
+            self.num_rejected += 1
+            raise CircuitOpenError("The embedding API is unavailable, try again later")
+
+        try:
+            embeddings = await self._hedged(texts)
+        except Exception:
+            self.circuit_breaker.record_failure()
+            raise
+        except BaseException:
+            # a cancelled call says nothing about the upstream, but must not leave the circuit waiting for its trial
+            if is_trial:
+                self.circuit_breaker.release_trial()
+            raise
+        self.circuit_breaker.record_success()
+        return embeddings
+
+    async def _hedged(self, texts: List[str]) -> List[List[float]]:
+        attempts = [asyncio.ensure_future(self._attempt(texts))]
+        pending = set(attempts)
+        error: Optional[BaseException] = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay if len(attempts) < self.max_attempts else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for attempt in done:
+                    if attempt.exception() is None:
+                        if attempt is not attempts[0]:
+                            self.num_hedges_won += 1
+                        return attempt.result()
+                    error = attempt.exception()
+                # another request is sent after the hedge delay, or right away if one failed
+                if len(attempts) < self.max_attempts:
+                    if not done:
+                        self.num_hedged += 1
+                    attempt = asyncio.ensure_future(self._attempt(texts))
+                    attempts.append(attempt)
+                    pending.add(attempt)
+            raise error
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+
+    def info(self) -> Dict[str, Any]:
+        """Return the recent latency percentiles, the hedging counters and the state of the circuit breaker."""
+        return {
+            "calls": self.num_calls,
+            "hedged": self.num_hedged,
+            "hedges_won": self.num_hedges_won,
+            "rejected": self.num_rejected,
+            "fallbacks": self.num_fallbacks,
+            "latency_p50": self._percentile(0.5),
+            "latency_p95": self._percentile(0.95),
+            "latency_p99": self._percentile(0.99),
+            "hedge_delay": self.hedge_delay,
+            "circuit": self.circuit_breaker.state,
+        }
@@ -0,0 +1,102 @@
+import asyncio
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from goldretriever.models.models import Document, Job, JobStatus
+
+
+class JobQueueFullError(Exception):
+    pass
+
+
+class JobManager:
+    """
+    Runs ingestion jobs in the background with a bounded pool of workers.
+
+    Each job is processed batch_size documents at a time, its progress, throughput and failures are kept in a Job.
+
+    Args:
+        process_batch: The coroutine function used to index a batch of documents.
+        num_workers: The number of jobs processed concurrently.
+        max_queued_jobs: The number of jobs that may wait for a worker, submitting more raises JobQueueFullError.
+        batch_size: The number of documents indexed at a time.
+        max_finished_jobs: The number of finished jobs whose status is kept.
+    """
+
+    def __init__(
+        self,
+        process_batch: Callable[..., Awaitable[Any]],
+        num_workers: int = 2,
+        max_queued_jobs: int = 100,
+        batch_size: int = 64,
+        max_finished_jobs: int = 1000,
+    ):
+        self._process_batch = process_batch
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.max_queued_jobs = max_queued_jobs
+        self.max_finished_jobs = max_finished_jobs
+        self._queue: Optional["asyncio.Queue[Tuple[Job, List[Document], Dict[str, Any]]]"] = None
+        self._jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self._workers: List[asyncio.Task] = []
+
+    def submit(self, documents: List[Document], **kwargs) -> Job:
+        """Queue documents for indexing and return the job tracking them, kwargs are passed on to process_batch."""
+        if self._queue is None:
+            # created here rather than in __init__ to bind them to the running event loop
+            self._queue = asyncio.Queue(maxsize=self.max_queued_jobs)
+            self._workers = [asyncio.ensure_future(self._work()) for _ in range(self.num_workers)]
+        job = Job(id=str(uuid.uuid4()), num_documents=len(documents), created_at=time.time())
+        try:
+            self._queue.put_nowait((job, documents, kwargs))
+        except asyncio.QueueFull:
+            raise JobQueueFullError(f"More than {self.max_queued_jobs} jobs are queued")
+        self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def _work(self):
+        while True:
+            job, documents, kwargs = await self._queue.get()
+            try:
+                await self._run(job, documents, **kwargs)
+            finally:
+                self._queue.task_done()
+            self._forget_finished_jobs()
+
+    async def _run(self, job: Job, documents: List[Document], **kwargs):
+        job.status = JobStatus.running
+        job.started_at = time.time()
+        for i in range(0, len(documents), self.batch_size):
+            batch = documents[i : i + self.batch_size]
+            try:
+                await self._process_batch(batch, **kwargs)
+                job.num_processed += len(batch)
+            except Exception as e:
+                print("Error:", e)
+                job.num_failed += len(batch)
+                job.errors.append(f"documents {i} to {i + len(batch) - 1}: {e}")
+            elapsed = time.time() - job.started_at
+            job.documents_per_second = job.num_processed / elapsed if elapsed > 0 else None
+        job.finished_at = time.time()
+        job.status = JobStatus.failed if job.num_failed else JobStatus.succeeded
+
+    def _forget_finished_jobs(self):
+        finished = [
+            job_id
+            for job_id, job in self._jobs.items()
+            if job.status in (JobStatus.succeeded, JobStatus.failed)
+        ]
+        for job_id in finished[: max(0, len(finished) - self.max_finished_jobs)]:
+            del self._jobs[job_id]
+
+    async def close(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._queue = None
@@ -1,7 +1,27 @@
-from typing import List
+import asyncio
+import base64
+import os
+from typing import List, Optional
 
+import aiohttp
+import numpy as np
+import openai
 from tenacity import retry, wait_random_exponential, stop_after_attempt
 
+from goldretriever.services.scheduling import RateLimitScheduler
+
+EMBEDDING_MODEL = "text-embedding-ada-002"  # The OpenAI model used to embed chunks and queries
+EMBEDDING_DIMENSIONS = {"text-embedding-ada-002": 1536}  # The embedding dimension of known models
+EMBEDDING_REQUEST_TIMEOUT = 10  # The timeout of a single embedding request in seconds
+EMBEDDING_MAX_CONNECTIONS = 32  # The number of pooled connections to the OpenAI API
+EMBEDDING_KEEPALIVE_TIMEOUT = 60  # The number of seconds an idle pooled connection is kept open
+CHARS_PER_TOKEN = 4  # The average number of characters per token, to estimate the tokens of texts not counted yet
+
+
+def estimate_num_tokens(texts: List[str]) -> int:
+    """Estimate the number of tokens of texts without loading the tokenizer."""
+    return sum(len(text) // CHARS_PER_TOKEN + 1 for text in texts)
+
 
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
 def get_embeddings(texts: List[str]) -> List[List[float]]:
@@ -18,9 +38,8 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
         Exception: If the OpenAI API call fails.
     """
     # Call the OpenAI API to get the embeddings
-    import os
     openai.api_key = os.environ.get("OPENAI_API_KEY", None)
-    response = openai.Embedding.create(input=texts, model="text-embedding-ada-002")
+    response = openai.Embedding.create(input=texts, model=EMBEDDING_MODEL)
 
     # Extract the embedding data from the response
     data = response["data"]  # type: ignore
@@ -29,6 +48,160 @@ def get_embeddings(texts: List[str]) -> List[List[float]]:
     return [result["embedding"] for result in data]
 
 
+class AsyncEmbeddingClient:
+    """
+    Non-blocking client for OpenAI's embeddings API.
+    All requests share one pooled keep-alive HTTP session, and are retried with asynchronous backoff.
+
+    Args:
+        model: The name of the embedding model.
+        timeout: The timeout of a single request in seconds.
+        max_connections: The maximum number of concurrent connections to the OpenAI API.
+        api_base: The base URL of an alternate OpenAI-compatible API, or None to use OpenAI's.
+        api_key: The API key, or None to use the OPENAI_API_KEY environment variable.
+        scheduler: The scheduler pacing the requests to the account's rate limits, shared by the clients of one account,
+            or None to send requests right away.
+    """
+
+    def __init__(
+        self,
+        model: str = EMBEDDING_MODEL,
+        timeout: float = EMBEDDING_REQUEST_TIMEOUT,
+        max_connections: int = EMBEDDING_MAX_CONNECTIONS,
+        api_base: Optional[str] = None,
+        api_key: Optional[str] = None,
+        scheduler: Optional[RateLimitScheduler] = None,
+    ):
+        self.model = model
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.api_base = api_base
+        self.api_key = api_key
+        self.scheduler = scheduler
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # a session is bound to the event loop it was created in
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._loop is not loop:
+            self._loop = loop
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(
+                    limit=self.max_connections,
+                    keepalive_timeout=EMBEDDING_KEEPALIVE_TIMEOUT,
+                )
+            )
+        return self._session
+
+    async def _create(self, texts: List[str], num_tokens: Optional[int] = None, wait: bool = True, **kwargs):
+        if self.scheduler is not None:
+            num_tokens = num_tokens if num_tokens is not None else estimate_num_tokens(texts)
+            if wait:
+                await self.scheduler.acquire(num_tokens)
+            else:
+                self.scheduler.reserve(num_tokens)
+        openai.aiosession.set(self._get_session())
+        if self.api_base is not None:
+            kwargs["api_base"] = self.api_base
+        return await openai.Embedding.acreate(
+            input=texts,
+            model=self.model,
+            api_key=self.api_key or os.environ.get("OPENAI_API_KEY", None),
+            request_timeout=self.timeout,
+            **kwargs,
+        )
+
+    async def create_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts with a single request, without retrying it if it fails, and without waiting for the scheduler.
+        Used by latency-sensitive callers that handle failures themselves, see HedgedEmbedder.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            A list of embeddings, each of which is a list of floats.
+
+        Raises:
+            Exception: If the OpenAI API call fails.
+        """
+        response = await self._create(texts, wait=False)
+
+        data = response["data"]  # type: ignore
+
+        return [result["embedding"] for result in data]
+
+    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
+    async def get_embeddings(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embed texts without blocking the event loop.
+
+        Args:
+            texts: The list of texts to embed.
+
+        Returns:
+            A list of embeddings, each of which is a list of floats.
+
+        Raises:
+            Exception: If the OpenAI API call fails.
+        """
+        response = await self._create(texts)
+
+        data = response["data"]  # type: ignore
+
+        return [result["embedding"] for result in data]
+
+    @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
+    async def get_embedding_matrix(self, texts: List[str], num_tokens: Optional[int] = None) -> np.ndarray:
+        """
+        Embed texts without blocking the event loop, and without creating a Python float per dimension.
+
+        Args:
+            texts: The list of texts to embed.
+            num_tokens: The number of tokens of the texts if they are counted already, or None to estimate it.
+
+        Returns:
+            A float32 matrix with one embedding per row.
+
+        Raises:
+            Exception: If the OpenAI API call fails.
+        """
+        # requesting base64 explicitly makes the client return the encoded float32 buffers as they are
+        response = await self._create(texts, num_tokens, encoding_format="base64")
+
+        data = response["data"]  # type: ignore
+
+        return np.stack(
+            [
+                np.frombuffer(base64.b64decode(result["embedding"]), dtype=np.float32)
+                if isinstance(result["embedding"], str)
+                else np.asarray(result["embedding"], dtype=np.float32)
+                for result in data
+            ]
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+default_embedding_client = AsyncEmbeddingClient()
+
+
+async def aget_embeddings(texts: List[str]) -> List[List[float]]:
+    """
+    Embed texts using OpenAI's ada model without blocking the event loop.
+
+    Args:
+        texts: The list of texts to embed.
+
+    Returns:
+        A list of embeddings, each of which is a list of floats.
+    """
+    return await default_embedding_client.get_embeddings(texts)
+
+
 @retry(wait=wait_random_exponential(min=1, max=20), stop=stop_after_attempt(3))
 def get_chat_completion(
     messages,
@@ -0,0 +1,54 @@
+from typing import List, Optional
+
+from goldretriever.models.models import DocumentChunkWithScore, QueryResult
+from goldretriever.services.chunks import count_tokens
+
+
+def get_chunk_num_tokens(chunk: DocumentChunkWithScore) -> int:
+    """Return the number of tokens of a chunk text, counted at ingest if possible."""
+    if chunk._num_tokens is None:
+        chunk._num_tokens = count_tokens(chunk.text)
+    return chunk._num_tokens
+
+
+def pack_query_results(
+    results: List[QueryResult], max_tokens: Optional[int]
+) -> List[QueryResult]:
+    """
+    Keep the closest chunks across all query results whose texts fit into a token budget.
+
+    The score of a chunk is the cosine distance the executor returns, lower is better.
+    Chunks are considered from the lowest to the highest distance, regardless of the query they belong to,
+    and a chunk that does not fit is skipped in favour of smaller, more distant ones.
+
+    Args:
+        results: The query results, each with its chunks ordered by ascending distance.
+        max_tokens: The maximum total number of tokens of all returned chunk texts, or None to keep all chunks.
+
+    Returns:
+        A query result per query with the chunks that fit, in their original order.
+    """
+    if max_tokens is None:
+        return results
+
+    candidates = sorted(
+        (
+            (chunk.score, i, j)
+            for i, result in enumerate(results)
+            for j, chunk in enumerate(result.results)
+        )
+    )
+    kept = [set() for _ in results]
+    remaining = max_tokens
+    for _, i, j in candidates:
+        num_tokens = get_chunk_num_tokens(results[i].results[j])
+        if num_tokens <= remaining:
+            kept[i].add(j)
+            remaining -= num_tokens
+
+    return [
+        result.copy(
+            update={"results": [chunk for j, chunk in enumerate(result.results) if j in kept[i]]}
+        )
+        for i, result in enumerate(results)
+    ]
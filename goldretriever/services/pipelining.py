@@ -0,0 +1,41 @@
+import asyncio
+from typing import AsyncIterator, Awaitable, Callable, List, TypeVar
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+
+async def process_pipelined(
+    items: AsyncIterator[T], process: Callable[[T], Awaitable[R]], max_inflight: int
+) -> List[R]:
+    """
+    Process items while they arrive, with at most max_inflight items being processed at a time.
+
+    The next item is produced while the previous ones are processed, and is only handed to process once fewer than
+    max_inflight items are in flight, which bounds the number of produced items held in memory to max_inflight + 1.
+    If an item fails, the items in flight are cancelled and the error is raised.
+
+    Args:
+        items: The items to process, e.g. batches of chunks as they are embedded.
+        process: The coroutine function used to process an item.
+        max_inflight: The maximum number of items processed at a time.
+
+    Returns:
+        The results of processing the items, in the order of the items.
+    """
+    tasks: List[asyncio.Future] = []
+    try:
+        async for item in items:
+            in_flight = [task for task in tasks if not task.done()]
+            if len(in_flight) >= max_inflight:
+                await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            # fail early if an item could not be processed
+            for task in tasks:
+                if task.done() and task.exception() is not None:
+                    raise task.exception()
+            tasks.append(asyncio.ensure_future(process(item)))
+        return list(await asyncio.gather(*tasks))
+    except BaseException:
+        for task in tasks:
+            task.cancel()
+        raise
@@ -0,0 +1,108 @@
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from typing import Iterable
+
+MAX_PROFILE_SECONDS = 60  # The longest profile that may be taken at once
+MEMORY_TRACEBACK_FRAMES = 25  # The number of frames tracemalloc keeps per allocation
+
+_profile_lock = threading.Lock()
+
+
+class ProfilerBusyError(Exception):
+    pass
+
+
+def _frame_name(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+def _fold(frames: Iterable[str]) -> str:
+    # folded stacks use ; as separator between frames, from the root to the leaf
+    return ";".join(frame.replace(";", ":") for frame in frames)
+
+
+def sample_cpu_profile(seconds: float, interval: float = 0.01) -> str:
+    """
+    Sample the stacks of all threads of this process every interval seconds, for the given number of seconds.
+    Blocks the calling thread, which is left out of the samples.
+
+    Returns:
+        The samples in folded stack format, one line per distinct stack with its sample count,
+        which can be rendered with flamegraph.pl or speedscope.
+    """
+    own_thread = threading.get_ident()
+    thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+    samples: Counter = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own_thread:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.append(f"thread {thread_names.get(thread_id, thread_id)}")
+            samples[_fold(reversed(stack))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in samples.most_common())
+
+
+def sample_memory_profile(seconds: float) -> str:
+    """
+    Trace the memory allocations of this process for the given number of seconds, blocking the calling thread.
+
+    Returns:
+        The allocations still alive at the end in folded stack format, one line per distinct allocation traceback
+        with its size in bytes.
+    """
+    started = not tracemalloc.is_tracing()
+    if started:
+        tracemalloc.start(MEMORY_TRACEBACK_FRAMES)
+    try:
+        time.sleep(seconds)
+        snapshot = tracemalloc.take_snapshot()
+    finally:
+        if started:
+            tracemalloc.stop()
+    lines = []
+    for statistic in snapshot.statistics("traceback"):
+        stack = [f"{os.path.basename(frame.filename)}:{frame.lineno}" for frame in statistic.traceback]
+        lines.append(f"{_fold(reversed(stack))} {statistic.size}\n")
+    return "".join(lines)
+
+
+def profile(seconds: float, kind: str = "cpu", interval: float = 0.01) -> str:
+    """
+    Profile this process, one profile at a time.
+
+    Args:
+        seconds: The duration of the profile, at most MAX_PROFILE_SECONDS.
+        kind: "cpu" for a sampling CPU profile, "memory" for a tracemalloc profile.
+        interval: The sampling interval of a CPU profile in seconds.
+
+    Returns:
+        The profile in folded stack format.
+
+    Raises:
+        ValueError: If the duration or kind is invalid.
+        ProfilerBusyError: If another profile is being taken.
+    """
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise ValueError(f"The profile duration must be between 0 and {MAX_PROFILE_SECONDS} seconds")
+    if interval <= 0:
+        raise ValueError("The sampling interval must be positive")
+    if kind not in ("cpu", "memory"):
+        raise ValueError(f"Unknown profile kind {kind}, use cpu or memory")
+    if not _profile_lock.acquire(blocking=False):
+        raise ProfilerBusyError("Another profile is being taken")
+    try:
+        if kind == "cpu":
+            return sample_cpu_profile(seconds, interval)
+        return sample_memory_profile(seconds)
+    finally:
+        _profile_lock.release()
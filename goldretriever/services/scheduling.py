@@ -0,0 +1,100 @@
+import asyncio
+import threading
+import time
+from typing import Any, Dict, Optional
+
+
+class _Budget:
+    """A per-minute budget refilled continuously, which requests may overdraw and then wait for."""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60
+        self.capacity = self.rate * burst_seconds
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def reserve(self, amount: float, now: float) -> float:
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        self.level -= amount
+        return max(0.0, -self.level / self.rate)
+
+
+class RateLimitScheduler:
+    """
+    Paces embedding requests to stay within the requests per minute and tokens per minute of an OpenAI account.
+
+    Each request reserves its share of both budgets when it is scheduled, and waits until the budgets have refilled
+    enough to cover it. Requests of concurrent callers are therefore sent in the order they were scheduled,
+    at a sustained rate that sits at the limits instead of running into 429 responses and backing off.
+
+    Args:
+        requests_per_minute: The maximum number of requests per minute, or None for no limit.
+        tokens_per_minute: The maximum number of tokens per minute, or None for no limit.
+        burst_seconds: The number of seconds of either budget that may be spent at once after an idle period.
+    """
+
+    def __init__(
+        self,
+        requests_per_minute: Optional[float] = None,
+        tokens_per_minute: Optional[float] = None,
+        burst_seconds: float = 1.0,
+    ):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self._requests = _Budget(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self._tokens = _Budget(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        # reservations are made from the event loop and from threads embedding synchronously
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_tokens = 0
+        self.num_delayed = 0
+        self.total_delay = 0.0
+
+    def reserve(self, num_tokens: int) -> float:
+        """
+        Reserve the budget of a request without waiting for it.
+
+        Args:
+            num_tokens: The number of tokens of the request. Requests that must not wait reserve their tokens too,
+                so that the requests of other callers leave room for them.
+
+        Returns:
+            The number of seconds to wait before sending the request.
+        """
+        with self._lock:
+            now = time.monotonic()
+            delay = 0.0
+            if self._requests is not None:
+                delay = max(delay, self._requests.reserve(1, now))
+            if self._tokens is not None:
+                delay = max(delay, self._tokens.reserve(num_tokens, now))
+            self.num_requests += 1
+            self.num_tokens += num_tokens
+            if delay > 0:
+                self.num_delayed += 1
+                self.total_delay += delay
+        return delay
+
+    async def acquire(self, num_tokens: int):
+        """Wait until a request of num_tokens tokens may be sent."""
+        delay = self.reserve(num_tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def acquire_sync(self, num_tokens: int):
+        """Like acquire, blocking the calling thread."""
+        delay = self.reserve(num_tokens)
+        if delay > 0:
+            time.sleep(delay)
+
+    def info(self) -> Dict[str, Any]:
+        """Return the limits, the number of requests and tokens scheduled, and how often and how long they waited."""
+        return {
+            "requests_per_minute": self.requests_per_minute,
+            "tokens_per_minute": self.tokens_per_minute,
+            "requests": self.num_requests,
+            "tokens": self.num_tokens,
+            "delayed": self.num_delayed,
+            "delay_mean": self.total_delay / self.num_delayed if self.num_delayed else 0.0,
+        }
@@ -0,0 +1,80 @@
+import json
+from typing import Any, Dict, List, Optional, Tuple
+
+from goldretriever.models.models import DocumentChunkWithScore, QueryResult
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+    print("Warning: orjson is not installed, query responses are encoded with the slower json module")
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+    print("Warning: msgpack is not installed, query responses are sent as JSON even if msgpack is accepted")
+
+JSON_MEDIA_TYPE = "application/json"
+MSGPACK_MEDIA_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+def chunk_to_dict(
+    chunk: DocumentChunkWithScore, fields: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """Return the given fields of a chunk, or all fields if None, as plain Python objects."""
+    fields = fields or chunk.__fields__.keys()
+    values = {}
+    for field in fields:
+        value = getattr(chunk, field)
+        if field == "metadata" and value is not None:
+            value = {key: getattr(value, key) for key in value.__fields__}
+        values[field] = value
+    return values
+
+
+def query_results_to_dict(
+    results: List[QueryResult], fields: Optional[List[str]] = None
+) -> Dict[str, Any]:
+    """
+    Convert query results into the plain objects of a QueryResponse, without validating them again.
+
+    Args:
+        results: The query results.
+        fields: The fields of each result chunk to include, or None to include all of them.
+
+    Returns:
+        A dictionary with the shape of a QueryResponse.
+    """
+    return {
+        "results": [
+            {
+                "query": result.query,
+                "results": [chunk_to_dict(chunk, fields) for chunk in result.results],
+            }
+            for result in results
+        ]
+    }
+
+
+def encode_query_response(
+    results: List[QueryResult],
+    fields: Optional[List[str]] = None,
+    accept: Optional[str] = None,
+) -> Tuple[bytes, str]:
+    """
+    Serialize query results as a QueryResponse, in the format negotiated by the Accept header.
+
+    Uses msgpack if it is accepted and installed, and JSON otherwise, encoded with orjson if it is installed.
+
+    Returns:
+        A tuple of (content, media_type).
+    """
+    payload = query_results_to_dict(results, fields)
+    if msgpack is not None and accept and any(
+        media_type in accept for media_type in MSGPACK_MEDIA_TYPES
+    ):
+        return msgpack.packb(payload), MSGPACK_MEDIA_TYPES[0]
+    if orjson is not None:
+        return orjson.dumps(payload), JSON_MEDIA_TYPE
+    return json.dumps(payload).encode("utf-8"), JSON_MEDIA_TYPE
@@ -0,0 +1,61 @@
+from typing import AsyncIterator, Optional, Tuple, Union
+
+from pydantic import ValidationError
+
+from goldretriever.models.models import Document
+
+
+async def iter_ndjson_documents(
+    stream: AsyncIterator[bytes],
+    max_line_size: Optional[int] = None,
+) -> AsyncIterator[Tuple[int, Union[Document, str]]]:
+    """
+    Parse newline-delimited JSON documents from a byte stream as it arrives.
+
+    Args:
+        stream: The byte stream, e.g. the body of a request, in arbitrarily split pieces.
+        max_line_size: The maximum size of a line in bytes, longer lines are discarded while they arrive.
+            None for no limit.
+
+    Yields:
+        A tuple of (line, document) for each non-empty line, where line is its 1-based line number,
+        and document is the parsed Document or an error message if the line is not a valid document.
+    """
+    # only the new piece is searched for the end of the line, and pieces are appended in place
+    buffer = bytearray()
+    oversized = False
+    line_number = 0
+    async for data in stream:
+        start = 0
+        while True:
+            end = data.find(b"\n", start)
+            if not oversized:
+                buffer += data[start:end] if end >= 0 else data[start:]
+                if max_line_size is not None and len(buffer) > max_line_size:
+                    oversized = True
+                    buffer.clear()
+            if end < 0:
+                break
+            line_number += 1
+            if oversized:
+                yield line_number, _line_too_long(max_line_size)
+            elif buffer.strip():
+                yield line_number, _parse_document(bytes(buffer))
+            buffer.clear()
+            oversized = False
+            start = end + 1
+    if oversized:
+        yield line_number + 1, _line_too_long(max_line_size)
+    elif buffer.strip():
+        yield line_number + 1, _parse_document(bytes(buffer))
+
+
+def _line_too_long(max_line_size: int) -> str:
+    return f"line is longer than the maximum of {max_line_size} bytes"
+
+
+def _parse_document(line: bytes) -> Union[Document, str]:
+    try:
+        return Document.parse_raw(line)
+    except ValidationError as e:
+        return str(e)
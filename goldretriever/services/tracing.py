@@ -0,0 +1,103 @@
+import contextlib
+from typing import Any, Callable, ContextManager, Dict, Optional, Tuple
+
+try:
+    from opentelemetry import propagate
+except ImportError:  # pragma: no cover
+    propagate = None
+
+# The request parameter the trace context is passed to the executor in, must match the executor's
+TRACE_CONTEXT_PARAMETER = "__trace_context__"
+
+
+def start_span(tracer: Optional[Any], name: str, **attributes) -> ContextManager:
+    """
+    Start a span as a child of the current one, if tracing is enabled.
+
+    Args:
+        tracer: The OpenTelemetry tracer, or None if tracing is disabled.
+        name: The name of the span.
+        attributes: Attributes set on the span.
+
+    Returns:
+        A context manager that ends the span on exit.
+    """
+    if tracer is None:
+        return contextlib.nullcontext()
+    return tracer.start_as_current_span(name, attributes=attributes)
+
+
+def trace_parameters(parameters: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Return request parameters carrying the current trace context, so that the executor's spans join the trace."""
+    parameters = dict(parameters or {})
+    if propagate is not None:
+        carrier: Dict[str, str] = {}
+        propagate.inject(carrier)
+        if carrier:
+            parameters[TRACE_CONTEXT_PARAMETER] = carrier
+    return parameters
+
+
+def create_file_tracer(path: str, name: str) -> Tuple[Any, Callable[[], None]]:
+    """
+    Create a tracer that appends the finished spans to a file, one JSON object per line.
+    Used when no OTLP collector is configured, e.g. to inspect single requests locally.
+
+    Args:
+        path: The path of the file the spans are appended to.
+        name: The name of the instrumented component.
+
+    Returns:
+        An OpenTelemetry tracer, and a function that exports the remaining spans and closes the file.
+
+    Raises:
+        ImportError: If the opentelemetry-sdk package is not installed.
+    """
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+    except ImportError as e:
+        raise ImportError(
+            "Writing traces to a file requires the opentelemetry-sdk package, "
+            "install the tracing extra of goldretriever"
+        ) from e
+
+    provider = TracerProvider(resource=Resource.create({"service.name": name}))
+    traces_file = open(path, "a")
+    exporter = ConsoleSpanExporter(
+        out=traces_file,
+        formatter=lambda span: span.to_json(indent=None) + "\n",
+    )
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+
+    def close():
+        provider.shutdown()
+        traces_file.close()
+
+    return provider.get_tracer(name), close
+
+
+class RequestSpanMiddleware:
+    """
+    ASGI middleware that traces each HTTP request with a root span, under which the spans of its stages are nested.
+    Only needed with a tracer of our own, jina instruments the app itself when tracing is enabled for the flow.
+
+    Args:
+        app: The ASGI app to wrap.
+        tracer: The OpenTelemetry tracer, or None to pass requests through untraced.
+    """
+
+    def __init__(self, app: Any, tracer: Optional[Any] = None):
+        self.app = app
+        self.tracer = tracer
+
+    async def __call__(self, scope, receive, send):
+        if self.tracer is None or scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with self.tracer.start_as_current_span(
+            f"{scope['method']} {scope['path']}",
+            attributes={"http.method": scope["method"], "http.target": scope["path"]},
+        ):
+            await self.app(scope, receive, send)
@@ -0,0 +1,123 @@
+"""
+Compares the speed of get_text_chunks with the previous implementation, which copied the remaining tokens for every chunk.
+
+Run with `python -m tests.benchmark_chunks` from the repository root. The cl100k_base tokenizer is used if it is
+available, otherwise a word tokenizer that needs no download.
+"""
+import random
+import re
+import time
+from typing import Dict, List, Optional
+from unittest.mock import patch
+
+from goldretriever.services import chunks as chunks_module
+from goldretriever.services.chunks import (
+    CHUNK_SIZE,
+    MIN_CHUNK_LENGTH_TO_EMBED,
+    MIN_CHUNK_SIZE_CHARS,
+    get_text_chunks,
+)
+
+# The cap on the number of chunks of a text the previous implementation had
+MAX_NUM_CHUNKS = 10000
+
+WORDS = ["retrieval", "plugin", "document", "chunk", "token", "the", "a", "of", "index", "embedding", "é", "数据"]
+
+
+class WordTokenizer:
+    """A stand-in for tiktoken, with one token per word, whitespace run, or punctuation run with its trailing newlines."""
+
+    _pattern = re.compile(r"\w+|[^\w\s]+\n*|\s+")
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._texts: List[str] = []
+
+    def encode(self, text: str, disallowed_special=()) -> List[int]:
+        tokens = []
+        for piece in self._pattern.findall(text):
+            if piece not in self._ids:
+                self._ids[piece] = len(self._texts)
+                self._texts.append(piece)
+            tokens.append(self._ids[piece])
+        return tokens
+
+    def decode(self, tokens: List[int]) -> str:
+        return "".join(self._texts[token] for token in tokens)
+
+
+def previous_get_text_chunks(text: str, chunk_token_size: Optional[int], tokenizer) -> List[str]:
+    """The implementation get_text_chunks replaced, kept as the reference for its output."""
+    if not text or text.isspace():
+        return []
+    tokens = tokenizer.encode(text, disallowed_special=())
+    chunks = []
+    chunk_size = chunk_token_size or CHUNK_SIZE
+    num_chunks = 0
+    while tokens and num_chunks < MAX_NUM_CHUNKS:
+        chunk = tokens[:chunk_size]
+        chunk_text = tokenizer.decode(chunk)
+        if not chunk_text or chunk_text.isspace():
+            tokens = tokens[len(chunk) :]
+            continue
+        last_punctuation = max(
+            chunk_text.rfind("."),
+            chunk_text.rfind("?"),
+            chunk_text.rfind("!"),
+            chunk_text.rfind("\n"),
+        )
+        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+            chunk_text = chunk_text[: last_punctuation + 1]
+        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
+        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(chunk_text_to_append)
+        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        num_chunks += 1
+    if tokens:
+        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(remaining_text)
+    return chunks
+
+
+def random_text(num_chars: int, seed: int = 0) -> str:
+    """Return a text of roughly num_chars characters with sentences, paragraphs and the odd run of blank lines."""
+    rng = random.Random(seed)
+    parts = []
+    size = 0
+    while size < num_chars:
+        sentence = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 30)))
+        parts.append(sentence + rng.choice([".", "?", "!", ".\n", "\n\n", ";", ".\n\n\n   \n"]) + " ")
+        size += len(parts[-1])
+    return "".join(parts)
+
+
+def get_tokenizer():
+    try:
+        return chunks_module.get_tokenizer()
+    except Exception:
+        return WordTokenizer()
+
+
+def main():
+    tokenizer = get_tokenizer()
+    print(f"tokenizer: {type(tokenizer).__name__}")
+    for num_chars in (100_000, 1_000_000, 4_000_000):
+        text = random_text(num_chars)
+        start = time.perf_counter()
+        previous = previous_get_text_chunks(text, None, tokenizer)
+        previous_seconds = time.perf_counter() - start
+        with patch.object(chunks_module, "get_tokenizer", return_value=tokenizer):
+            start = time.perf_counter()
+            current = get_text_chunks(text, None)
+            current_seconds = time.perf_counter() - start
+        assert current == previous
+        print(
+            f"{num_chars:>9} chars, {len(current):>6} chunks: "
+            f"previous {previous_seconds:.3f}s, single pass {current_seconds:.3f}s, "
+            f"{previous_seconds / current_seconds:.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import importlib.util
+import os
+import sys
+import tempfile
+import unittest
+from unittest.mock import AsyncMock, patch
+
+import numpy as np
+
+from goldretriever.models.models import DocumentChunkBatch
+from goldretriever.services.packing import pack_query_results
+
+HAS_JINA = importlib.util.find_spec('jina') is not None
+
+if HAS_JINA:
+    from docarray import DocumentArray
+
+    from goldretriever.datastore.executor.docarray_v1 import DocArrayDataStore
+
+    # the gateway is imported the way jina loads it, with the goldretriever directory on the path
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'goldretriever'))
+    import gateway
+
+
+def create_datastore(directory):
+    with patch.dict(os.environ, {'K8S_NAMESPACE_NAME': 'jnamespace-test'}):
+        datastore = DocArrayDataStore()
+    # the executor loads the index of its namespace if there is one, the tests start from an empty one
+    datastore._index_file_path = os.path.join(directory, 'retrieval_da.bin')
+    datastore._index = DocumentArray()
+    return datastore
+
+
+class StubStreamer:
+    """Sends the requests of the gateway to an executor in the test process and records their endpoints."""
+
+    def __init__(self, datastore):
+        self.datastore = datastore
+        self.endpoints = []
+        self.failing_endpoints = set()
+
+    async def stream_docs(self, docs, parameters, exec_endpoint):
+        self.endpoints.append(exec_endpoint)
+        if exec_endpoint in self.failing_endpoints:
+            raise ConnectionError(f'{exec_endpoint} failed')
+        endpoint = getattr(self.datastore, exec_endpoint.lstrip('/'))
+        yield await endpoint(docs=docs, parameters=parameters)
+
+
+EMBEDDINGS = {'near': [1.0, 0.0], 'mid': [1.0, 1.0], 'far': [-1.0, 0.1]}
+
+
+def create_gateway(datastore):
+    """Create a gateway without the jina runtime, which embeds with a fake OpenAI client and queries datastore."""
+    create_embeddings = AsyncMock(side_effect=lambda texts: [EMBEDDINGS[text] for text in texts])
+    with patch.object(gateway.FastAPIBaseGateway, '__init__', lambda self, **kwargs: None), patch.object(
+        gateway.AsyncEmbeddingClient, 'create_embeddings', create_embeddings
+    ), patch.dict(os.environ):
+        retrieval_gateway = gateway.RetrievalGateway(
+            bearer_token='token', openai_token='sk-test', processing_workers=0, prewarm_tokenizer=False
+        )
+    retrieval_gateway.streamer = StubStreamer(datastore)
+    return retrieval_gateway, create_embeddings
+
+
+async def close_gateway(retrieval_gateway):
+    # what the gateway's shutdown closes, without the jina runtime
+    await retrieval_gateway.jobs.close()
+    await retrieval_gateway.embedding_client.close()
+
+
+async def aiter_batches(batches):
+    for batch in batches:
+        yield batch
+
+
+def chunk_batch(ids):
+    return DocumentChunkBatch(
+        ids=[f'{id}_0' for id in ids],
+        texts=ids,
+        metadata=[{'document_id': id} for id in ids],
+        embeddings=np.array([EMBEDDINGS[id] for id in ids], dtype=np.float32),
+        num_tokens=[10] * len(ids),
+    )
+
+
+@unittest.skipUnless(HAS_JINA, 'the executor and the gateway need jina')
+class TestPackExecutorResults(unittest.TestCase):
+
+    def test_closest_chunks_are_kept(self):
+        with tempfile.TemporaryDirectory() as directory:
+            datastore = create_datastore(directory)
+            batch = DocumentChunkBatch(
+                ids=['far_0', 'near_0', 'mid_0'],
+                texts=['far', 'near', 'mid'],
+                metadata=[{}, {}, {}],
+                embeddings=np.array([[-1.0, 0.1], [1.0, 0.0], [1.0, 1.0]], dtype=np.float32),
+                num_tokens=[10, 10, 10],
+            )
+            datastore._index.extend(gateway.chunk_batch_to_da(batch))
+            query = gateway.query_to_doc(gateway.Query(query='near', top_k=3), [1.0, 0.0])
+            results = [gateway.doc_to_query_result(doc) for doc in datastore._query(DocumentArray([query]))]
+
+        # the executor returns cosine distances, the closest match first
+        self.assertEqual([chunk.id for chunk in results[0].results], ['near_0', 'mid_0', 'far_0'])
+        self.assertEqual(results[0].results[0].score, 0.0)
+        packed = pack_query_results(results, max_tokens=10)
+        self.assertEqual([chunk.id for chunk in packed[0].results], ['near_0'])
+        packed = pack_query_results(results, max_tokens=25)
+        self.assertEqual([chunk.id for chunk in packed[0].results], ['near_0', 'mid_0'])
+
+
+class GatewayTestCase(unittest.IsolatedAsyncioTestCase):
+
+    async def asyncSetUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.datastore = create_datastore(self.directory.name)
+        self.gateway, self.create_embeddings = create_gateway(self.datastore)
+
+    async def asyncTearDown(self):
+        await close_gateway(self.gateway)
+        self.directory.cleanup()
+
+    async def query(self, text):
+        results = await self.gateway.query_documents([gateway.Query(query=text, top_k=3)])
+        return [chunk.id for chunk in results[0].results]
+
+
+@unittest.skipUnless(HAS_JINA, 'the executor and the gateway need jina')
+class TestQueryEmbeddings(GatewayTestCase):
+
+    async def test_cached_embeddings_are_not_requested_again(self):
+        self.assertEqual(await self.gateway.get_query_embeddings(['near']), [EMBEDDINGS['near']])
+        self.assertEqual(await self.gateway.get_query_embeddings(['near']), [EMBEDDINGS['near']])
+        self.assertEqual(self.create_embeddings.call_count, 1)
+
+        texts = ['far', 'near', 'mid', 'far']
+        self.assertEqual(await self.gateway.get_query_embeddings(texts), [EMBEDDINGS[text] for text in texts])
+        # only the texts missing from the cache are embedded, once each
+        self.assertEqual(self.create_embeddings.call_count, 2)
+        self.assertEqual(self.create_embeddings.call_args.args, (['far', 'mid'],))
+
+
+@unittest.skipUnless(HAS_JINA, 'the executor and the gateway need jina')
+class TestQueryCache(GatewayTestCase):
+
+    async def test_results_are_cached_until_the_index_changes(self):
+        streamer = self.gateway.streamer
+        await self.gateway.perform_upsert_call(chunk_batch(['far']))
+
+        self.assertEqual(await self.query('near'), ['far_0'])
+        self.assertEqual(await self.query('near'), ['far_0'])
+        self.assertEqual(streamer.endpoints, ['/upsert', '/query'])
+        self.assertEqual(self.create_embeddings.call_count, 1)
+
+        await self.gateway.perform_upsert_call(chunk_batch(['near']))
+        self.assertEqual(await self.query('near'), ['near_0', 'far_0'])
+        self.assertEqual(streamer.endpoints, ['/upsert', '/query', '/upsert', '/query'])
+        # the query embedding is still cached, only the results depend on the index
+        self.assertEqual(self.create_embeddings.call_count, 1)
+
+        self.assertTrue(await self.gateway.perform_delete_call(ids=['far_0']))
+        self.assertEqual(await self.query('near'), ['near_0'])
+        self.assertEqual(streamer.endpoints[-2:], ['/delete', '/query'])
+        self.assertEqual(self.create_embeddings.call_count, 1)
+
+    async def test_changes_reported_by_the_executor_invalidate_results(self):
+        await self.gateway.perform_upsert_call(chunk_batch(['far']))
+        self.assertEqual(await self.query('near'), ['far_0'])
+
+        # another gateway replica changes the index, this one learns about it from its next query to the executor
+        other_gateway, _ = create_gateway(self.datastore)
+        await other_gateway.perform_upsert_call(chunk_batch(['near']))
+        await close_gateway(other_gateway)
+        self.assertEqual(await self.query('near'), ['far_0'])
+        self.assertEqual(await self.query('mid'), ['near_0', 'far_0'])
+        self.assertEqual(await self.query('near'), ['near_0', 'far_0'])
+        self.assertEqual(self.gateway.streamer.endpoints, ['/upsert', '/query', '/query', '/query'])
+        self.assertEqual(self.create_embeddings.call_count, 2)
+
+
+@unittest.skipUnless(HAS_JINA, 'the executor and the gateway need jina')
+class TestUpsertChunkBatches(GatewayTestCase):
+
+    async def test_index_is_saved_once(self):
+        batches = [chunk_batch(['far']), chunk_batch(['near']), chunk_batch(['mid'])]
+        response = await self.gateway.upsert_chunk_batches(aiter_batches(batches))
+
+        self.assertEqual(response.ids, ['far_0', 'near_0', 'mid_0'])
+        self.assertEqual(self.gateway.streamer.endpoints, ['/upsert', '/upsert', '/upsert', '/save'])
+        # the executor saves and bumps its generation only for /save
+        self.assertEqual(self.datastore._generation, 1)
+        self.assertTrue(os.path.exists(self.datastore._index_file_path))
+
+    async def test_failed_save_invalidates_results(self):
+        await self.gateway.perform_upsert_call(chunk_batch(['far']))
+        self.assertEqual(await self.query('near'), ['far_0'])
+        self.gateway.streamer.failing_endpoints.add('/save')
+        with self.assertRaises(ConnectionError):
+            await self.gateway.upsert_chunk_batches(aiter_batches([chunk_batch(['near'])]))
+
+        # the executor indexed the batch, which queries find although it wasn't saved
+        self.assertEqual(await self.query('near'), ['near_0', 'far_0'])
+        self.assertEqual(self.gateway.streamer.endpoints, ['/upsert', '/query', '/upsert', '/save', '/query'])
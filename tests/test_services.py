@@ -0,0 +1,950 @@
+import asyncio
+import base64
+import gzip
+import io
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ProcessPoolExecutor
+from unittest.mock import AsyncMock, MagicMock, patch
+
+import httpx
+import numpy as np
+from fastapi import FastAPI, Request, UploadFile
+from starlette.datastructures import Headers
+
+from goldretriever.models.api import QueryResponse
+from goldretriever.models.models import (
+    Document,
+    DocumentChunk,
+    DocumentChunkBatch,
+    DocumentChunkMetadata,
+    DocumentChunkWithScore,
+    DocumentMetadata,
+    DocumentMetadataFilter,
+    JobStatus,
+    Query,
+    QueryResult,
+    Source,
+)
+from goldretriever.services import chunks as chunks_module
+from goldretriever.services.admission import AdmissionLimiter, AdmissionMiddleware, AdmissionRejectedError
+from goldretriever.services.batching import EmbeddingBatcher
+from goldretriever.services.cache import (
+    EmbeddingCache,
+    LRUCache,
+    PersistentEmbeddingCache,
+    QueryResultCache,
+    SemanticQueryCache,
+    normalize_query_text,
+)
+from goldretriever.services.chunks import (
+    aiter_in_executor,
+    aiter_upload_chunk_batches,
+    get_document_chunks,
+    iter_document_chunks,
+    iter_batch_slices,
+    validate_document_embeddings,
+)
+from goldretriever.services.compression import DECOMPRESSED_CHUNK_SIZE, DecompressionMiddleware
+from goldretriever.services.file import extract_text_from_filepath, iter_text_from_file
+from goldretriever.services.hedging import CircuitBreaker, CircuitOpenError, HedgedEmbedder
+from goldretriever.services.jobs import JobManager, JobQueueFullError
+from goldretriever.services.openai import AsyncEmbeddingClient
+from goldretriever.services.packing import pack_query_results
+from goldretriever.services.pipelining import process_pipelined
+from goldretriever.services.profiling import ProfilerBusyError, _profile_lock, profile
+from goldretriever.services.scheduling import RateLimitScheduler
+from goldretriever.services.serialization import encode_query_response
+from goldretriever.services.stream import iter_ndjson_documents
+from goldretriever.services.tracing import (
+    TRACE_CONTEXT_PARAMETER,
+    create_file_tracer,
+    start_span,
+    trace_parameters,
+)
+from tests.benchmark_chunks import WordTokenizer, previous_get_text_chunks, random_text
+
+try:
+    import opentelemetry.sdk
+except ImportError:
+    opentelemetry = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+def use_word_tokenizer():
+    # the tokenizer of the worker processes, which can't be patched from the test
+    tokenizer = WordTokenizer()
+    chunks_module.get_tokenizer = lambda: tokenizer
+
+
+class TestCache(unittest.TestCase):
+
+    def test_lru_eviction(self):
+        cache = LRUCache(maxsize=2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+        cache.put('c', 3)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.info()['hits'], 3)
+        self.assertEqual(cache.info()['misses'], 1)
+
+    def test_ttl_expiry(self):
+        cache = LRUCache(maxsize=2, ttl=10)
+        with patch('goldretriever.services.cache.time.monotonic', return_value=100):
+            cache.put('a', 1)
+        with patch('goldretriever.services.cache.time.monotonic', return_value=105):
+            self.assertEqual(cache.get('a'), 1)
+        with patch('goldretriever.services.cache.time.monotonic', return_value=111):
+            self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 0)
+
+    def test_embedding_cache(self):
+        self.assertEqual(normalize_query_text('  Blue   Color\n'), 'Blue Color')
+        cache = EmbeddingCache()
+        cache.put_many(['Blue color'], [[0.1, 0.2]], 'model-a')
+        embeddings, missing = cache.get_many([' Blue  color', 'red', 'BLUE COLOR'], 'model-a')
+        self.assertEqual(embeddings, [[0.1, 0.2], None, None])
+        self.assertEqual(missing, [1, 2])
+        _, missing = cache.get_many(['blue color'], 'model-b')
+        self.assertEqual(missing, [0])
+
+    def test_persistent_embedding_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'embeddings.db')
+            cache = PersistentEmbeddingCache(path)
+            cache.put_many(['a', 'b'], np.array([[1.0, 2.0], [3.0, 4.0]]), 'model-a')
+            embeddings, missing = cache.get_many(['a', 'c', 'b'], 'model-a')
+            self.assertEqual(missing, [1])
+            np.testing.assert_array_equal(embeddings[2], [3.0, 4.0])
+            self.assertEqual(cache.get_many(['a'], 'model-b')[1], [0])
+            cache.close()
+
+            # the embeddings outlive the process, and the least recently used are evicted beyond max_bytes
+            cache = PersistentEmbeddingCache(path, max_bytes=3 * 8 + 4, access_resolution=0)
+            self.assertEqual(cache.info()['size'], 2)
+            cache.get_many(['a'], 'model-a')
+            cache.put_many(['c', 'd'], [[5.0, 6.0], [7.0, 8.0]], 'model-a')
+            self.assertEqual(cache.get_many(['a', 'b', 'c', 'd'], 'model-a')[1], [1])
+            self.assertEqual(cache.info()['bytes'], 3 * 8)
+            cache.close()
+
+    def test_persistent_embedding_cache_size_is_shared(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'embeddings.db')
+            # e.g. the gateway and an ingestion script, each adding less than the maximum size
+            first = PersistentEmbeddingCache(path, max_bytes=3 * 8 + 4)
+            second = PersistentEmbeddingCache(path, max_bytes=3 * 8 + 4)
+            first.put_many(['a', 'b'], [[1.0, 2.0], [3.0, 4.0]], 'model-a')
+            second.put_many(['c', 'd'], [[5.0, 6.0], [7.0, 8.0]], 'model-a')
+            self.assertEqual(len(first.get_many(['a', 'b', 'c', 'd'], 'model-a')[1]), 1)
+            self.assertEqual((first.info()['size'], first.info()['bytes']), (3, 3 * 8))
+            self.assertEqual((first.info()['hits'], first.info()['misses']), (3, 1))
+            first.close()
+            second.close()
+
+    def test_persistent_embedding_cache_lookups_dont_write(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'embeddings.db')
+            cache = PersistentEmbeddingCache(path, access_resolution=0)
+            cache.put_many(['a'], [[1.0]], 'model-a')
+            reader = sqlite3.connect(path)
+            key = PersistentEmbeddingCache._key('a', 'model-a')
+
+            def accessed_at():
+                return reader.execute('SELECT accessed_at FROM embeddings WHERE key = ?', (key,)).fetchone()[0]
+
+            # hits are recorded in the transaction of the next put, or on close
+            put_at = accessed_at()
+            cache.get_many(['a'], 'model-a')
+            self.assertEqual(accessed_at(), put_at)
+            cache.put_many(['b'], [[2.0]], 'model-a')
+            hit_at = accessed_at()
+            self.assertGreater(hit_at, put_at)
+
+            # and only if the last recorded access is older than the resolution
+            cache.access_resolution = 60
+            cache.get_many(['a'], 'model-a')
+            cache.close()
+            self.assertEqual(accessed_at(), hit_at)
+            reader.close()
+
+    def test_query_result_cache(self):
+        cache = QueryResultCache()
+        query = Query(query='blue', filter=DocumentMetadataFilter(author='me'), top_k=2)
+        cache.put_result(query, QueryResult(query='blue', results=[]), generation=1)
+
+        result = cache.get_result(Query(query=' blue ', filter=DocumentMetadataFilter(author='me'), top_k=2), 1)
+        self.assertEqual(result.query, ' blue ')
+        self.assertIsNone(cache.get_result(Query(query='Blue', filter=DocumentMetadataFilter(author='me'), top_k=2), 1))
+        self.assertIsNone(cache.get_result(query, generation=2))
+        self.assertIsNone(cache.get_result(Query(query='blue', top_k=2), generation=1))
+        self.assertIsNone(
+            cache.get_result(Query(query='blue', filter=DocumentMetadataFilter(author='me'), top_k=3), 1)
+        )
+        self.assertEqual(cache.info()['hits'], 1)
+
+    def test_semantic_query_cache(self):
+        cache = SemanticQueryCache(threshold=0.95, maxsize=2)
+        cache.put_result(Query(query='Q3 revenue'), [1.0, 0.0], QueryResult(query='Q3 revenue', results=[]), 1)
+
+        result = cache.get_result(Query(query='revenue in Q3'), [0.99, 0.05], 1)
+        self.assertEqual(result.query, 'revenue in Q3')
+        self.assertIsNone(cache.get_result(Query(query='Q3 costs'), [0.6, 0.8], 1))
+        self.assertIsNone(cache.get_result(Query(query='revenue in Q3'), [0.99, 0.05], 2))
+        self.assertIsNone(cache.get_result(Query(query='revenue in Q3', top_k=5), [0.99, 0.05], 1))
+
+        cache.put_result(Query(query='a'), [0.0, 1.0], QueryResult(query='a', results=[]), 1)
+        cache.put_result(Query(query='b'), [0.0, -1.0], QueryResult(query='b', results=[]), 1)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get_result(Query(query='Q3 revenue'), [1.0, 0.0], 1))
+        self.assertEqual(cache.info()['hits'], 1)
+
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertIsNone(cache.get_result(Query(query='a'), [0.0, 1.0], 1))
+        cache.put_result(Query(query='c'), [1.0, 1.0], QueryResult(query='c', results=[]), 1)
+        self.assertIsNone(cache.get_result(Query(query='b'), [0.0, -1.0], 1))
+        self.assertEqual(cache.get_result(Query(query='c'), [1.0, 1.0], 1).query, 'c')
+
+
+class TestModels(unittest.TestCase):
+
+    def test_document_chunk_batch(self):
+        metadata = DocumentChunkMetadata(document_id='doc', author='me')
+        chunks = [
+            DocumentChunk(id=f'doc_{i}', text=f'text {i}', metadata=metadata, embedding=[float(i), 1.0])
+            for i in range(3)
+        ]
+        batch = DocumentChunkBatch.from_chunks(chunks)
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.embeddings.dtype.name, 'float32')
+        self.assertEqual(batch.metadata[2]['author'], 'me')
+
+        tail = batch[1:]
+        self.assertEqual(tail.ids, ['doc_1', 'doc_2'])
+        self.assertEqual(tail.embeddings.tolist(), [[1.0, 1.0], [2.0, 1.0]])
+
+
+class TestSerialization(unittest.TestCase):
+
+    def test_encode_query_response(self):
+        chunk = DocumentChunkWithScore.construct(
+            id='doc_0', text='blue', score=0.5, embedding=None,
+            metadata=DocumentChunkMetadata.construct(document_id='doc', source='file'),
+        )
+        results = [QueryResult.construct(query='color', results=[chunk])]
+
+        content, media_type = encode_query_response(results)
+        self.assertEqual(media_type, 'application/json')
+        response = QueryResponse.parse_raw(content)
+        self.assertEqual(response.results[0].results[0].metadata.document_id, 'doc')
+
+        content, _ = encode_query_response(results, fields=['id', 'score'])
+        self.assertEqual(
+            json.loads(content), {'results': [{'query': 'color', 'results': [{'id': 'doc_0', 'score': 0.5}]}]}
+        )
+
+
+class TestTextChunks(unittest.TestCase):
+
+    def test_get_text_chunks_matches_previous_chunker(self):
+        tokenizer = WordTokenizer()
+        with patch.object(chunks_module, 'get_tokenizer', return_value=tokenizer):
+            for seed in range(5):
+                text = random_text(20000, seed=seed)
+                for chunk_token_size in (None, 50, 500):
+                    self.assertEqual(
+                        chunks_module.get_text_chunks(text, chunk_token_size),
+                        previous_get_text_chunks(text, chunk_token_size, tokenizer),
+                    )
+
+
+class TestChunks(unittest.IsolatedAsyncioTestCase):
+
+    async def test_aembed_document_chunks_yields_batches(self):
+        client = AsyncEmbeddingClient()
+        chunks = DocumentChunkBatch(
+            ids=[str(i) for i in range(5)], texts=[str(i) for i in range(5)], metadata=[{}] * 5
+        )
+        get_embedding_matrix = AsyncMock(
+            side_effect=lambda texts, num_tokens=None: np.array([[float(text)] for text in texts], dtype=np.float32)
+        )
+        with patch.object(chunks_module, 'EMBEDDINGS_BATCH_SIZE', 2), patch.object(
+            client, 'get_embedding_matrix', new=get_embedding_matrix
+        ):
+            batches = [batch async for batch in chunks_module.aembed_document_chunks(chunks, client)]
+        self.assertEqual([len(batch) for batch in batches], [2, 2, 1])
+        self.assertEqual([batch.embeddings[:, 0].tolist() for batch in batches], [[0.0, 1.0], [2.0, 3.0], [4.0]])
+
+    async def test_iter_text_chunks_streams_pieces(self):
+        text = random_text(50000)
+        consumed = []
+
+        def pieces():
+            for line in text.splitlines(keepends=True):
+                consumed.append(line)
+                yield line
+
+        with patch.object(chunks_module, 'get_tokenizer', return_value=WordTokenizer()), patch.object(
+            chunks_module, 'STREAM_BUFFER_SIZE', 2000
+        ):
+            chunks = chunks_module.iter_text_chunks(pieces(), None)
+            next(chunks)
+            self.assertLess(len(''.join(consumed)), 5000)
+            document = Document(id='doc', text='')
+            batches = list(
+                chunks_module.iter_document_chunk_batches(
+                    chunks_module.iter_document_chunks(document, 'doc', None, [text[:25000], text[25000:]]), size=16
+                )
+            )
+        self.assertTrue(all(len(batch) == 16 for batch in batches[:-1]))
+        self.assertEqual(batches[0].ids[:2], ['doc_0', 'doc_1'])
+        self.assertEqual(len(batches[0].num_tokens), len(batches[0]))
+        # nothing is dropped from a text in many pieces
+        texts = [text for batch in batches for text in batch.texts]
+        self.assertEqual(''.join(''.join(texts).split()), ''.join(text.split()))
+
+    async def test_batches_are_embedded_concurrently_in_order(self):
+        client = AsyncEmbeddingClient()
+        in_flight = 0
+        max_in_flight = 0
+
+        async def get_embedding_matrix(texts, num_tokens=None):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            # earlier batches take longer, so that they finish out of order
+            await asyncio.sleep(0.01 * (10 - int(texts[0])))
+            in_flight -= 1
+            return np.array([[float(text)] for text in texts], dtype=np.float32)
+
+        chunks = DocumentChunkBatch(
+            ids=[str(i) for i in range(10)], texts=[str(i) for i in range(10)], metadata=[{}] * 10
+        )
+        with patch.object(chunks_module, 'EMBEDDINGS_BATCH_SIZE', 1), patch.object(
+            client, 'get_embedding_matrix', new=get_embedding_matrix
+        ):
+            batches = [
+                batch
+                async for batch in chunks_module.aembed_document_chunks(chunks, client, max_concurrent_batches=3)
+            ]
+        self.assertEqual([batch.embeddings[0, 0] for batch in batches], list(range(10)))
+        self.assertEqual(max_in_flight, 3)
+
+        documents = [Document(id=str(i), text=f'document number {i}') for i in range(10)]
+        with patch.object(chunks_module, 'EMBEDDINGS_BATCH_SIZE', 1), patch.object(
+            chunks_module, 'get_tokenizer', return_value=WordTokenizer()
+        ), patch.object(
+            chunks_module, 'get_embeddings', side_effect=lambda texts: [[float(texts[0].split()[-1])]]
+        ) as get_embeddings:
+            document_chunks = chunks_module.get_document_chunks(documents, None, max_concurrent_batches=4)
+        self.assertEqual(get_embeddings.call_count, 10)
+        self.assertEqual([document_chunks[str(i)][0].embedding for i in range(10)], [[float(i)] for i in range(10)])
+
+    async def test_cached_embeddings_are_not_requested_again(self):
+        client = AsyncEmbeddingClient(model='model-a')
+        get_embedding_matrix = AsyncMock(
+            side_effect=lambda texts, num_tokens=None: np.array([[float(text)] for text in texts], dtype=np.float32)
+        )
+        with tempfile.TemporaryDirectory() as directory, patch.object(
+            client, 'get_embedding_matrix', new=get_embedding_matrix
+        ):
+            cache = PersistentEmbeddingCache(os.path.join(directory, 'embeddings.db'))
+            cache.put_many(['1', '3'], [[1.0], [3.0]], 'model-a')
+            chunks = DocumentChunkBatch(
+                ids=[str(i) for i in range(4)], texts=[str(i) for i in range(4)], metadata=[{}] * 4, num_tokens=[1] * 4
+            )
+            batches = [
+                batch async for batch in chunks_module.aembed_document_chunks(chunks, client, embedding_cache=cache)
+            ]
+            get_embedding_matrix.assert_awaited_once_with(['0', '2'], 2)
+            self.assertEqual(batches[0].embeddings[:, 0].tolist(), [0.0, 1.0, 2.0, 3.0])
+            self.assertEqual(cache.get_many(['0', '2'], 'model-a')[1], [])
+            cache.close()
+
+    async def test_aiter_in_executor(self):
+        self.assertEqual([item async for item in aiter_in_executor(iter(range(3)))], [0, 1, 2])
+
+
+class TestPrecomputedEmbeddings(unittest.TestCase):
+
+    def test_documents_with_embeddings_are_not_embedded_again(self):
+        document = Document(id='doc', text='a long text ' * 200, embedding=[0.5] * 1536)
+        with patch('goldretriever.services.chunks.get_embeddings') as get_embeddings:
+            chunks = get_document_chunks([document], None)
+        get_embeddings.assert_not_called()
+        self.assertEqual([chunk.id for chunk in chunks['doc']], ['doc_0'])
+        self.assertEqual(chunks['doc'][0].embedding, document.embedding)
+        self.assertEqual(chunks['doc'][0].metadata.document_id, 'doc')
+
+    def test_validate_document_embeddings(self):
+        documents = [Document(text='a'), Document(text='b', embedding=[0.5] * 1536)]
+        validate_document_embeddings(documents, 'text-embedding-ada-002')
+        validate_document_embeddings(documents[:1], None)
+        with self.assertRaises(ValueError):
+            validate_document_embeddings(documents, None)
+        with self.assertRaises(ValueError):
+            validate_document_embeddings(documents, 'another-model')
+        with self.assertRaises(ValueError):
+            validate_document_embeddings([Document(text='c', embedding=[0.5] * 8)], 'text-embedding-ada-002')
+
+
+class TestPacking(unittest.TestCase):
+
+    def test_pack_query_results(self):
+        def chunk(id, score, num_tokens):
+            chunk = DocumentChunkWithScore.construct(
+                id=id, text=id, score=score, embedding=None, metadata=DocumentChunkMetadata.construct()
+            )
+            chunk._num_tokens = num_tokens
+            return chunk
+
+        results = [
+            QueryResult.construct(query='a', results=[chunk('a0', 0.1, 5), chunk('a1', 0.5, 1)]),
+            QueryResult.construct(query='b', results=[chunk('b0', 0.2, 4), chunk('b1', 0.3, 2)]),
+        ]
+        packed = pack_query_results(results, max_tokens=10)
+        self.assertEqual([[chunk.id for chunk in result.results] for result in packed], [['a0', 'a1'], ['b0']])
+        self.assertIs(pack_query_results(results, max_tokens=None), results)
+
+
+class TestPipelining(unittest.IsolatedAsyncioTestCase):
+
+    async def test_batches_are_upserted_while_later_ones_are_embedded(self):
+        events = []
+        in_flight = 0
+        max_in_flight = 0
+
+        async def embedded_batches():
+            for i in range(6):
+                await asyncio.sleep(0.01)
+                events.append(('embedded', i))
+                yield i
+
+        async def upsert(i):
+            nonlocal in_flight, max_in_flight
+            in_flight += 1
+            max_in_flight = max(max_in_flight, in_flight)
+            events.append(('upsert', i))
+            await asyncio.sleep(0.03)
+            in_flight -= 1
+            events.append(('upserted', i))
+            return i * 10
+
+        results = await process_pipelined(embedded_batches(), upsert, max_inflight=2)
+        self.assertEqual(results, [0, 10, 20, 30, 40, 50])
+        self.assertEqual(max_in_flight, 2)
+        # the first batch is upserted while the second one is embedded
+        self.assertLess(events.index(('upsert', 0)), events.index(('embedded', 1)))
+        self.assertLess(events.index(('embedded', 1)), events.index(('upserted', 0)))
+
+    async def test_failed_batch_cancels_the_others(self):
+        async def embedded_batches():
+            for i in range(3):
+                yield i
+
+        async def upsert(i):
+            if i == 1:
+                raise RuntimeError('executor failed')
+            await asyncio.sleep(10)
+
+        with self.assertRaises(RuntimeError):
+            await asyncio.wait_for(process_pipelined(embedded_batches(), upsert, max_inflight=2), 1)
+
+
+class TestAsyncEmbeddingClient(unittest.IsolatedAsyncioTestCase):
+
+    async def test_get_embedding_matrix(self):
+        client = AsyncEmbeddingClient()
+        vectors = np.array([[0.5, -1.0], [2.0, 0.25]], dtype=np.float32)
+        response = {'data': [{'embedding': base64.b64encode(vector.tobytes()).decode()} for vector in vectors]}
+        with patch('openai.Embedding.acreate', new=AsyncMock(return_value=response)) as acreate:
+            matrix = await client.get_embedding_matrix(['a', 'b'])
+        self.assertEqual(acreate.call_args.kwargs['encoding_format'], 'base64')
+        self.assertEqual(matrix.dtype, np.float32)
+        np.testing.assert_array_equal(matrix, vectors)
+        await client.close()
+
+    async def test_get_embeddings_reuses_session(self):
+        client = AsyncEmbeddingClient(model='model-a', timeout=5)
+        response = {'data': [{'embedding': [0.1]}, {'embedding': [0.2]}]}
+        with patch('openai.Embedding.acreate', new=AsyncMock(return_value=response)) as acreate:
+            self.assertEqual(await client.get_embeddings(['a', 'b']), [[0.1], [0.2]])
+            session = client._session
+            await client.get_embeddings(['c'])
+        self.assertIs(client._session, session)
+        self.assertEqual(acreate.call_args.kwargs['model'], 'model-a')
+        self.assertEqual(acreate.call_args.kwargs['request_timeout'], 5)
+        await client.close()
+        self.assertTrue(session.closed)
+
+    async def test_requests_are_scheduled(self):
+        scheduler = RateLimitScheduler(tokens_per_minute=60000)
+        client = AsyncEmbeddingClient(scheduler=scheduler)
+        response = {'data': [{'embedding': [0.1]}]}
+        with patch('openai.Embedding.acreate', new=AsyncMock(return_value=response)):
+            await client.get_embedding_matrix(['a'], num_tokens=7)
+            await client.create_embeddings(['abcdefgh'])
+        self.assertEqual(scheduler.info()['requests'], 2)
+        self.assertEqual(scheduler.info()['tokens'], 7 + 3)
+        await client.close()
+
+
+class TestRateLimitScheduler(unittest.TestCase):
+
+    def test_requests_are_paced_to_the_limits(self):
+        now = [100.0]
+        with patch('goldretriever.services.scheduling.time.monotonic', side_effect=lambda: now[0]):
+            scheduler = RateLimitScheduler(requests_per_minute=600, tokens_per_minute=60000, burst_seconds=1)
+            # one second of each budget is available right away
+            self.assertEqual(scheduler.reserve(500), 0)
+            self.assertEqual(scheduler.reserve(500), 0)
+            # the tokens budget refills at 1000 tokens per second, and reservations queue up behind each other
+            self.assertAlmostEqual(scheduler.reserve(1000), 1.0)
+            self.assertAlmostEqual(scheduler.reserve(1000), 2.0)
+            now[0] += 2.0
+            self.assertAlmostEqual(scheduler.reserve(0), 0.0)
+            now[0] += 10.0
+            # the requests budget holds 10 requests
+            delays = [scheduler.reserve(1) for _ in range(12)]
+        self.assertEqual(delays[:10], [0.0] * 10)
+        self.assertAlmostEqual(delays[11], 0.2)
+        self.assertEqual(scheduler.info()['delayed'], 4)
+
+    def test_batches_are_packed_by_tokens(self):
+        self.assertEqual(
+            list(iter_batch_slices(5, [10, 10, 30, 5, 5], size=3, max_tokens=25)),
+            [slice(0, 2), slice(2, 3), slice(3, 5)],
+        )
+        self.assertEqual(list(iter_batch_slices(5, size=2)), [slice(0, 2), slice(2, 4), slice(4, 5)])
+
+
+class TestEmbeddingBatcher(unittest.IsolatedAsyncioTestCase):
+
+    async def test_concurrent_requests_share_a_batch(self):
+        calls = []
+
+        async def get_embeddings(texts):
+            calls.append(texts)
+            return [[float(len(text))] for text in texts]
+
+        batcher = EmbeddingBatcher(get_embeddings, max_wait=0.01, max_batch_size=10)
+        results = await asyncio.gather(
+            batcher.get_embeddings(['a', 'bb']),
+            batcher.get_embeddings(['bb', 'ccc']),
+            batcher.get_embeddings(['a']),
+        )
+        self.assertEqual(results, [[[1.0], [2.0]], [[2.0], [3.0]], [[1.0]]])
+        self.assertEqual(calls, [['a', 'bb', 'ccc']])
+        self.assertEqual(batcher.info()['deduplicated'], 2)
+
+    async def test_batch_size_limit_and_errors(self):
+        calls = []
+
+        async def get_embeddings(texts):
+            calls.append(texts)
+            raise RuntimeError('upstream failed')
+
+        batcher = EmbeddingBatcher(get_embeddings, max_wait=10, max_batch_size=2)
+        with self.assertRaises(RuntimeError):
+            await batcher.get_embeddings(['a', 'b'])
+        self.assertEqual(calls, [['a', 'b']])
+
+    async def test_cancelled_batch_does_not_hang(self):
+        async def get_embeddings(texts):
+            raise asyncio.CancelledError()
+
+        batcher = EmbeddingBatcher(get_embeddings, max_wait=0.001)
+        with self.assertRaises(asyncio.CancelledError):
+            await asyncio.wait_for(batcher.get_embeddings(['a']), 1)
+        self.assertEqual(batcher._in_flight, {})
+
+
+class TestHedgedEmbedder(unittest.IsolatedAsyncioTestCase):
+
+    async def test_slow_request_is_hedged(self):
+        delays = [1.0, 0.0]
+
+        async def get_embeddings(texts):
+            await asyncio.sleep(delays.pop(0))
+            return [[1.0] for _ in texts]
+
+        embedder = HedgedEmbedder(get_embeddings, max_attempts=2, initial_hedge_delay=0.01)
+        self.assertEqual(await asyncio.wait_for(embedder.get_embeddings(['a']), 0.5), [[1.0]])
+        self.assertEqual(embedder.info()['hedged'], 1)
+        self.assertEqual(embedder.info()['hedges_won'], 1)
+
+    async def test_circuit_breaker_fails_fast_and_falls_back(self):
+        calls = []
+
+        async def get_embeddings(texts):
+            calls.append(texts)
+            raise RuntimeError('upstream failed')
+
+        async def fallback(texts):
+            return [[0.0] for _ in texts]
+
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        embedder = HedgedEmbedder(get_embeddings, max_attempts=2, circuit_breaker=breaker)
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                await embedder.get_embeddings(['a'])
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(breaker.state, 'open')
+        with self.assertRaises(CircuitOpenError):
+            await embedder.get_embeddings(['a'])
+        self.assertEqual(len(calls), 4)
+
+        embedder = HedgedEmbedder(get_embeddings, circuit_breaker=breaker, fallback=fallback)
+        self.assertEqual(await embedder.get_embeddings(['a']), [[0.0]])
+
+        breaker.opened_at -= 60
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.state, 'closed')
+
+    async def test_cancelled_trial_releases_the_circuit(self):
+        async def get_embeddings(texts):
+            await asyncio.sleep(10)
+
+        breaker = CircuitBreaker(failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        breaker.opened_at -= 60
+        embedder = HedgedEmbedder(get_embeddings, circuit_breaker=breaker)
+        trial = asyncio.ensure_future(embedder.get_embeddings(['a']))
+        await asyncio.sleep(0)
+        self.assertFalse(breaker.allow_request())
+        trial.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await trial
+        self.assertEqual(breaker.state, 'half-open')
+        self.assertTrue(breaker.allow_request())
+
+
+class TestFile(unittest.IsolatedAsyncioTestCase):
+
+    @staticmethod
+    def _upload(path, content_type=None, max_size=1024):
+        spool = tempfile.SpooledTemporaryFile(max_size=max_size)
+        with open(path, 'rb') as f:
+            spool.write(f.read())
+        headers = Headers({'content-type': content_type}) if content_type else None
+        return UploadFile(file=spool, filename=path.split('/')[-1], headers=headers)
+
+    async def test_upload_is_chunked_in_a_worker_process(self):
+        txt_path = 'tests/resources/text_data/test.txt'
+        document = Document(id='doc', text='', metadata=DocumentMetadata(source=Source.file))
+        with open(txt_path) as f:
+            with patch.object(chunks_module, 'get_tokenizer', return_value=WordTokenizer()):
+                expected = [chunk.text for chunk in iter_document_chunks(document, 'doc', None, [f.read()])]
+        context = multiprocessing.get_context('spawn')
+        pool = ProcessPoolExecutor(1, mp_context=context, initializer=use_word_tokenizer)
+        with pool, context.Manager() as manager:
+            batches = [
+                batch
+                async for batch in aiter_upload_chunk_batches(
+                    self._upload(txt_path), 'text/plain', document, pool, manager
+                )
+            ]
+            self.assertEqual([text for batch in batches for text in batch.texts], expected)
+            self.assertEqual(batches[0].ids[0], 'doc_0')
+
+            with self.assertRaises(ValueError):
+                async for _ in aiter_upload_chunk_batches(self._upload(txt_path), 'image/png', document, pool, manager):
+                    pass
+
+    @unittest.skipUnless(os.path.isdir('/proc/self/fd'), 'uploads are shared through /proc')
+    async def test_upload_is_not_copied_for_the_worker_process(self):
+        txt_path = 'tests/resources/text_data/test.txt'
+        document = Document(id='doc', text='', metadata=DocumentMetadata(source=Source.file))
+        with open(txt_path) as f:
+            with patch.object(chunks_module, 'get_tokenizer', return_value=WordTokenizer()):
+                expected = [chunk.text for chunk in iter_document_chunks(document, 'doc', None, [f.read()])]
+        context = multiprocessing.get_context('spawn')
+        pool = ProcessPoolExecutor(1, mp_context=context, initializer=use_word_tokenizer)
+        copy = AsyncMock(side_effect=AssertionError('the upload was copied'))
+        with pool, context.Manager() as manager, patch.object(chunks_module, 'write_form_file_to_temp_file', copy):
+            # an upload spooled to disk, and one still held in memory
+            for max_size in (16, 1024):
+                upload = self._upload(txt_path, max_size=max_size)
+                batches = [
+                    batch async for batch in aiter_upload_chunk_batches(upload, 'text/plain', document, pool, manager)
+                ]
+                self.assertEqual([text for batch in batches for text in batch.texts], expected)
+
+    async def test_iter_text_from_file(self):
+        self.assertEqual(list(iter_text_from_file(io.BytesIO(b'a,b\nc,d\n'), 'text/csv')), ['a b\n', 'c d\n'])
+        txt_path = 'tests/resources/text_data/test.txt'
+        with open(txt_path, 'rb') as f:
+            self.assertEqual(''.join(iter_text_from_file(f, 'text/plain')), extract_text_from_filepath(txt_path))
+
+
+class TestStream(unittest.IsolatedAsyncioTestCase):
+
+    async def test_iter_ndjson_documents(self):
+        async def stream():
+            yield b'{"id": "a", "text": "first"}\n{"text": "sec'
+            yield b'ond", "metadata": {"author": "me"}}\n\n'
+            yield b'{"id": "c"}\n{"text": "last"}'
+
+        parsed = [item async for item in iter_ndjson_documents(stream())]
+        self.assertEqual([line for line, _ in parsed], [1, 2, 4, 5])
+        self.assertEqual(parsed[0][1].id, 'a')
+        self.assertEqual(parsed[1][1].text, 'second')
+        self.assertEqual(parsed[1][1].metadata.author, 'me')
+        self.assertIsInstance(parsed[2][1], str)
+        self.assertEqual(parsed[3][1].text, 'last')
+
+    async def test_long_lines_are_rejected(self):
+        async def stream():
+            yield b'{"id": "a", "text": "' + b'x' * 20
+            yield b'x' * 20 + b'"}\n{"id": "b"'
+            yield b', "text": "short"}\n{"id": "c", "text": "' + b'y' * 50
+
+        parsed = [item async for item in iter_ndjson_documents(stream(), max_line_size=40)]
+        self.assertEqual([line for line, _ in parsed], [1, 2, 3])
+        self.assertEqual(parsed[0][1], 'line is longer than the maximum of 40 bytes')
+        self.assertEqual(parsed[1][1].text, 'short')
+        self.assertEqual(parsed[2][1], 'line is longer than the maximum of 40 bytes')
+
+
+class TestAdmission(unittest.IsolatedAsyncioTestCase):
+
+    async def test_limiter_rejects_when_queue_is_full(self):
+        limiter = AdmissionLimiter('ingest', max_concurrency=1, max_queued=1)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        with self.assertRaises(AdmissionRejectedError):
+            await limiter.acquire()
+        limiter.release()
+        await waiting
+        limiter.release()
+        info = limiter.info()
+        self.assertEqual((info['admitted'], info['rejected'], info['active'], info['queued']), (2, 1, 0, 0))
+        self.assertGreater(info['queue_wait_max'], 0)
+
+        limiter = AdmissionLimiter('query', max_concurrency=1, max_queued=1, queue_timeout=0.01)
+        await limiter.acquire()
+        with self.assertRaises(AdmissionRejectedError):
+            await limiter.acquire()
+
+    async def test_cancelled_request_gives_back_its_slot(self):
+        limiter = AdmissionLimiter('query', max_concurrency=1, max_queued=1, queue_timeout=10)
+        await limiter.acquire()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # the slot is handed to the waiting request, which is cancelled before it resumes
+        limiter.release()
+        await asyncio.sleep(0)
+        waiting.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            await waiting
+        await asyncio.wait_for(limiter.acquire(), 1)
+        self.assertEqual((limiter.info()['active'], limiter.info()['admitted']), (1, 2))
+
+    async def test_timed_out_request_gives_back_its_slot(self):
+        limiter = AdmissionLimiter('query', max_concurrency=1, max_queued=1, queue_timeout=0.01)
+        await limiter.acquire()
+        loop = asyncio.get_running_loop()
+        waiting = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0)
+        # blocks the event loop past the timeout and the release, which then run in the same iteration
+        loop.call_later(0.011, limiter.release)
+        loop.call_soon(time.sleep, 0.03)
+        with self.assertRaises(AdmissionRejectedError):
+            await waiting
+        await asyncio.wait_for(limiter.acquire(), 1)
+        self.assertEqual((limiter.info()['active'], limiter.info()['rejected']), (1, 1))
+
+    async def test_middleware_returns_429_with_retry_after(self):
+        release = asyncio.Event()
+        app = FastAPI()
+
+        @app.post('/upsert')
+        async def upsert():
+            await release.wait()
+            return {}
+
+        @app.post('/query')
+        async def query():
+            return {}
+
+        limiter = AdmissionLimiter('ingest', max_concurrency=1, max_queued=0, retry_after=3)
+        app.add_middleware(AdmissionMiddleware, limiters={'/upsert': limiter})
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            slow = asyncio.ensure_future(client.post('/upsert'))
+            while limiter.num_active == 0:
+                await asyncio.sleep(0.01)
+            rejected = await client.post('/upsert')
+            self.assertEqual(rejected.status_code, 429)
+            self.assertEqual(rejected.headers['retry-after'], '3')
+            self.assertEqual((await client.post('/query')).status_code, 200)
+            release.set()
+            self.assertEqual((await slow).status_code, 200)
+        self.assertEqual(limiter.num_active, 0)
+
+
+class TestDecompression(unittest.IsolatedAsyncioTestCase):
+
+    async def test_middleware_decompresses_request_bodies(self):
+        app = FastAPI()
+
+        @app.post('/upsert')
+        async def upsert(request: Request):
+            chunks = [chunk async for chunk in request.stream()]
+            return {'size': sum(len(chunk) for chunk in chunks), 'encoding': request.headers.get('content-encoding')}
+
+        app.add_middleware(DecompressionMiddleware, paths=['/upsert'], max_size=10 ** 6)
+        body = b'{"text": "a long text"}\n' * 10000
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            response = await client.post('/upsert', content=gzip.compress(body), headers={'Content-Encoding': 'gzip'})
+            self.assertEqual(response.json(), {'size': len(body), 'encoding': None})
+            response = await client.post('/upsert', content=body)
+            self.assertEqual(response.json()['size'], len(body))
+
+            response = await client.post(
+                '/upsert', content=gzip.compress(body)[:100], headers={'Content-Encoding': 'gzip'}
+            )
+            self.assertEqual(response.status_code, 400)
+            response = await client.post(
+                '/upsert', content=gzip.compress(body * 10), headers={'Content-Encoding': 'gzip'}
+            )
+            self.assertEqual(response.status_code, 400)
+            response = await client.post('/upsert', content=body, headers={'Content-Encoding': 'br'})
+            self.assertEqual(response.status_code, 415)
+
+    @unittest.skipIf(zstandard is None, 'zstd needs the zstandard package')
+    async def test_zstd_bodies_are_decompressed_in_bounded_pieces(self):
+        app = FastAPI()
+
+        @app.post('/upsert')
+        async def upsert(request: Request):
+            sizes = [len(chunk) async for chunk in request.stream()]
+            return {'size': sum(sizes), 'largest': max(sizes)}
+
+        app.add_middleware(DecompressionMiddleware, paths=['/upsert'], max_size=10 ** 7)
+        body = b'\0' * (5 * DECOMPRESSED_CHUNK_SIZE)
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url='http://test') as client:
+            compressed = zstandard.ZstdCompressor().compress(body)
+            response = await client.post('/upsert', content=compressed, headers={'Content-Encoding': 'zstd'})
+            self.assertEqual(response.json(), {'size': len(body), 'largest': DECOMPRESSED_CHUNK_SIZE})
+
+            # a few kilobytes that would inflate to 100 MB are rejected before they are held in memory
+            bomb = zstandard.ZstdCompressor().compress(b'\0' * 10 ** 8)
+            response = await client.post('/upsert', content=bomb, headers={'Content-Encoding': 'zstd'})
+            self.assertEqual(response.status_code, 400)
+
+
+class TestTracing(unittest.TestCase):
+
+    def test_spans_are_optional(self):
+        with start_span(None, 'disabled'):
+            pass
+        tracer = MagicMock()
+        with start_span(tracer, 'embed_queries', num_queries=2):
+            pass
+        tracer.start_as_current_span.assert_called_once_with('embed_queries', attributes={'num_queries': 2})
+
+        carrier = {'traceparent': '00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01'}
+        with patch('goldretriever.services.tracing.propagate') as propagate:
+            propagate.inject.side_effect = lambda c: c.update(carrier)
+            parameters = trace_parameters({'delete_all': True})
+        self.assertEqual(parameters, {'delete_all': True, TRACE_CONTEXT_PARAMETER: carrier})
+
+    @unittest.skipIf(opentelemetry is None, 'needs the opentelemetry-sdk package')
+    def test_file_tracer(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'traces.jsonl')
+            tracer, close = create_file_tracer(path, 'gateway')
+            with tracer.start_as_current_span('query_documents'):
+                pass
+            close()
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+        self.assertEqual([span['name'] for span in spans], ['query_documents'])
+
+    def test_file_tracer_needs_the_sdk(self):
+        with patch.dict(sys.modules, {'opentelemetry.sdk.trace': None}):
+            with self.assertRaisesRegex(ImportError, 'opentelemetry-sdk'):
+                create_file_tracer(os.devnull, 'gateway')
+
+
+class TestProfiling(unittest.TestCase):
+
+    def test_profile(self):
+        def busy_loop(stop):
+            while not stop.is_set():
+                sum(range(1000))
+
+        stop = threading.Event()
+        thread = threading.Thread(target=busy_loop, args=(stop,), name='busy')
+        thread.start()
+        try:
+            folded = profile(0.1, interval=0.005)
+        finally:
+            stop.set()
+            thread.join()
+        lines = folded.splitlines()
+        self.assertTrue(lines)
+        for line in lines:
+            stack, count = line.rsplit(' ', 1)
+            self.assertGreater(int(count), 0)
+        self.assertTrue(any(line.startswith('thread busy;') and 'busy_loop' in line for line in lines))
+
+        self.assertIsInstance(profile(0.01, kind='memory'), str)
+
+    def test_invalid_or_concurrent_profiles(self):
+        with self.assertRaises(ValueError):
+            profile(0)
+        with self.assertRaises(ValueError):
+            profile(1, kind='wall')
+        with _profile_lock:
+            with self.assertRaises(ProfilerBusyError):
+                profile(0.01)
+
+
+class TestJobManager(unittest.IsolatedAsyncioTestCase):
+
+    async def test_jobs_report_progress_and_failures(self):
+        async def process_batch(documents):
+            if any(document.text == 'bad' for document in documents):
+                raise RuntimeError('executor failed')
+
+        jobs = JobManager(process_batch, num_workers=1, max_queued_jobs=1, batch_size=2)
+        job = jobs.submit([Document(text=text) for text in ['a', 'b', 'bad', 'c', 'd']])
+        self.assertEqual(jobs.get(job.id).status, JobStatus.queued)
+        with self.assertRaises(JobQueueFullError):
+            jobs.submit([Document(text='e')])
+
+        while jobs.get(job.id).finished_at is None:
+            await asyncio.sleep(0.01)
+        job = jobs.get(job.id)
+        self.assertEqual(job.status, JobStatus.failed)
+        self.assertEqual(job.num_processed, 3)
+        self.assertEqual(job.num_failed, 2)
+        self.assertEqual(len(job.errors), 1)
+        await jobs.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+import importlib.util
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import unittest
+
+# The import plus readiness time budget of the gateway services, in seconds
+STARTUP_BUDGET = 3.0
+
+# The time budget from importing the gateway until it answers its first request, in seconds.
+# It includes jina starting the gateway in a process of its own
+GATEWAY_READINESS_BUDGET = 10.0
+
+REPOSITORY_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+GATEWAY_ROOT = os.path.join(REPOSITORY_ROOT, 'goldretriever')
+
+# Modules that are only needed for ingestion, and must not be loaded before the first file or text is processed
+LAZY_MODULES = ['tiktoken', 'PyPDF2', 'docx2txt', 'pptx']
+
+STARTUP_SCRIPT = '''
+import json
+import sys
+import time
+
+start = time.perf_counter()
+from goldretriever.models.api import QueryRequest, UpsertRequest
+from goldretriever.services.admission import AdmissionLimiter
+from goldretriever.services.batching import EmbeddingBatcher
+from goldretriever.services.cache import EmbeddingCache, QueryResultCache, SemanticQueryCache
+from goldretriever.services.chunks import aembed_document_chunks, get_document_chunk_batches
+from goldretriever.services.file import guess_mimetype, iter_text_from_file
+from goldretriever.services.hedging import HedgedEmbedder
+from goldretriever.services.jobs import JobManager
+from goldretriever.services.openai import AsyncEmbeddingClient
+from goldretriever.services.packing import pack_query_results
+from goldretriever.services.serialization import encode_query_response
+from goldretriever.services.stream import iter_ndjson_documents
+
+# the state the gateway sets up before serving its first query
+client = AsyncEmbeddingClient()
+EmbeddingBatcher(HedgedEmbedder(client.create_embeddings).get_embeddings)
+EmbeddingCache()
+QueryResultCache()
+SemanticQueryCache()
+AdmissionLimiter("query", max_concurrency=1, max_queued=1)
+JobManager(None)
+elapsed = time.perf_counter() - start
+
+print(json.dumps({"seconds": elapsed, "modules": sorted(sys.modules)}))
+'''
+
+GATEWAY_STARTUP_SCRIPT = '''
+import json
+import sys
+import time
+import urllib.request
+
+start = time.perf_counter()
+import gateway
+modules = sorted(sys.modules)
+
+from jina import Flow
+
+port = int(sys.argv[1])
+flow = Flow(protocol="http", port=port).config_gateway(
+    uses="RetrievalGateway",
+    py_modules=[gateway.__file__],
+    uses_with={"bearer_token": "token", "processing_workers": 1},
+)
+with flow:
+    request = urllib.request.Request(
+        f"http://127.0.0.1:{port}/stats", headers={"Authorization": "Bearer token"}
+    )
+    status = urllib.request.urlopen(request).status
+    elapsed = time.perf_counter() - start
+
+print(json.dumps({"seconds": elapsed, "status": status, "modules": modules}))
+'''
+
+
+def get_free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_startup_budget(self):
+        # a fresh interpreter, so that no module is imported already
+        output = subprocess.run(
+            [sys.executable, '-c', STARTUP_SCRIPT], capture_output=True, check=True, text=True
+        ).stdout
+        startup = json.loads(output.splitlines()[-1])
+        loaded = [module for module in LAZY_MODULES if module in startup['modules']]
+        self.assertEqual(loaded, [], f'{loaded} are imported at startup')
+        self.assertLess(startup['seconds'], STARTUP_BUDGET)
+
+    @unittest.skipIf(importlib.util.find_spec('jina') is None, 'the gateway needs jina')
+    def test_gateway_readiness_budget(self):
+        # the gateway is started the way it is deployed, next to its packages and plugin files
+        with tempfile.TemporaryDirectory() as directory:
+            shutil.copytree(os.path.join(GATEWAY_ROOT, '.well-known'), os.path.join(directory, '.well-known'))
+            env = dict(
+                os.environ,
+                PYTHONPATH=os.pathsep.join([GATEWAY_ROOT, REPOSITORY_ROOT]),
+                K8S_NAMESPACE_NAME='jnamespace-test',
+                OPENAI_API_KEY='sk-test',
+            )
+            output = subprocess.run(
+                [sys.executable, '-c', GATEWAY_STARTUP_SCRIPT, str(get_free_port())],
+                capture_output=True, check=True, text=True, cwd=directory, env=env, timeout=120,
+            ).stdout
+        startup = json.loads(output.splitlines()[-1])
+        self.assertEqual(startup['status'], 200)
+        loaded = [module for module in LAZY_MODULES if module in startup['modules']]
+        self.assertEqual(loaded, [], f'{loaded} are imported with the gateway')
+        self.assertLess(startup['seconds'], GATEWAY_READINESS_BUDGET)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,7 +1,8 @@
+import gzip
 import os
 import unittest
 
-from goldretriever.retriever import check_bearer_token, check_flow_id, check_openai_key
+from goldretriever.retriever import check_bearer_token, check_flow_id, check_openai_key, compress_body
 
 
 class TestCheckFunctions(unittest.TestCase):
@@ -50,6 +51,13 @@ class TestCheckFunctions(unittest.TestCase):
         with self.assertRaises(ValueError, msg='No OpenAI key is provided'):
             check_openai_key()
 
+    def test_compress_body(self):
+        body = b'{"documents": []}' * 100
+        self.assertEqual(gzip.decompress(compress_body(body, 'gzip')), body)
+        self.assertEqual(compress_body(body, 'none'), body)
+        with self.assertRaises(ValueError):
+            compress_body(body, 'br')
+
 
 if __name__ == '__main__':
     unittest.main()